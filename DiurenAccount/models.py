@@ -17,7 +17,8 @@ from DiurenAccount.apps import logger, EMAIL_TOKEN_EXPIRE, \
     AVATAR_ORIGINAL_SIZE_NAME
 from DiurenAccount.fields import DictField
 from DiurenUtility.aliyun_oss.storage import AliyunBaseStorage
-from DiurenUtility.utility import send_mail, gen_random_char_string, dotdict, generate_thumbnails
+from DiurenUtility.utility import send_mail, gen_random_char_string, dotdict, generate_thumbnails, \
+    delete_many
 
 DEFAULT_LANGUAGE_CODE = settings.LANGUAGE_CODE
 AVAILABLE_LANGUAGES = settings.LANGUAGES
@@ -154,9 +155,8 @@ class UserProfile(models.Model):
     def avatar(self):
         logger.debug('删除头像：开始删除头像')
         storage = default_storage  # type:Storage
-        for name in self._avatar.values():
-            storage.delete(name)
-            logger.debug('删除头像：删除 {name}'.format(name=name))
+        delete_many(storage, self._avatar.values())
+        logger.debug('删除头像：删除 {names}'.format(names=list(self._avatar.values())))
         self._avatar = dict()
         logger.debug('删除头像：完成√')
 
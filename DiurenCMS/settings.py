@@ -184,6 +184,12 @@ if DEBUG:
 else:
     EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 
+# 本地存储下载设置
+# 由前端服务器发送文件内容，可选 'X-Accel-Redirect'（nginx）、'X-Sendfile'（Apache、lighttpd）或 None（由 Django 发送）
+CLOUD_DOWNLOAD_ACCEL = None
+# 使用 X-Accel-Redirect 时，nginx 中映射到 MEDIA_ROOT 的 internal location
+CLOUD_DOWNLOAD_ACCEL_LOCATION = '/protected-media/'
+
 # 阿里云OSS设置
 USE_OSS = False
 
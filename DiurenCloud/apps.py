@@ -5,14 +5,45 @@ VERBOSE_NAME = _('文件管理')
 
 APP_UPLOAD_ROOT = 'cloud/'
 USER_UPLOAD_PATH = APP_UPLOAD_ROOT + 'user/'
+# 断点续传时已接收分片的暂存路径（仅本地存储使用）
+UPLOAD_SESSION_PATH = APP_UPLOAD_ROOT + 'session/'
 
+# 上传时写入存储后端的缓冲区大小（OSS 分片大小）
 FILE_BUFFER_MAX_SIZE = 15 * 1024 * 1024
+# 从存储后端流式读取文件时每次读取的大小
+FILE_STREAM_CHUNK_SIZE = 1024 * 1024
+# 上传请求中 multipart 分隔符与字段头所允许的最大长度
+UPLOAD_MULTIPART_OVERHEAD_MAX_SIZE = 64 * 1024
+
+# 浏览器直传OSS的签名有效期（秒）
+OSS_UPLOAD_TOKEN_EXPIRE = 15 * 60
+# 分配出去的存储名称的预留时间（秒），须长于直传签名的有效期
+STORAGE_NAME_RESERVATION_EXPIRE = 24 * 60 * 60
+
+# 断点续传分片大小限制（OSS 要求除最后一个分片外不小于 100KB，且分片数不超过 10000）
+UPLOAD_SESSION_MIN_PART_SIZE = 100 * 1024
+UPLOAD_SESSION_MAX_PART_SIZE = FILE_BUFFER_MAX_SIZE
+UPLOAD_SESSION_MAX_PART_COUNT = 10000
+
+# 目录树的最大深度（对象的祖先目录数）。树索引中每一级至多占 11 个字符（10 位主键与‘/’），
+# 需保证 11 * CLOUD_TREE_MAX_DEPTH 不超过树索引字段的长度 255
+CLOUD_TREE_MAX_DEPTH = 20
+
+# 回收站中的对象保留的天数，过后由 cloud_purge_trash 命令清除
+TRASH_RETENTION_DAYS = 30
+# 清除回收站时每批删除的数据库记录数
+TRASH_PURGE_BATCH_SIZE = 500
 
 
 class DiurencloudConfig(AppConfig):
     name = 'DiurenCloud'
     verbose_name = VERBOSE_NAME
 
+    def ready(self):
+        from django.db.models.signals import post_migrate
+        from DiurenCloud.search import install_search_index_after_migrate
+        post_migrate.connect(install_search_index_after_migrate, sender=self)
+
 
 import logging
 
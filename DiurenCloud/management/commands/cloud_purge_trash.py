@@ -0,0 +1,79 @@
+import datetime
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from DiurenCloud.apps import logger, TRASH_RETENTION_DAYS, TRASH_PURGE_BATCH_SIZE
+from DiurenCloud.models import CloudBlob, CloudDirectory, CloudFile, CloudUploadSession
+from DiurenUtility.utility import delete_many
+
+
+class Command(BaseCommand):
+    help = '清除回收站中超过保留期的文件与目录：分批删除数据库记录，并批量删除不再被引用的存储对象。' \
+           '指定 --interval 时作为后台任务持续运行。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=TRASH_RETENTION_DAYS,
+                            help='回收站中的对象保留的天数，默认 %d' % TRASH_RETENTION_DAYS)
+        parser.add_argument('--batch-size', type=int, default=TRASH_PURGE_BATCH_SIZE,
+                            help='每批删除的记录数，默认 %d' % TRASH_PURGE_BATCH_SIZE)
+        parser.add_argument('--interval', type=int, default=0,
+                            help='每隔若干秒重复清除一次，默认只运行一次')
+
+    def handle(self, *args, **options):
+        while True:
+            before = timezone.now() - datetime.timedelta(days=options['days'])
+            files, directories = self.purge(before, options['batch_size'])
+            self.stdout.write('清除文件 {files} 个，目录 {directories} 个'.format(
+                files=files, directories=directories))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def purge(self, before, batch_size):
+        # 先清除文件：逐批释放其引用的存储对象，目录中的文件清空后再删除目录
+        files = 0
+        while True:
+            pks = list(CloudFile.objects.filter(trashed_at__lte=before).values_list(
+                'pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            files += self.purge_files(pks, before)
+
+        # 目录由深至浅删除，级联删除时其下已没有需要加载的子对象
+        directories = 0
+        while True:
+            pks = list(CloudDirectory.objects.filter(trashed_at__lte=before).order_by(
+                '-depth').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                deleted, rows = CloudDirectory.objects.filter(
+                    pk__in=pks, trashed_at__lte=before).delete()
+            directories += rows.get(CloudDirectory._meta.label, 0)
+            logger.debug('回收站：清除目录 {count} 个'.format(count=len(pks)))
+        return files, directories
+
+    @staticmethod
+    def purge_files(pks, before) -> int:
+        # 取消这些文件未完成的上传会话，以删除已上传的分片
+        for session in CloudUploadSession.objects.filter(file__in=pks):
+            session.abort()
+        with transaction.atomic():
+            # 再次按时间过滤，跳过在此期间被恢复的文件
+            files = CloudFile.objects.filter(pk__in=pks, trashed_at__lte=before)
+            counts = dict(files.filter(blob__isnull=False).order_by().values('blob').annotate(
+                count=Count('pk')).values_list('blob', 'count'))
+            # 未关联存储对象的已上传文件，直接删除其存储对象
+            paths = list(files.filter(uploaded=True, blob=None).values_list('path', flat=True))
+            files.update(blob=None)
+            CloudBlob.release_many(counts)
+            deleted, rows = files.delete()
+            if paths:
+                transaction.on_commit(lambda: delete_many(default_storage, paths))
+        logger.debug('回收站：清除文件 {count} 个'.format(count=len(pks)))
+        return rows.get(CloudFile._meta.label, 0)
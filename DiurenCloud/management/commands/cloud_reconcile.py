@@ -0,0 +1,206 @@
+import datetime
+import heapq
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from DiurenCloud.apps import USER_UPLOAD_PATH
+from DiurenCloud.models import CloudBlob, CloudFile, CloudUploadSession, CloudStorageName
+from DiurenUtility.utility import delete_many
+
+# 批量删除孤立对象、批量修复缺失对象时每批的数量
+BATCH_SIZE = 1000
+# 从数据库中分批读取记录的数量
+DB_CHUNK_SIZE = 2000
+# 后台线程预取的存储对象数量
+PREFETCH_SIZE = 10000
+
+
+# 按存储名称的字节序排序（与 OSS 列举顺序一致），而不是数据库默认的排序规则
+def ordered_paths(queryset, *fields):
+    column = '{table}.{column}'.format(table=connection.ops.quote_name(queryset.model._meta.db_table),
+                                       column=connection.ops.quote_name('path'))
+    if connection.vendor == 'postgresql':
+        ordering = RawSQL(column + ' COLLATE "C"', ())
+    elif connection.vendor == 'mysql':
+        ordering = RawSQL('BINARY ' + column, ())
+    else:
+        ordering = RawSQL(column, ())
+    return queryset.order_by(ordering.asc()).values_list('path', *fields).iterator(
+        chunk_size=DB_CHUNK_SIZE)
+
+
+def datetime_from_timestamp(ts):
+    if settings.USE_TZ:
+        return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+    return datetime.datetime.fromtimestamp(ts)
+
+
+# 按名称顺序遍历本地存储目录下的所有文件；目录以 name/ 参与排序，保证整体按完整路径的字典序输出
+def iter_local_files(storage, prefix):
+    def walk(directory):
+        try:
+            entries = list(os.scandir(storage.path(directory)))
+        except FileNotFoundError:
+            return
+        entries.sort(key=lambda entry: entry.name + '/' if entry.is_dir() else entry.name)
+        for entry in entries:
+            path = directory + entry.name
+            if entry.is_dir():
+                yield from walk(path + '/')
+            else:
+                stat = entry.stat()
+                yield path, stat.st_size, datetime_from_timestamp(stat.st_mtime)
+
+    return walk(prefix)
+
+
+# 按名称顺序遍历存储后端中指定前缀下的所有文件，返回 (存储名称, 大小, 修改时间)
+def iter_storage_files(storage, prefix):
+    if hasattr(storage, 'iter_dir'):
+        return ((entry.path, entry.size, entry.last_modified)
+                for entry in storage.iter_dir(prefix, recursive=True) if not entry.is_dir)
+    return iter_local_files(storage, prefix)
+
+
+# 在后台线程中读取 iterable，使列举存储对象与读取数据库同时进行
+def prefetch(iterable, size):
+    items = queue.Queue(size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+        items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class Command(BaseCommand):
+    help = '核对数据库记录与存储后端中的用户文件：报告（并可修复）没有记录的孤立对象与记录存在但对象缺失的文件。' \
+           '数据库记录与存储对象均按名称顺序流式读取并归并比较，内存占用与文件数量无关。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='删除存储后端中没有数据库记录的对象')
+        parser.add_argument('--fix-missing', action='store_true',
+                            help='将对象缺失的文件标记为未上传，并删除对应的存储对象记录')
+        parser.add_argument('--grace', type=int, default=60,
+                            help='忽略最近若干分钟内修改的孤立对象（可能正在上传），默认 60')
+        parser.add_argument('--prefix', default=USER_UPLOAD_PATH,
+                            help='要核对的路径前缀，默认 %s' % USER_UPLOAD_PATH)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.storage = default_storage
+        self.orphans, self.missing = [], []
+        self.stats = {'checked': 0, 'orphan': 0, 'missing': 0, 'size_mismatch': 0, 'recent': 0}
+        self.grace_time = timezone.now() - datetime.timedelta(minutes=options['grace'])
+        prefix = options['prefix']
+
+        self.merge(self.iter_records(prefix),
+                   prefetch(iter_storage_files(self.storage, prefix), PREFETCH_SIZE))
+        self.flush_orphans()
+        self.flush_missing()
+
+        self.stdout.write('共核对 {checked} 个对象：孤立对象 {orphan} 个，缺失对象 {missing} 个，'
+                          '大小不符 {size_mismatch} 个，跳过最近修改的对象 {recent} 个'.format(**self.stats))
+
+        # 过期的存储名称预留对应的对象或已写入并被记录，或已不会再写入
+        count = CloudStorageName.purge_expired()
+        if count:
+            self.stdout.write('已清除 {count} 个过期的存储名称预留'.format(count=count))
+
+    # 按名称顺序返回数据库中引用的存储名称：(存储名称, 类型, pk, 大小)
+    # 类型为 blob、file（未关联存储对象的已上传文件）或 session（断点续传目标，对象可能尚未生成）
+    @staticmethod
+    def iter_records(prefix):
+        blobs = ordered_paths(CloudBlob.objects.filter(path__startswith=prefix), 'pk', 'size')
+        files = ordered_paths(CloudFile.objects.filter(path__startswith=prefix, uploaded=True,
+                                                       blob__isnull=True), 'pk', 'size')
+        sessions = ordered_paths(CloudUploadSession.objects.filter(path__startswith=prefix), 'pk',
+                                 'file__size')
+        return heapq.merge(((path, 'blob', pk, size) for path, pk, size in blobs),
+                           ((path, 'file', pk, size) for path, pk, size in files),
+                           ((path, 'session', pk, size) for path, pk, size in sessions))
+
+    def merge(self, records, objects):
+        record = next(records, None)
+        obj = next(objects, None)
+        while record is not None or obj is not None:
+            if obj is None or (record is not None and record[0] < obj[0]):
+                if record[1] != 'session':
+                    self.report_missing(record)
+                record = next(records, None)
+            elif record is None or obj[0] < record[0]:
+                self.report_orphan(obj)
+                obj = next(objects, None)
+            else:
+                # 同一对象可能有多条记录
+                path = obj[0]
+                self.stats['checked'] += 1
+                while record is not None and record[0] == path:
+                    if record[1] != 'session' and record[3] != obj[1]:
+                        self.stats['size_mismatch'] += 1
+                        self.stderr.write('大小不符：{path} 记录 {expected}，实际 {size}'.format(
+                            path=path, expected=record[3], size=obj[1]))
+                    record = next(records, None)
+                obj = next(objects, None)
+
+    def report_orphan(self, obj):
+        path, size, last_modified = obj
+        self.stats['checked'] += 1
+        if last_modified and last_modified > self.grace_time:
+            self.stats['recent'] += 1
+            return
+        self.stats['orphan'] += 1
+        if self.options['verbosity'] >= 2:
+            self.stdout.write('孤立对象：{path}（{size} 字节）'.format(path=path, size=size))
+        if self.options['delete_orphans']:
+            self.orphans.append(path)
+            if len(self.orphans) >= BATCH_SIZE:
+                self.flush_orphans()
+
+    def report_missing(self, record):
+        path, kind, pk, size = record
+        self.stats['missing'] += 1
+        self.stderr.write('对象缺失：{path}（{kind} #{pk}）'.format(path=path, kind=kind, pk=pk))
+        if self.options['fix_missing']:
+            self.missing.append((kind, pk))
+            if len(self.missing) >= BATCH_SIZE:
+                self.flush_missing()
+
+    def flush_orphans(self):
+        if self.orphans:
+            delete_many(self.storage, self.orphans)
+            self.stdout.write('已删除 {count} 个孤立对象'.format(count=len(self.orphans)))
+            self.orphans = []
+
+    def flush_missing(self):
+        if not self.missing:
+            return
+        blobs = [pk for kind, pk in self.missing if kind == 'blob']
+        files = [pk for kind, pk in self.missing if kind == 'file']
+        with transaction.atomic():
+            CloudFile.objects.filter(blob__in=blobs).update(uploaded=False, blob=None)
+            CloudFile.objects.filter(pk__in=files).update(uploaded=False)
+            CloudBlob.objects.filter(pk__in=blobs).delete()
+        self.stdout.write('已将 {count} 个存储对象缺失的记录标记为未上传'.format(count=len(self.missing)))
+        self.missing = []
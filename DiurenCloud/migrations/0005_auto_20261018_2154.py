@@ -0,0 +1,84 @@
+# Generated by Django 2.2.4 on 2026-10-18 13:54
+
+import DiurenCloud.validators
+from django.db import migrations, models
+
+
+def build_tree_index(apps, schema_editor):
+    # 按层级自上而下为已有对象生成树索引
+    CloudDirectory = apps.get_model('DiurenCloud', 'CloudDirectory')
+    CloudFile = apps.get_model('DiurenCloud', 'CloudFile')
+    tree_paths = {None: ''}
+    level = list(CloudDirectory.objects.filter(parent=None))
+    while level:
+        for directory in level:
+            directory.tree_path = tree_paths[directory.parent_id]
+            directory.depth = directory.tree_path.count('/')
+            directory.save(update_fields=('tree_path', 'depth'))
+            tree_paths[directory.pk] = directory.tree_path + str(directory.pk) + '/'
+        level = list(CloudDirectory.objects.filter(parent__in=[d.pk for d in level]))
+    for file in CloudFile.objects.all():
+        file.tree_path = tree_paths.get(file.parent_id, '')
+        file.depth = file.tree_path.count('/')
+        file.save(update_fields=('tree_path', 'depth'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0004_auto_20190812_1424'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clouddirectory',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='clouddirectory',
+            name='tree_path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='cloudfile',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cloudfile',
+            name='tree_path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='clouddirectory',
+            name='name',
+            field=models.CharField(auto_created=True, blank=True, editable=False, max_length=128, validators=[DiurenCloud.validators.validate_object_name_special_characters]),
+        ),
+        migrations.AlterField(
+            model_name='clouddirectory',
+            name='path',
+            field=models.CharField(auto_created=True, blank=True, editable=False, max_length=256),
+        ),
+        migrations.AlterField(
+            model_name='clouddirectory',
+            name='virtual_path',
+            field=models.CharField(auto_created=True, blank=True, editable=False, max_length=256),
+        ),
+        migrations.AlterField(
+            model_name='cloudfile',
+            name='name',
+            field=models.CharField(auto_created=True, blank=True, editable=False, max_length=128, validators=[DiurenCloud.validators.validate_object_name_special_characters]),
+        ),
+        migrations.AlterField(
+            model_name='cloudfile',
+            name='path',
+            field=models.CharField(auto_created=True, blank=True, editable=False, max_length=256),
+        ),
+        migrations.AlterField(
+            model_name='cloudfile',
+            name='virtual_path',
+            field=models.CharField(auto_created=True, blank=True, editable=False, max_length=256),
+        ),
+        migrations.RunPython(build_tree_index, migrations.RunPython.noop),
+    ]
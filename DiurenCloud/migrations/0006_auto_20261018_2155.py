@@ -0,0 +1,48 @@
+# Generated by Django 2.2.4 on 2026-10-18 13:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def reserve_names(apps, schema_editor):
+    CloudObjectName = apps.get_model('DiurenCloud', 'CloudObjectName')
+    for model_name, field in (('CloudDirectory', 'directory'), ('CloudFile', 'file')):
+        model = apps.get_model('DiurenCloud', model_name)
+        CloudObjectName.objects.bulk_create(
+            CloudObjectName(owner_id=obj.owner_id, parent_id=obj.parent_id,
+                            virtual_name=obj.virtual_name, **{field: obj})
+            for obj in model.objects.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0005_auto_20261018_2154'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloudObjectName',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('virtual_name', models.CharField(max_length=128)),
+                ('directory', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='name_reservation', to='DiurenCloud.CloudDirectory')),
+                ('file', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='name_reservation', to='DiurenCloud.CloudFile')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='DiurenCloud.CloudUser')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='DiurenCloud.CloudDirectory')),
+            ],
+            options={
+                'verbose_name': '对象名称',
+                'verbose_name_plural': '对象名称',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='cloudobjectname',
+            constraint=models.UniqueConstraint(fields=('owner', 'parent', 'virtual_name'), name='unique_cloud_object_name'),
+        ),
+        migrations.AddConstraint(
+            model_name='cloudobjectname',
+            constraint=models.UniqueConstraint(condition=models.Q(parent=None), fields=('owner', 'virtual_name'), name='unique_cloud_root_object_name'),
+        ),
+        migrations.RunPython(reserve_names, migrations.RunPython.noop),
+    ]
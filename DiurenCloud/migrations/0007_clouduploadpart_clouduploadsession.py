@@ -0,0 +1,46 @@
+# Generated by Django 2.2.4 on 2026-10-18 13:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0006_auto_20261018_2155'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloudUploadSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('part_size', models.PositiveIntegerField()),
+                ('path', models.CharField(editable=False, max_length=256)),
+                ('upload_id', models.CharField(blank=True, editable=False, max_length=64)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='DiurenCloud.CloudFile')),
+            ],
+            options={
+                'verbose_name': '上传会话',
+                'verbose_name_plural': '上传会话',
+            },
+        ),
+        migrations.CreateModel(
+            name='CloudUploadPart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('md5', models.CharField(max_length=32)),
+                ('etag', models.CharField(blank=True, max_length=64)),
+                ('path', models.CharField(blank=True, max_length=256)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='DiurenCloud.CloudUploadSession')),
+            ],
+            options={
+                'verbose_name': '上传分片',
+                'verbose_name_plural': '上传分片',
+                'unique_together': {('session', 'number')},
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_blobs(apps, schema_editor):
+    # 为已上传的文件建立存储对象；内容重复但路径不同的旧文件保持不变，不关联存储对象
+    CloudBlob = apps.get_model('DiurenCloud', 'CloudBlob')
+    CloudFile = apps.get_model('DiurenCloud', 'CloudFile')
+    for file in CloudFile.objects.filter(uploaded=True).order_by('pk'):
+        blob, created = CloudBlob.objects.get_or_create(md5=file.md5, size=file.size,
+                                                        defaults={'path': file.path})
+        if blob.path == file.path:
+            blob.reference_count += 1
+            blob.save()
+            file.blob = blob
+            file.save(update_fields=('blob',))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0007_clouduploadpart_clouduploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloudBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('md5', models.CharField(max_length=32)),
+                ('size', models.IntegerField()),
+                ('path', models.CharField(max_length=256, unique=True)),
+                ('reference_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': '存储对象',
+                'verbose_name_plural': '存储对象',
+                'unique_together': {('md5', 'size')},
+            },
+        ),
+        migrations.AddField(
+            model_name='cloudfile',
+            name='blob',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='files', to='DiurenCloud.CloudBlob'),
+        ),
+        migrations.RunPython(create_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+def compute_rollups(apps, schema_editor):
+    CloudUser = apps.get_model('DiurenCloud', 'CloudUser')
+    CloudDirectory = apps.get_model('DiurenCloud', 'CloudDirectory')
+    CloudFile = apps.get_model('DiurenCloud', 'CloudFile')
+    users = {user.pk: user for user in CloudUser.objects.all()}
+    directories = {directory.pk: directory for directory in CloudDirectory.objects.all()}
+
+    def add(obj, total_size, file_count, directory_count):
+        targets = [directories[int(pk)] for pk in obj.tree_path.split('/') if pk]
+        targets.append(users[obj.owner_id])
+        for target in targets:
+            target.total_size += total_size
+            target.file_count += file_count
+            target.directory_count += directory_count
+
+    for directory in directories.values():
+        add(directory, 0, 0, 1)
+    for file in CloudFile.objects.all():
+        add(file, file.size, 1, 0)
+    for obj in list(users.values()) + list(directories.values()):
+        obj.save(update_fields=('total_size', 'file_count', 'directory_count'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0008_auto_20261018_2201'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clouddirectory',
+            name='directory_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='clouddirectory',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='clouddirectory',
+            name='total_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='clouduser',
+            name='directory_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='clouduser',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='clouduser',
+            name='total_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0009_auto_20261018_2202'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='clouddirectory',
+            index=models.Index(fields=['owner', 'parent', 'virtual_name', 'id'], name='cloud_directory_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cloudfile',
+            index=models.Index(fields=['owner', 'parent', 'virtual_name', 'id'], name='cloud_file_listing_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0010_auto_20261018_2203'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='clouddirectory',
+            name='cloud_directory_listing_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='cloudfile',
+            name='cloud_file_listing_idx',
+        ),
+        migrations.AddField(
+            model_name='clouddirectory',
+            name='trashed_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='cloudfile',
+            name='trashed_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='clouddirectory',
+            index=models.Index(fields=['owner', 'parent', 'trashed_at', 'virtual_name', 'id'], name='cloud_directory_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cloudfile',
+            index=models.Index(fields=['owner', 'parent', 'trashed_at', 'virtual_name', 'id'], name='cloud_file_listing_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:41
+
+from django.db import migrations
+
+# 按数据库类型建立名称搜索索引：SQLite 上为 FTS5 trigram 索引表与触发器，PostgreSQL 上为 pg_trgm GIN 索引
+# 迁移中的语句是固定的，不引用 DiurenCloud.search 中的现行代码
+
+SEARCH_MODELS = ('CloudDirectory', 'CloudFile')
+
+# SQLite 自 3.34.0 起支持 trigram 分词器，更早的版本不建立索引
+SQLITE_TRIGRAM_MIN_VERSION = (3, 34, 0)
+
+INSTALL_SQL = {
+    'sqlite': (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS "{search}" USING fts5('
+        'virtual_name, content="{table}", content_rowid="id", tokenize="trigram")',
+        'CREATE TRIGGER IF NOT EXISTS "{search}_ai" AFTER INSERT ON "{table}" '
+        'BEGIN INSERT INTO "{search}"(rowid, virtual_name) '
+        'VALUES (new.id, new.virtual_name); END',
+        'CREATE TRIGGER IF NOT EXISTS "{search}_ad" AFTER DELETE ON "{table}" '
+        'BEGIN INSERT INTO "{search}"("{search}", rowid, virtual_name) '
+        'VALUES (\'delete\', old.id, old.virtual_name); END',
+        'CREATE TRIGGER IF NOT EXISTS "{search}_au" AFTER UPDATE OF virtual_name ON "{table}" '
+        'BEGIN INSERT INTO "{search}"("{search}", rowid, virtual_name) '
+        'VALUES (\'delete\', old.id, old.virtual_name); '
+        'INSERT INTO "{search}"(rowid, virtual_name) VALUES (new.id, new.virtual_name); END',
+        # 为已有的对象建立索引
+        'INSERT INTO "{search}"("{search}") VALUES (\'rebuild\')',
+    ),
+    'postgresql': (
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        # 与 icontains/istartswith 生成的 UPPER("virtual_name"::text) LIKE UPPER(%s) 一致
+        'CREATE INDEX IF NOT EXISTS "{search}_trgm_idx" ON "{table}" '
+        'USING gin (UPPER("virtual_name"::text) gin_trgm_ops)',
+    ),
+}
+
+UNINSTALL_SQL = {
+    'sqlite': (
+        'DROP TRIGGER IF EXISTS "{search}_ai"',
+        'DROP TRIGGER IF EXISTS "{search}_ad"',
+        'DROP TRIGGER IF EXISTS "{search}_au"',
+        'DROP TABLE IF EXISTS "{search}"',
+    ),
+    'postgresql': (
+        'DROP INDEX IF EXISTS "{search}_trgm_idx"',
+    ),
+}
+
+
+def execute(apps, schema_editor, statements):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite' and \
+            connection.Database.sqlite_version_info < SQLITE_TRIGRAM_MIN_VERSION:
+        return
+    for model_name in SEARCH_MODELS:
+        table = apps.get_model('DiurenCloud', model_name)._meta.db_table
+        for sql in statements.get(connection.vendor, ()):
+            schema_editor.execute(sql.format(table=table, search=table + '_search'))
+
+
+def install(apps, schema_editor):
+    execute(apps, schema_editor, INSTALL_SQL)
+
+
+def uninstall(apps, schema_editor):
+    execute(apps, schema_editor, UNINSTALL_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0011_auto_20261018_2230'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0012_auto_20261018_2241'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cloudfile',
+            index=models.Index(fields=['path', 'uploaded'], name='cloud_file_path_idx'),
+        ),
+    ]
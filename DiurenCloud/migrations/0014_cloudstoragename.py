@@ -0,0 +1,25 @@
+# Generated by Django 2.2.4 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DiurenCloud', '0013_auto_20261018_2246'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloudStorageName',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=256, unique=True)),
+                ('reserved', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': '存储名称',
+                'verbose_name_plural': '存储名称',
+            },
+        ),
+    ]
@@ -1,24 +1,59 @@
+import datetime
 import hashlib
+import math
+import os
+from collections import Counter
+from itertools import chain, groupby
+from operator import attrgetter
 
 from django.conf import settings
 from django.conf.global_settings import MEDIA_ROOT
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage, Storage
-from django.db import models
-from django.db.models import QuerySet
-from django.db.models.signals import post_save
+from django.db import models, transaction, IntegrityError
+from django.db.models import QuerySet, F, Value, Case, When, Count, Max
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext, gettext_lazy as _
 
 # Create your models here.
-from DiurenCloud.apps import USER_UPLOAD_PATH, logger
+from DiurenCloud.apps import USER_UPLOAD_PATH, logger, UPLOAD_SESSION_PATH, \
+    FILE_BUFFER_MAX_SIZE, UPLOAD_SESSION_MIN_PART_SIZE, UPLOAD_SESSION_MAX_PART_SIZE, \
+    UPLOAD_SESSION_MAX_PART_COUNT, STORAGE_NAME_RESERVATION_EXPIRE, CLOUD_TREE_MAX_DEPTH
 from DiurenCloud.validators import validate_object_name_special_characters
-from DiurenUtility.aliyun_oss.storage import AliyunMediaStorage
+from DiurenUtility.aliyun_oss.storage import AliyunMediaStorage, register_name_index, multipart_etag
+from DiurenUtility.utility import file_md5, open_storage_writer, MD5HashingFile, delete_many
 
 
-class CloudUser(models.Model):
+ROLLUP_FIELDS = ('total_size', 'file_count', 'directory_count')
+
+
+class CloudRollup(models.Model):
+    class Meta:
+        abstract = True
+
+    # 统计信息：其下所有文件（包括尚未上传完成的文件）的总大小、文件数与目录数
+    # 在文件/目录创建、删除、移动时沿祖先链增量更新，读取时无需遍历目录树
+    total_size = models.BigIntegerField(default=0, editable=False)
+    file_count = models.PositiveIntegerField(default=0, editable=False)
+    directory_count = models.PositiveIntegerField(default=0, editable=False)
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        # 统计字段只通过增量更新维护，保存时不写入，以免内存中的旧值覆盖数据库中的值
+        if not self._state.adding and update_fields is None:
+            update_fields = [f.name for f in self._meta.concrete_fields
+                             if not f.primary_key and f.name not in ROLLUP_FIELDS]
+        return super().save(force_insert, force_update, using, update_fields)
+
+
+class CloudUser(CloudRollup):
     class Meta:
         verbose_name = _('云用户')
         verbose_name_plural = _('云用户')
@@ -39,6 +74,7 @@ class CloudObject(models.Model):
 
     # 注意：在修改文件名称或虚拟名称后，必须保存以使路径字段刷新，
     # 或者也可以调用 obj._path obj._virtual_path 来强制计算最新路径
+    # 保存目录时，其所有子孙对象的路径字段会被一并批量改写
     name = models.CharField(max_length=128, blank=True, auto_created=True,
                             validators=(validate_object_name_special_characters,), editable=False)
     virtual_name = models.CharField(max_length=128,
@@ -50,7 +86,15 @@ class CloudObject(models.Model):
     # 面向用户的虚拟路径
     virtual_path = models.CharField(max_length=256, blank=True, editable=False, auto_created=True)
 
+    # 树索引：祖先目录主键链（由根至父，以‘/’结尾，如 '1/5/9/'），根目录下的对象为空字符串
+    # 祖先查询、子树查询以及“是否位于某目录内”的判断均基于此字段，无需逐级访问 parent
+    tree_path = models.CharField(max_length=255, blank=True, editable=False, db_index=True)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+
     last_modified = models.DateTimeField(auto_now=True)
+    # 移入回收站的时间，为空表示不在回收站中
+    # 目录移入回收站时，其子树中的对象被标记为同一时间，恢复时据此一并恢复
+    trashed_at = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
 
     owner = models.ForeignKey(to=CloudUser, on_delete=models.CASCADE)
     parent = models.ForeignKey(to='CloudDirectory', on_delete=models.CASCADE,
@@ -65,61 +109,359 @@ class CloudObject(models.Model):
     def clean(self):
         if not self.name:
             self.name = self.virtual_name
+        # 移动到更深处时，其子树中的对象随之加深
+        depth = self.parent.depth + 1 if self.parent else 0
+        if depth > self.depth:
+            self._validate_depth(depth + self._subtree_height())
+
+    # 子树中最深的对象比自身深的层数
+    def _subtree_height(self) -> int:
+        return 0
+
+    # 树索引字段的长度有限，限制目录树的深度
+    @staticmethod
+    def _validate_depth(depth: int):
+        if depth > CLOUD_TREE_MAX_DEPTH:
+            raise ValidationError(_('目录层级过深，最多允许 %(max)d 层。'), code='tree-too-deep',
+                                  params={'max': CLOUD_TREE_MAX_DEPTH})
+
+    # 同一目录下的文件与目录共用名称占用表，只需一次索引查询即可判断名称是否重复
+    def validate_unique(self, exclude=None):
+        if hasattr(self, 'owner'):
+            names = CloudObjectName.objects.filter(owner=self.owner, parent=self.parent,
+                                                   virtual_name=self.virtual_name)  # type:QuerySet
+            if not self._state.adding:
+                names = names.exclude(**{self.name_reservation_field: self})
+            if names.exists():
+                raise ValidationError(_('对象名称重复！'), code='object-name-duplicated')
+
+    # 保存与删除时需要读取的数据库中的旧值
+    tracked_fields = ('tree_path', 'path', 'virtual_path', 'owner')
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         if hasattr(self, 'owner'):
-            # 重新计算路径，并保存到持久化字段中
-            self.path = self._path
-            self.virtual_path = self._virtual_path
-        instance = super().save(force_insert, force_update, using, update_fields)
+            # 父目录的树索引与路径可能已被批量改写，先从数据库中刷新
+            if self.parent:
+                self.parent.refresh_from_db(fields=('tree_path', 'path', 'virtual_path'))
+            self._update_paths()
+        with transaction.atomic(using=using):
+            old = None
+            if not self._state.adding:
+                old = type(self).objects.filter(pk=self.pk).values(*self.tracked_fields).first()
+            instance = super().save(force_insert, force_update, using, update_fields)
+            self._after_save(old)
         return instance
 
+    # 重新计算树索引与路径，并保存到持久化字段中
+    def _update_paths(self):
+        self.tree_path = self._tree_path
+        self.depth = self.tree_path.count('/')
+        # 已上传文件的路径即其在存储后端上的键，不随所在目录的移动而改变
+        if not getattr(self, 'uploaded', False):
+            self.path = self._path
+        self.virtual_path = self._virtual_path
+
+    def _after_save(self, old):
+        self._reserve_name()
+        self._update_rollups(old)
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic(using=using):
+            old = type(self).objects.filter(pk=self.pk).values(
+                'trashed_at', *self.tracked_fields).first()
+            if old:
+                self._apply_rollup(old['tree_path'], old['owner'], self._rollup_weight(old), -1,
+                                   old['trashed_at'])
+            return super().delete(using, keep_parents)
+
+    # 统计信息的增量维护由以下两个方法决定，子类必须实现：
+    # _rollup_weight(values) 返回对象自身计入祖先目录与所属用户统计信息中的数值（键为 ROLLUP_FIELDS），
+    # values 为对象的字段值，可以是数据库中的旧值（tracked_fields 与 trashed_at），也可以是 _rollup_values 的结果；
+    # _rollup_values(old) 返回保存后用于计算权重的字段值，old 为保存前数据库中的旧值，新建对象时为 None
+    def _rollup_weight(self, values: dict) -> dict:
+        raise NotImplementedError('{model} 未实现 _rollup_weight'.format(model=type(self).__name__))
+
+    def _rollup_values(self, old: dict) -> dict:
+        raise NotImplementedError('{model} 未实现 _rollup_values'.format(model=type(self).__name__))
+
+    def _update_rollups(self, old):
+        weight = self._rollup_weight(self._rollup_values(old))
+        if old is not None:
+            old_weight = self._rollup_weight(old)
+            if (old['tree_path'], old['owner'], old_weight) == (self.tree_path, self.owner_id,
+                                                               weight):
+                return
+            self._apply_rollup(old['tree_path'], old['owner'], old_weight, -1)
+        self._apply_rollup(self.tree_path, self.owner_id, weight, 1)
+
+    # 对一条祖先链上的所有目录以及所属用户的统计信息进行增量更新，每张表一次UPDATE
+    # 回收站中的对象（trashed_at 不为空）在移入回收站时已从更上层的祖先与所属用户中扣除，
+    # 只计入随其一并移入回收站（移入时间相同）的祖先目录
+    @staticmethod
+    def _apply_rollup(tree_path: str, owner_pk: int, weight: dict, sign: int, trashed_at=None):
+        changes = {field: F(field) + sign * value for field, value in weight.items() if value}
+        if not changes:
+            return
+        ancestor_pks = [int(pk) for pk in tree_path.split('/') if pk]
+        ancestors = CloudDirectory.objects.filter(pk__in=ancestor_pks)
+        if trashed_at is not None:
+            if ancestor_pks:
+                ancestors.filter(trashed_at=trashed_at).update(**changes)
+            return
+        if ancestor_pks:
+            ancestors.update(**changes)
+        CloudUser.objects.filter(pk=owner_pk).update(**changes)
+
+    # 移入回收站：对用户立即不可见，释放名称并从祖先目录与所属用户的统计信息中扣除，
+    # 数据库记录与存储对象由 cloud_purge_trash 命令在保留期过后分批清除
+    def trash(self):
+        with transaction.atomic():
+            old = type(self).objects.select_for_update().filter(
+                pk=self.pk, trashed_at=None).values(*self.tracked_fields).first()
+            if old is None:
+                return
+            self.trashed_at = timezone.now()
+            type(self).objects.filter(pk=self.pk).update(trashed_at=self.trashed_at)
+            self._trash_descendants()
+            CloudObjectName.objects.filter(**{self.name_reservation_field: self}).delete()
+            self._apply_rollup(old['tree_path'], old['owner'], self._rollup_weight(old), -1)
+        logger.debug('回收站：移入 {obj}'.format(obj=self))
+
+    # 从回收站中恢复到原位置，原位置已有同名对象或父目录仍在回收站中时抛出 ValidationError
+    def restore(self):
+        with transaction.atomic():
+            old = type(self).objects.select_for_update().filter(
+                pk=self.pk, trashed_at__isnull=False).values(
+                'trashed_at', *self.tracked_fields).first()
+            if old is None:
+                return
+            if CloudDirectory.objects.filter(pk=self.parent_id, trashed_at__isnull=False).exists():
+                raise ValidationError(_('父目录位于回收站中，无法恢复。'), code='parent-trashed')
+            self.validate_unique()
+            self.trashed_at = None
+            type(self).objects.filter(pk=self.pk).update(trashed_at=None)
+            self._restore_descendants(old['trashed_at'])
+            self._reserve_name()
+            self._apply_rollup(old['tree_path'], old['owner'], self._rollup_weight(old), 1)
+        logger.debug('回收站：恢复 {obj}'.format(obj=self))
+
+    def _trash_descendants(self):
+        pass
+
+    def _restore_descendants(self, trashed_at):
+        pass
+
+    # 名称占用表上的唯一约束在并发保存时由数据库保证名称不重复（违反时抛出 IntegrityError）
+    def _reserve_name(self):
+        reservation = {
+            'owner': self.owner,
+            'parent': self.parent,
+            'virtual_name': self.virtual_name,
+        }
+        names = CloudObjectName.objects.filter(**{self.name_reservation_field: self})
+        if not names.update(**reservation):
+            reservation[self.name_reservation_field] = self
+            CloudObjectName.objects.create(**reservation)
+
     # 因为覆盖 __eq__ 方法会导致 __hash__ 无法继承，在这再定义一次。
     def __hash__(self):
         if self.pk is None:
             raise TypeError("Model instances without primary key value are unhashable")
         return hash(self.pk)
 
+    @property
+    def _tree_path(self):
+        if self.parent:
+            return self.parent.subtree_path
+        return ''
+
+    # 父目录的路径字段已持久化，直接在其基础上拼接，不再逐级向上查询
     @property
     # (Media Root/)cloud/user/<username>/<path>
     def _path(self):
         if self.parent:
-            path = self.parent._path + self.name
-        else:
-            path = self.name
-        return self.owner.object_path + path
+            return self.parent.path + self.name
+        return self.owner.object_path + self.name
 
     @property
     # 返回包括用户根虚拟路径的路径 <username>/<virtual_path>
     def _virtual_path(self):
         if self.parent:
-            return self.parent._virtual_path + self.virtual_name
+            return self.parent.virtual_path + self.virtual_name
         else:
             return self.owner.user.username + '/' + self.virtual_name
 
+    @property
+    def ancestor_pks(self):
+        return [int(pk) for pk in self.tree_path.split('/') if pk]
+
+    # 由根至父的全部祖先目录，仅需一次查询
+    @property
+    def ancestors(self) -> QuerySet:
+        return CloudDirectory.objects.filter(pk__in=self.ancestor_pks).order_by('depth')
+
+    def is_inside(self, directory: 'CloudDirectory') -> bool:
+        return self.tree_path.startswith(directory.subtree_path)
+
+
+class CloudDirectory(CloudObject, CloudRollup):
+    class Meta:
+        indexes = (
+            # 目录列表按名称分页（不包括回收站中的对象）
+            models.Index(fields=('owner', 'parent', 'trashed_at', 'virtual_name', 'id'),
+                         name='cloud_directory_listing_idx'),
+        )
+
+    name_reservation_field = 'directory'
 
-class CloudDirectory(CloudObject):
     owner = models.ForeignKey(to=CloudUser, on_delete=models.CASCADE, related_name='directories')
     parent = models.ForeignKey(to='self', on_delete=models.CASCADE, related_name='directories',
                                null=True, blank=True)
 
-    def validate_unique(self, exclude=None):
-        if hasattr(self, 'owner'):
-            directories = CloudDirectory.objects.filter(parent=self.parent,
-                                                        owner=self.owner)  # type:QuerySet
-            files = CloudFile.objects.filter(parent=self.parent, owner=self.owner)  # type:QuerySet
-            if not self._state.adding:
-                directories = directories.exclude(pk=self.pk)
-            unique = True
-            for d in directories:
-                if self == d:
-                    unique = False
-            for f in files:
-                if self == f:
-                    unique = False
-            if not unique:
-                raise ValidationError(_('对象名称重复！'))
+    def clean(self):
+        super().clean()
+        if self.parent and self.pk and (self.parent.pk == self.pk or self.parent.is_inside(self)):
+            raise ValidationError({'parent': _('不能将目录移动到其自身或其子目录中。')})
+
+    tracked_fields = CloudObject.tracked_fields + ROLLUP_FIELDS
+
+    def _subtree_height(self):
+        if self.pk is None:
+            return 0
+        depths = [model.objects.filter(tree_path__startswith=self.subtree_path).aggregate(
+            depth=Max('depth'))['depth'] for model in (CloudDirectory, CloudFile)]
+        return max((depth for depth in depths if depth is not None), default=self.depth) - self.depth
+
+    def _after_save(self, old):
+        super()._after_save(old)
+        # 目录被移动或重命名时，一次性改写整棵子树的树索引与路径前缀
+        if old and (old['tree_path'] != self.tree_path or old['path'] != self.path or
+                    old['virtual_path'] != self.virtual_path):
+            self._rewrite_subtree(old['tree_path'] + str(self.pk) + '/',
+                                  old['path'], old['virtual_path'])
+
+    def _rollup_weight(self, values):
+        return {
+            'total_size': values['total_size'],
+            'file_count': values['file_count'],
+            'directory_count': values['directory_count'] + 1,
+        }
+
+    # 目录自身的统计信息不因保存而改变，以数据库中的值为准
+    def _rollup_values(self, old):
+        if old is None:
+            return {field: 0 for field in ROLLUP_FIELDS}
+        return old
+
+    def _rewrite_subtree(self, old_subtree_path: str, old_path: str, old_virtual_path: str):
+        logger.debug('云目录：改写子树 {old} -> {new}'.format(old=old_virtual_path,
+                                                        new=self.virtual_path))
+
+        def replace_prefix(field, old_prefix, new_prefix):
+            return Concat(Value(new_prefix), Substr(field, len(old_prefix) + 1))
+
+        depth_delta = self.subtree_path.count('/') - old_subtree_path.count('/')
+        changes = {
+            'tree_path': replace_prefix('tree_path', old_subtree_path, self.subtree_path),
+            'depth': F('depth') + depth_delta,
+            'virtual_path': replace_prefix('virtual_path', old_virtual_path, self.virtual_path),
+        }
+        path = replace_prefix('path', old_path, self.path)
+        CloudDirectory.objects.filter(tree_path__startswith=old_subtree_path).update(
+            path=path, **changes)
+        # 已上传文件的路径即其在存储后端上的键，保持不变
+        CloudFile.objects.filter(tree_path__startswith=old_subtree_path).update(
+            path=Case(When(uploaded=True, then=F('path')), default=path,
+                      output_field=models.CharField()),
+            **changes)
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic(using=using):
+            # 子树中的文件将随目录级联删除：一次性释放其引用的存储对象，并批量删除不再被引用的对象，
+            # 随后解除文件与存储对象的关联，以免逐个文件释放
+            files = self.descendant_files.filter(blob__isnull=False)
+            counts = dict(files.order_by().values('blob').annotate(count=Count('pk')).values_list(
+                'blob', 'count'))
+            files.update(blob=None)
+            CloudBlob.release_many(counts)
+            return super().delete(using, keep_parents)
+
+    # 子树中尚未移入回收站的对象一并标记，以便通过单条 UPDATE 对用户隐藏整棵子树
+    def _trash_descendants(self):
+        self.descendant_directories.filter(trashed_at=None).update(trashed_at=self.trashed_at)
+        self.descendant_files.filter(trashed_at=None).update(trashed_at=self.trashed_at)
+
+    # 只恢复随目录一并移入回收站的对象，此前单独移入回收站的对象保持不变
+    def _restore_descendants(self, trashed_at):
+        self.descendant_directories.filter(trashed_at=trashed_at).update(trashed_at=None)
+        self.descendant_files.filter(trashed_at=trashed_at).update(trashed_at=None)
+
+    # 将整棵子树复制到 parent 目录下（parent 为空时复制到所属用户的根目录下），返回目录副本
+    # 文件副本与原文件引用同一个存储对象，只增加引用数，存储后端上不复制任何数据；
+    # 子孙目录逐层批量插入，文件与名称占用一次性批量插入，统计信息在内存中汇总后批量写入。
+    # 尚未上传完成的文件与回收站中的对象不会被复制
+    def copy_to(self, parent: 'CloudDirectory' = None,
+                virtual_name: str = None) -> 'CloudDirectory':
+        if parent and (parent.pk == self.pk or parent.is_inside(self)):
+            raise ValidationError({'parent': _('不能将目录复制到其自身或其子目录中。')})
+        owner = parent.owner if parent else self.owner
+        self._validate_depth((parent.depth + 1 if parent else 0) + self._subtree_height())
+        with transaction.atomic():
+            descendant_files = self.descendant_files.filter(uploaded=True, trashed_at=None)
+            for cloud_file in descendant_files.filter(blob=None):
+                cloud_file.ensure_blob()
+            directories = list(self.descendant_directories.filter(trashed_at=None).order_by(
+                'depth', 'pk'))
+            files = list(descendant_files.order_by('pk'))
+
+            root = CloudDirectory(owner=owner, parent=parent,
+                                  virtual_name=virtual_name or self.virtual_name)
+            root.full_clean()
+            root.save()
+            logger.debug('云目录：复制 {source} -> {target}，{directories} 个目录，{files} 个文件'.format(
+                source=self.virtual_path, target=root.virtual_path,
+                directories=len(directories), files=len(files)))
+            copies = {self.pk: root}
+            for depth, level in groupby(directories, key=attrgetter('depth')):
+                level = list(level)
+                copies.update(zip((d.pk for d in level), _bulk_copy(root, level, copies, owner)))
+            file_copies = _bulk_copy(root, files, copies, owner,
+                                     fields=('size', 'md5', 'uploaded', 'blob_id'))
+
+            directory_copies = [copies[d.pk] for d in directories]
+            CloudObjectName.objects.bulk_create(
+                CloudObjectName(owner=owner, parent=obj.parent, virtual_name=obj.virtual_name,
+                                **{obj.name_reservation_field: obj})
+                for obj in chain(directory_copies, file_copies))
+            CloudBlob.acquire_many(Counter(f.blob_id for f in files))
+
+            # 自底向上汇总统计信息
+            for cloud_file in file_copies:
+                cloud_file.parent.total_size += cloud_file.size
+                cloud_file.parent.file_count += 1
+            for directory in reversed(directory_copies):
+                directory.parent.total_size += directory.total_size
+                directory.parent.file_count += directory.file_count
+                directory.parent.directory_count += directory.directory_count + 1
+            CloudDirectory.objects.bulk_update(list(copies.values()), ROLLUP_FIELDS)
+            # 目录副本自身已在保存时计入，此处只需计入其内容
+            self._apply_rollup(root.tree_path, owner.pk,
+                               {field: getattr(root, field) for field in ROLLUP_FIELDS}, 1)
+        return root
+
+    # 子对象的 tree_path 均以此为前缀
+    @property
+    def subtree_path(self):
+        return self.tree_path + str(self.pk) + '/'
+
+    @property
+    def descendant_directories(self) -> QuerySet:
+        return CloudDirectory.objects.filter(tree_path__startswith=self.subtree_path)
+
+    @property
+    def descendant_files(self) -> QuerySet:
+        return CloudFile.objects.filter(tree_path__startswith=self.subtree_path)
 
     @property
     def _path(self):
@@ -131,6 +473,17 @@ class CloudDirectory(CloudObject):
 
 
 class CloudFile(CloudObject):
+    class Meta:
+        indexes = (
+            # 目录列表按名称分页（不包括回收站中的对象）
+            models.Index(fields=('owner', 'parent', 'trashed_at', 'virtual_name', 'id'),
+                         name='cloud_file_listing_idx'),
+            # 分配存储名称时查询尚未关联 CloudBlob 的已上传文件所占用的路径
+            models.Index(fields=('path', 'uploaded'), name='cloud_file_path_idx'),
+        )
+
+    name_reservation_field = 'file'
+
     owner = models.ForeignKey(to=CloudUser, on_delete=models.CASCADE, related_name='files')
     parent = models.ForeignKey(to=CloudDirectory, on_delete=models.CASCADE, related_name='files',
                                null=True, blank=True)
@@ -138,35 +491,29 @@ class CloudFile(CloudObject):
     size = models.IntegerField(default=0)
     md5 = models.CharField(max_length=32)
     uploaded = models.BooleanField(default=False)
+    # 文件内容所在的共享存储对象，内容相同的文件共用同一个对象
+    blob = models.ForeignKey(to='CloudBlob', on_delete=models.SET_NULL, related_name='files',
+                             null=True, blank=True, editable=False)
+
+    tracked_fields = CloudObject.tracked_fields + ('size',)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.storage = default_storage  # type:Storage
 
-    def validate_unique(self, exclude=None):
-        if hasattr(self, 'owner'):
-            directories = CloudDirectory.objects.filter(parent=self.parent,
-                                                        owner=self.owner)  # type:QuerySet
-            files = CloudFile.objects.filter(parent=self.parent, owner=self.owner)  # type:QuerySet
-            if not self._state.adding:
-                files = files.exclude(pk=self.pk)
-            unique = True
-            for d in directories:
-                if self == d:
-                    unique = False
-            for f in files:
-                if self == f:
-                    unique = False
-            if not unique:
-                raise ValidationError(_('对象名称重复！'))
+    def _rollup_weight(self, values):
+        return {
+            'total_size': values['size'],
+            'file_count': 1,
+            'directory_count': 0,
+        }
+
+    def _rollup_values(self, old):
+        return {'size': self.size}
 
     @property
     def _md5(self):
-        # todo 大文件分部分hash
-        hasher = hashlib.md5()
-        buf = self.file.read()
-        hasher.update(buf)
-        return hasher.hexdigest()
+        return file_md5(self.file)
 
     @property
     def url(self):
@@ -176,10 +523,22 @@ class CloudFile(CloudObject):
             if settings.USE_OSS:
                 oss_storage = self.storage  # type:AliyunMediaStorage
                 return oss_storage.url(self.path, virtual_name=self.virtual_name)
-            return self.storage.url(self.path)
+            # 使用本地存储时经由下载视图验证用户身份，并支持断点续传
+            return reverse('DiurenCloud:download', kwargs={'pk': self.pk})
         else:
             return None
 
+    # 批量生成多个文件的下载url，返回 {pk: url}
+    # 使用阿里云存储时一次性读取签名url缓存，仅对未命中的文件重新签名
+    @classmethod
+    def get_urls(cls, files) -> dict:
+        files = [f for f in files if f.uploaded]
+        if settings.USE_OSS and files:
+            oss_storage = files[0].storage  # type:AliyunMediaStorage
+            urls = oss_storage.urls([(f.path, f.virtual_name) for f in files])
+            return {f.pk: url for f, url in zip(files, urls)}
+        return {f.pk: f.url for f in files}
+
     @property
     def file(self):
         logger.debug('云文件：打开文件 {file}'.format(file=self))
@@ -187,7 +546,80 @@ class CloudFile(CloudObject):
 
     @file.setter
     def file(self, file_obj: File):
-        self.path = self.storage.save(self.path, file_obj)
+        hashing_file = MD5HashingFile(file_obj)
+        path = self.storage.save(self.path, hashing_file)
+        self.md5 = hashing_file.md5
+        self.size = hashing_file.size
+        self.attach(path)
+
+    # 关联一个已经保存在存储后端上的对象，其内容须与 md5、size 字段一致
+    # 若已存在相同内容的对象，则删除刚保存的对象，改为引用已有对象
+    def attach(self, path: str):
+        blob, created = CloudBlob.acquire(self.md5, self.size, path)
+        if not created and blob.path != path:
+            logger.debug('云文件：内容重复，删除 {path}'.format(path=path))
+            self.storage.delete(path)
+        self._link_blob(blob)
+
+    # 秒传：若所属用户已有相同内容的文件，直接引用其存储对象，无需上传
+    # 只凭 md5 与大小无法证明客户端持有文件内容，因此不引用其他用户的存储对象
+    # 锁定该对象后再增加引用数，以免其在此期间被释放并删除；此处只引用已有的对象，从不新建
+    def attach_existing_blob(self) -> bool:
+        owned = CloudFile.objects.filter(owner_id=self.owner_id, blob__isnull=False)
+        with transaction.atomic():
+            try:
+                blob = CloudBlob.objects.select_for_update().get(
+                    md5=self.md5, size=self.size, pk__in=owned.values('blob_id'))
+            except CloudBlob.DoesNotExist:
+                return False
+            if self.blob_id == blob.pk:
+                return True
+            blob.reference_count += 1
+            blob.save(update_fields=('reference_count',))
+            logger.debug('存储对象：引用 {blob}，引用数 {count}'.format(blob=blob,
+                                                               count=blob.reference_count))
+            if self.uploaded:
+                del self.file
+            self._link_blob(blob)
+        return True
+
+    # 早期上传的文件与通过断点续传上传到OSS的文件未关联存储对象，为其建立关联，以便与其它文件共用
+    # 这些文件的MD5未经服务器校验，关联前读取文件重新计算，以免内容与MD5不符的对象被其它文件引用
+    def ensure_blob(self):
+        if self.uploaded and not self.blob_id:
+            with self.storage.open(self.path) as f:
+                md5 = file_md5(f, FILE_BUFFER_MAX_SIZE)
+            if md5 != self.md5:
+                logger.warning('云文件：{file} 的内容与MD5 {md5} 不符，按实际内容更新'.format(
+                    file=self, md5=self.md5))
+                self.md5 = md5
+            self.attach(self.path)
+            self.save()
+
+    # 复制文件到 parent 目录下（parent 为空时复制到所属用户的根目录下），返回文件副本
+    # 副本与原文件引用同一个存储对象，存储后端上不复制任何数据
+    def copy_to(self, parent: CloudDirectory = None, virtual_name: str = None) -> 'CloudFile':
+        if not self.uploaded:
+            raise ValidationError(_('文件尚未上传。'), code='file-not-uploaded')
+        with transaction.atomic():
+            self.ensure_blob()
+            copy = CloudFile(owner=parent.owner if parent else self.owner, parent=parent,
+                             virtual_name=virtual_name or self.virtual_name,
+                             size=self.size, md5=self.md5)
+            copy.full_clean()
+            blob, created = CloudBlob.acquire(self.md5, self.size, self.blob.path)
+            copy._link_blob(blob)
+            copy.save()
+        logger.debug('云文件：复制 {source} -> {target}'.format(source=self, target=copy))
+        return copy
+
+    def _link_blob(self, blob: 'CloudBlob'):
+        self.blob = blob
+        self._link_path(blob.path)
+
+    # 关联存储后端上的对象，但不关联存储对象（内容未经校验，不与其它文件共用）
+    def _link_path(self, path: str):
+        self.path = path
         self.name = self.path.split('/')[-1]
         logger.debug('云文件：保存文件 {file}'.format(file=self))
         self.uploaded = True
@@ -195,5 +627,371 @@ class CloudFile(CloudObject):
     @file.deleter
     def file(self):
         logger.debug('云文件：删除文件 {file}'.format(file=self))
-        self.storage.delete(self.path)
+        if self.blob_id:
+            self.blob.release()
+            self.blob = None
+        else:
+            self.storage.delete(self.path)
         self.uploaded = False
+
+
+# 在 root 子树中批量插入 objects 的副本，副本的父目录为 copies 中对应的目录副本，
+# 返回与 objects 一一对应的副本。批量插入绕过了 save()，树索引与路径在此计算
+def _bulk_copy(root: CloudDirectory, objects: list, copies: dict, owner: CloudUser,
+               fields=()) -> list:
+    if not objects:
+        return []
+    model = type(objects[0])
+    created = []
+    for obj in objects:
+        copy = model(owner=owner, parent=copies[obj.parent_id], name=obj.name,
+                     virtual_name=obj.virtual_name, path=obj.path,
+                     **{field: getattr(obj, field) for field in fields})
+        copy._update_paths()
+        created.append(copy)
+    model.objects.bulk_create(created)
+    # 部分数据库后端不会为批量插入的对象设置主键，按（父目录，名称）回查
+    if created[0].pk is None:
+        rows = model.objects.filter(tree_path__startswith=root.subtree_path,
+                                    depth__in={copy.depth for copy in created})
+        pks = {(parent, name): pk
+               for parent, name, pk in rows.values_list('parent', 'virtual_name', 'pk')}
+        for copy in created:
+            copy.pk = pks[copy.parent_id, copy.virtual_name]
+    return created
+
+
+# 通过级联或查询集删除文件时，同样释放其引用的存储对象
+@receiver(post_delete, sender=CloudFile)
+def release_cloud_file_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        CloudBlob.release_many({instance.blob_id: 1})
+
+
+class CloudObjectName(models.Model):
+    class Meta:
+        verbose_name = _('对象名称')
+        verbose_name_plural = _('对象名称')
+        constraints = (
+            models.UniqueConstraint(fields=('owner', 'parent', 'virtual_name'),
+                                    name='unique_cloud_object_name'),
+            # parent 为空时（位于根目录下）唯一约束不会生效，需单独建立部分索引
+            models.UniqueConstraint(fields=('owner', 'virtual_name'),
+                                    condition=models.Q(parent=None),
+                                    name='unique_cloud_root_object_name'),
+        )
+
+    owner = models.ForeignKey(to=CloudUser, on_delete=models.CASCADE, related_name='+')
+    parent = models.ForeignKey(to=CloudDirectory, on_delete=models.CASCADE, related_name='+',
+                               null=True, blank=True)
+    virtual_name = models.CharField(max_length=128)
+
+    # 二者有且仅有一个不为空
+    directory = models.OneToOneField(to=CloudDirectory, on_delete=models.CASCADE,
+                                     related_name='name_reservation', null=True, blank=True)
+    file = models.OneToOneField(to=CloudFile, on_delete=models.CASCADE,
+                                related_name='name_reservation', null=True, blank=True)
+
+    def __str__(self):
+        return self.virtual_name
+
+
+'''
+断点续传上传会话
+客户端先创建会话，然后以任意顺序、可重复地上传编号的分片（附带分片MD5），最后提交会话以合并文件。
+使用OSS时，会话直接对应一次OSS分片上传，分片在接收后立即上传至OSS，提交时通过对象的 ETag 校验合并结果，
+不再读取整个对象，因此整个文件的MD5未经校验，文件暂不关联存储对象；
+使用本地存储时，分片暂存在 UPLOAD_SESSION_PATH 下，提交时按顺序合并并校验整个文件的MD5。
+'''
+
+
+class CloudUploadSession(models.Model):
+    class Meta:
+        verbose_name = _('上传会话')
+        verbose_name_plural = _('上传会话')
+
+    file = models.ForeignKey(to=CloudFile, on_delete=models.CASCADE,
+                             related_name='upload_sessions')
+    part_size = models.PositiveIntegerField()
+    # 目标对象在存储后端上的路径
+    path = models.CharField(max_length=256, editable=False)
+    # OSS 分片上传ID
+    upload_id = models.CharField(max_length=64, blank=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{file} #{pk}'.format(file=self.file, pk=self.pk)
+
+    @property
+    def storage(self) -> Storage:
+        return self.file.storage
+
+    @property
+    def part_count(self):
+        return max(1, math.ceil(self.file.size / self.part_size))
+
+    @property
+    def parts_path(self):
+        return UPLOAD_SESSION_PATH + str(self.pk) + '/'
+
+    @property
+    def missing_parts(self):
+        received = set(self.parts.values_list('number', flat=True))
+        return [n for n in range(1, self.part_count + 1) if n not in received]
+
+    def part_length(self, number: int):
+        if number < self.part_count:
+            return self.part_size
+        return self.file.size - self.part_size * (self.part_count - 1)
+
+    @classmethod
+    def start(cls, cloud_file: CloudFile, part_size: int = None) -> 'CloudUploadSession':
+        size = cloud_file.size
+        min_part_size = max(UPLOAD_SESSION_MIN_PART_SIZE,
+                            math.ceil(size / UPLOAD_SESSION_MAX_PART_COUNT))
+        if part_size is None:
+            part_size = UPLOAD_SESSION_MAX_PART_SIZE
+        if not min_part_size <= part_size <= UPLOAD_SESSION_MAX_PART_SIZE:
+            raise ValidationError(_('分片大小必须在 %(min)d 至 %(max)d 字节之间。'),
+                                  code='part-size-invalid',
+                                  params={'min': min_part_size, 'max': UPLOAD_SESSION_MAX_PART_SIZE})
+        session = cls(file=cloud_file, part_size=part_size)
+        if settings.USE_OSS:
+            oss_storage = cloud_file.storage  # type:AliyunMediaStorage
+            session.path = oss_storage.get_available_name(cloud_file.path)
+            session.upload_id = oss_storage.init_multipart_upload(session.path)
+        else:
+            session.path = cloud_file.path
+        session.save()
+        logger.debug('上传会话：创建会话 {session}'.format(session=session))
+        return session
+
+    def upload_part(self, number: int, data: bytes, md5: str) -> 'CloudUploadPart':
+        if not 1 <= number <= self.part_count:
+            raise ValidationError(_('分片编号无效。'), code='part-number-invalid')
+        if len(data) != self.part_length(number):
+            raise ValidationError(_('分片大小校验失败。'), code='part-size-validation-failed')
+        if hashlib.md5(data).hexdigest() != md5:
+            raise ValidationError(_('分片md5校验失败。'), code='part-md5-validation-failed')
+
+        part = self.parts.filter(number=number).first() or CloudUploadPart(session=self,
+                                                                           number=number)
+        if settings.USE_OSS:
+            oss_storage = self.storage  # type:AliyunMediaStorage
+            part.etag = oss_storage.upload_part(self.path, self.upload_id, number, data, md5)
+        else:
+            # 重复上传的分片直接覆盖
+            if part.path:
+                self.storage.delete(part.path)
+            part.path = self.storage.save(self.parts_path + str(number), ContentFile(data))
+        part.size = len(data)
+        part.md5 = md5
+        part.save()
+        logger.debug('上传会话：接收分片 {session} #{number}'.format(session=self, number=number))
+        return part
+
+    def commit(self):
+        if self.missing_parts:
+            raise ValidationError(_('仍有分片尚未上传。'), code='parts-missing')
+        parts = list(self.parts.order_by('number'))
+        if settings.USE_OSS:
+            # 每个分片的MD5已在接收时校验，合并后的 ETag 由各分片的MD5决定，
+            # 与之一致即说明 OSS 合并的正是这些分片，无需读取整个对象
+            oss_storage = self.storage  # type:AliyunMediaStorage
+            etag = oss_storage.complete_multipart_upload(self.path, self.upload_id,
+                                                         [(p.number, p.etag) for p in parts])
+            path = self.path
+            if etag != multipart_etag(p.md5 for p in parts):
+                oss_storage.delete(path)
+                # 分片上传已经完成，会话无法继续使用
+                self.delete()
+                raise ValidationError(_('文件校验失败。'), code='file-validation-failed')
+        else:
+            hasher = hashlib.md5()
+            writer = open_storage_writer(self.storage, self.path, FILE_BUFFER_MAX_SIZE)
+            try:
+                for part in parts:
+                    with self.storage.open(part.path) as f:
+                        for chunk in f.chunks():
+                            hasher.update(chunk)
+                            writer.write(chunk)
+            except Exception:
+                writer.abort()
+                raise
+            path = writer.close()
+            if hasher.hexdigest() != self.file.md5:
+                self.storage.delete(path)
+                raise ValidationError(_('文件md5校验失败。'), code='file-md5-validation-failed')
+            self._delete_parts()
+
+        cloud_file = self.file
+        if cloud_file.uploaded:
+            del cloud_file.file
+        if settings.USE_OSS:
+            # 整个文件的MD5未经校验，待需要与其它文件共用时由 ensure_blob 校验后再关联存储对象
+            cloud_file._link_path(path)
+        else:
+            cloud_file.attach(path)
+        cloud_file.save()
+        self.delete()
+        logger.debug('上传会话：提交完成 {file}'.format(file=cloud_file))
+        return cloud_file
+
+    def abort(self):
+        if settings.USE_OSS:
+            oss_storage = self.storage  # type:AliyunMediaStorage
+            oss_storage.abort_multipart_upload(self.path, self.upload_id)
+        else:
+            self._delete_parts()
+        logger.debug('上传会话：取消会话 {session}'.format(session=self))
+        self.delete()
+
+    def _delete_parts(self):
+        delete_many(self.storage, self.parts.values_list('path', flat=True))
+        # 删除暂存分片的目录
+        try:
+            os.rmdir(self.storage.path(self.parts_path))
+        except OSError:
+            pass
+
+
+class CloudUploadPart(models.Model):
+    class Meta:
+        verbose_name = _('上传分片')
+        verbose_name_plural = _('上传分片')
+        unique_together = ('session', 'number')
+
+    session = models.ForeignKey(to=CloudUploadSession, on_delete=models.CASCADE,
+                                related_name='parts')
+    number = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    md5 = models.CharField(max_length=32)
+    # OSS 返回的分片ETag
+    etag = models.CharField(max_length=64, blank=True)
+    # 本地存储时分片的暂存路径
+    path = models.CharField(max_length=256, blank=True)
+
+    def __str__(self):
+        return '{session} #{number}'.format(session=self.session, number=self.number)
+
+
+'''
+内容寻址的存储对象
+以 (md5, size) 标识文件内容，内容相同的云文件共用同一个存储对象，并通过引用计数管理其生命周期，
+最后一个引用被释放时删除存储对象。
+注意：秒传只引用用户自己已有的存储对象，不同用户之间只有实际上传了相同内容时才会共用存储对象。
+'''
+
+
+class CloudBlob(models.Model):
+    class Meta:
+        verbose_name = _('存储对象')
+        verbose_name_plural = _('存储对象')
+        unique_together = ('md5', 'size')
+
+    md5 = models.CharField(max_length=32)
+    size = models.IntegerField()
+    path = models.CharField(max_length=256, unique=True)
+    reference_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{md5} ({path})'.format(md5=self.md5, path=self.path)
+
+    @classmethod
+    def acquire(cls, md5: str, size: int, path: str):
+        with transaction.atomic():
+            blob, created = cls.objects.select_for_update().get_or_create(
+                md5=md5, size=size, defaults={'path': path})
+            blob.reference_count += 1
+            blob.save(update_fields=('reference_count',))
+        logger.debug('存储对象：引用 {blob}，引用数 {count}'.format(blob=blob,
+                                                           count=blob.reference_count))
+        return blob, created
+
+    # 批量增加存储对象的引用数，counts 为 {pk: 增加的引用数}
+    @classmethod
+    def acquire_many(cls, counts: dict):
+        if not counts:
+            return
+        with transaction.atomic():
+            blobs = list(cls.objects.select_for_update().filter(pk__in=counts.keys()))
+            for blob in blobs:
+                blob.reference_count += counts[blob.pk]
+            cls.objects.bulk_update(blobs, ('reference_count',))
+
+    def release(self):
+        self.reference_count = CloudBlob.release_many({self.pk: 1}).get(self.pk, 0)
+        logger.debug('存储对象：释放 {blob}，引用数 {count}'.format(blob=self,
+                                                           count=self.reference_count))
+
+    # 批量释放存储对象，counts 为 {pk: 释放的引用数}，返回 {pk: 剩余引用数}
+    # 引用数归零的存储对象被删除，其在存储后端上的文件通过一次批量删除移除
+    @classmethod
+    def release_many(cls, counts: dict) -> dict:
+        if not counts:
+            return {}
+        with transaction.atomic():
+            blobs = list(cls.objects.select_for_update().filter(pk__in=counts.keys()))
+            released, kept = [], []
+            for blob in blobs:
+                blob.reference_count = max(blob.reference_count - counts[blob.pk], 0)
+                (kept if blob.reference_count else released).append(blob)
+            cls.objects.bulk_update(kept, ('reference_count',))
+            cls.objects.filter(pk__in=[blob.pk for blob in released]).delete()
+            paths = [blob.path for blob in released]
+            if paths:
+                logger.debug('存储对象：删除 {paths}'.format(paths=paths))
+                # 事务提交后再删除存储对象，以免事务回滚后对象丢失
+                transaction.on_commit(lambda: delete_many(default_storage, paths))
+        return {blob.pk: blob.reference_count for blob in blobs}
+
+
+'''
+存储名称预留
+分配存储名称时插入一条记录，由唯一约束保证同一名称只分配一次；在对象写入并被 CloudBlob 等记录引用之前
+（例如等待浏览器直传OSS完成），名称也不会被再次分配。
+预留超过 STORAGE_NAME_RESERVATION_EXPIRE 后不再需要，由 cloud_reconcile 命令清除。
+'''
+
+
+class CloudStorageName(models.Model):
+    class Meta:
+        verbose_name = _('存储名称')
+        verbose_name_plural = _('存储名称')
+
+    path = models.CharField(max_length=256, unique=True)
+    reserved = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.path
+
+    @classmethod
+    def purge_expired(cls) -> int:
+        expired = timezone.now() - datetime.timedelta(seconds=STORAGE_NAME_RESERVATION_EXPIRE)
+        count, _rows = cls.objects.filter(reserved__lt=expired).delete()
+        return count
+
+
+# 用户文件目录下的存储对象均由数据库记录（已上传的文件引用一个 CloudBlob，早先上传、尚未关联 CloudBlob 的文件
+# 记录在其 path 中，断点续传会话记录其目标路径，分配出去的名称记录在 CloudStorageName 中），
+# 分配存储名称时查询数据库即可判断名称是否已被占用
+def taken_storage_names(names) -> set:
+    names = list(names)
+    taken = set(CloudBlob.objects.filter(path__in=names).values_list('path', flat=True))
+    taken.update(CloudFile.objects.filter(path__in=names, uploaded=True).values_list('path', flat=True))
+    taken.update(CloudUploadSession.objects.filter(path__in=names).values_list('path', flat=True))
+    taken.update(CloudStorageName.objects.filter(path__in=names).values_list('path', flat=True))
+    return taken
+
+
+def reserve_storage_name(name) -> bool:
+    try:
+        with transaction.atomic():
+            CloudStorageName.objects.create(path=name)
+    except IntegrityError:
+        logger.debug('存储名称：{name} 已被预留'.format(name=name))
+        return False
+    return True
+
+
+register_name_index(USER_UPLOAD_PATH, taken_storage_names, reserve_storage_name)
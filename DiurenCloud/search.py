@@ -0,0 +1,121 @@
+'''
+名称搜索
+SQLite 上为 virtual_name 建立 FTS5 trigram 外部内容索引表，由触发器在插入、重命名、删除时维护；
+PostgreSQL 上建立 pg_trgm GIN 索引，icontains/istartswith 查询可直接使用；
+其它数据库不建立索引，退化为普通的 LIKE 查询。
+索引由迁移 0012 建立，此处的建表语句须与其保持一致。
+SQLite 修改表结构时会重建数据表，触发器随之丢失，因此每次迁移后都会检查并补建。
+'''
+
+from django.db import connections
+from django.db.models import QuerySet
+
+from DiurenCloud.apps import logger
+from DiurenCloud.models import CloudDirectory, CloudFile
+
+SEARCH_MODES = ('substring', 'prefix')
+# trigram 索引只能用于长度不小于 3 的关键词，更短的关键词直接使用 LIKE 查询
+TRIGRAM_MIN_LENGTH = 3
+# SQLite 自 3.34.0 起支持 trigram 分词器
+SQLITE_TRIGRAM_MIN_VERSION = (3, 34, 0)
+
+SEARCH_MODELS = (CloudDirectory, CloudFile)
+
+# 各数据库连接上 FTS5 索引是否可用
+_fts_available = {}
+
+
+def search_table(model) -> str:
+    return model._meta.db_table + '_search'
+
+
+def sqlite_index_sql(table: str, search: str) -> dict:
+    return {
+        search: 'CREATE VIRTUAL TABLE IF NOT EXISTS "{search}" USING fts5('
+                'virtual_name, content="{table}", content_rowid="id", tokenize="trigram")',
+        search + '_ai': 'CREATE TRIGGER IF NOT EXISTS "{search}_ai" AFTER INSERT ON "{table}" '
+                        'BEGIN INSERT INTO "{search}"(rowid, virtual_name) '
+                        'VALUES (new.id, new.virtual_name); END',
+        search + '_ad': 'CREATE TRIGGER IF NOT EXISTS "{search}_ad" AFTER DELETE ON "{table}" '
+                        'BEGIN INSERT INTO "{search}"("{search}", rowid, virtual_name) '
+                        'VALUES (\'delete\', old.id, old.virtual_name); END',
+        search + '_au': 'CREATE TRIGGER IF NOT EXISTS "{search}_au" '
+                        'AFTER UPDATE OF virtual_name ON "{table}" '
+                        'BEGIN INSERT INTO "{search}"("{search}", rowid, virtual_name) '
+                        'VALUES (\'delete\', old.id, old.virtual_name); '
+                        'INSERT INTO "{search}"(rowid, virtual_name) '
+                        'VALUES (new.id, new.virtual_name); END',
+    }
+
+
+def install_search_index(connection):
+    _fts_available.pop(connection.alias, None)
+    with connection.cursor() as cursor:
+        for model in SEARCH_MODELS:
+            table, search = model._meta.db_table, search_table(model)
+            if connection.vendor == 'sqlite':
+                if connection.Database.sqlite_version_info < SQLITE_TRIGRAM_MIN_VERSION:
+                    return
+                statements = sqlite_index_sql(table, search)
+                cursor.execute('SELECT name FROM sqlite_master WHERE name IN (%s)' % ', '.join(
+                    ['%s'] * len(statements)), list(statements))
+                missing = set(statements) - {name for name, in cursor.fetchall()}
+                if not missing:
+                    continue
+                for name in missing:
+                    cursor.execute(statements[name].format(table=table, search=search))
+                # 新建的索引或触发器缺失期间的修改均需重新索引
+                logger.info('名称搜索：重建索引 {search}'.format(search=search))
+                cursor.execute('INSERT INTO "{search}"("{search}") VALUES (\'rebuild\')'.format(
+                    search=search))
+            elif connection.vendor == 'postgresql':
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                # 与 icontains/istartswith 生成的 UPPER("virtual_name"::text) LIKE UPPER(%s) 一致
+                cursor.execute('CREATE INDEX IF NOT EXISTS "{search}_trgm_idx" ON "{table}" '
+                               'USING gin (UPPER("virtual_name"::text) gin_trgm_ops)'.format(
+                                   table=table, search=search))
+
+
+# 迁移后补建 SQLite 上因重建数据表而丢失的触发器（索引表本身不会被删除，仅在其存在时补建）
+def install_search_index_after_migrate(sender, using, **kwargs):
+    connection = connections[using]
+    if connection.vendor == 'sqlite' and search_table(
+            CloudFile) in connection.introspection.table_names():
+        install_search_index(connection)
+
+
+def fts_available(connection) -> bool:
+    if connection.alias not in _fts_available:
+        _fts_available[connection.alias] = connection.vendor == 'sqlite' and search_table(
+            CloudFile) in connection.introspection.table_names()
+    return _fts_available[connection.alias]
+
+
+'''
+在用户的文件或目录中按名称搜索，不包括回收站中的对象
+mode 为 substring 时名称包含 query，为 prefix 时名称以 query 开头；ext 为文件扩展名（不含‘.’）；
+within 不为空时只搜索该目录的子树。均不区分大小写。
+'''
+
+
+def search_objects(model, owner, query: str = '', mode: str = 'substring', ext: str = '',
+                   within: CloudDirectory = None) -> QuerySet:
+    queryset = model.objects.filter(trashed_at=None)
+    if within is not None:
+        queryset = queryset.filter(tree_path__startswith=within.subtree_path)
+    if query:
+        lookup = 'virtual_name__istartswith' if mode == 'prefix' else 'virtual_name__icontains'
+        queryset = queryset.filter(**{lookup: query})
+    if ext:
+        queryset = queryset.filter(virtual_name__iendswith='.' + ext)
+    # SQLite 上先通过 trigram 索引筛选出候选对象，再由上面的条件精确匹配
+    terms = [term for term in (query, '.' + ext if ext else '') if len(term) >= TRIGRAM_MIN_LENGTH]
+    if not (terms and fts_available(connections[queryset.db])):
+        return queryset.filter(owner=owner)
+    # 所属用户条件写作 +owner_id，使 SQLite 不使用 owner 索引扫描该用户的所有对象，而是由候选对象的主键查找；
+    # 不能使用 pk__in=RawSQL(...)，其生成的 IN ((SELECT ...)) 在 SQLite 上被视为标量子查询，只返回第一行
+    match = ' AND '.join('"{term}"'.format(term=term.replace('"', '""')) for term in terms)
+    where = '+"{table}"."owner_id" = %s AND "{table}"."id" IN ' \
+            '(SELECT rowid FROM "{search}" WHERE "{search}" MATCH %s)'.format(
+                table=model._meta.db_table, search=search_table(model))
+    return queryset.extra(where=[where], params=[owner.pk, match])
@@ -1,3 +1,998 @@
-from django.test import TestCase
+import ast
+import base64
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+from importlib import import_module
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.wsgi import LimitedStream
+from django.core.management import call_command
+from django.db import connection
+from django.http import UnreadablePostError
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
+from django.urls import reverse
+from django.utils import timezone
+
+from DiurenCloud.search import SQLITE_TRIGRAM_MIN_VERSION, fts_available, search_objects, \
+    sqlite_index_sql
+from DiurenCloud.views import CloudLocalFileUploadAPI
+from DiurenUtility.aliyun_oss.fake import FakeBucket
+from DiurenUtility.aliyun_oss import storage as oss_storage
+from DiurenUtility.aliyun_oss.storage import AliyunMediaStorage
+from DiurenCloud.apps import USER_UPLOAD_PATH, CLOUD_TREE_MAX_DEPTH
+from DiurenCloud.models import CloudUser, CloudDirectory, CloudFile, CloudBlob, CloudObjectName, \
+    CloudStorageName, CloudUploadSession, ROLLUP_FIELDS
+
+
+class CloudTreeTestCase(TestCase):
+    '''
+    构造目录树：
+    a/
+      a.txt
+      b/
+        b.txt
+        c/
+          c.txt
+          pending.txt（尚未上传）
+      d/
+        d.txt
+    文件直接引用存储对象，不经过存储后端
+    '''
+
+    def setUp(self):
+        self.owner = CloudUser.objects.create(user=User.objects.create(username='tester'))
+        self.a = self.make_directory('a')
+        self.b = self.make_directory('b', self.a)
+        self.c = self.make_directory('c', self.b)
+        self.d = self.make_directory('d', self.a)
+        self.a_txt = self.make_file('a.txt', self.a, 1)
+        self.b_txt = self.make_file('b.txt', self.b, 10)
+        self.c_txt = self.make_file('c.txt', self.c, 100)
+        self.d_txt = self.make_file('d.txt', self.d, 10)
+        self.pending = self.make_file('pending.txt', self.c, 1000, uploaded=False)
+
+    def make_directory(self, name, parent=None) -> CloudDirectory:
+        directory = CloudDirectory(owner=self.owner, parent=parent, virtual_name=name)
+        directory.full_clean()
+        directory.save()
+        return directory
+
+    def make_file(self, name, parent, size, uploaded=True) -> CloudFile:
+        md5 = '%032x' % size
+        cloud_file = CloudFile(owner=self.owner, parent=parent, virtual_name=name, md5=md5,
+                               size=size)
+        cloud_file.full_clean()
+        if uploaded:
+            blob, created = CloudBlob.acquire(md5, size, 'cloud/user/tester/%s' % name)
+            cloud_file._link_blob(blob)
+        cloud_file.save()
+        return cloud_file
+
+    @staticmethod
+    def rollups(obj) -> tuple:
+        obj.refresh_from_db(fields=ROLLUP_FIELDS)
+        return tuple(getattr(obj, field) for field in ROLLUP_FIELDS)
+
+    # 按定义重新统计，与增量维护的统计信息比较；回收站中的对象不计入
+    def assertRollupsConsistent(self):
+        for directory in CloudDirectory.objects.filter(trashed_at=None):
+            files = directory.descendant_files.filter(trashed_at=None)
+            directories = directory.descendant_directories.filter(trashed_at=None)
+            expected = (sum(files.values_list('size', flat=True)), files.count(),
+                        directories.count())
+            self.assertEqual(self.rollups(directory), expected, directory)
+        files = CloudFile.objects.filter(owner=self.owner, trashed_at=None)
+        directories = CloudDirectory.objects.filter(owner=self.owner, trashed_at=None)
+        expected = (sum(files.values_list('size', flat=True)), files.count(), directories.count())
+        self.assertEqual(self.rollups(self.owner), expected)
+
+    def assertReferenceCountsConsistent(self):
+        for blob in CloudBlob.objects.all():
+            self.assertEqual(blob.reference_count, blob.files.count(), blob)
+
+    # 路径字段与按父目录逐级计算的结果一致
+    def assertPathsConsistent(self):
+        for model in (CloudDirectory, CloudFile):
+            for obj in model.objects.select_related('parent', 'owner__user'):
+                self.assertEqual(obj.tree_path, obj._tree_path, obj)
+                self.assertEqual(obj.depth, obj.tree_path.count('/'), obj)
+                self.assertEqual(obj.virtual_path, obj._virtual_path, obj)
+
+
+class CloudTrashTest(CloudTreeTestCase):
+    def test_trash_excludes_subtree_from_rollups(self):
+        self.b.trash()
+        self.assertRollupsConsistent()
+        self.assertEqual(self.rollups(self.a), (11, 2, 1))
+        # 回收站中的目录保留其内容的统计信息，恢复时整体计入
+        self.assertEqual(self.rollups(self.b), (1110, 3, 1))
+        self.assertFalse(CloudObjectName.objects.filter(directory=self.b).exists())
+
+    def test_delete_trashed_file(self):
+        self.c_txt.trash()
+        self.assertRollupsConsistent()
+        CloudFile.objects.get(pk=self.c_txt.pk).delete()
+        self.assertRollupsConsistent()
+        self.assertReferenceCountsConsistent()
+
+    def test_delete_trashed_directory(self):
+        self.b.trash()
+        CloudDirectory.objects.get(pk=self.b.pk).delete()
+        self.assertRollupsConsistent()
+        self.assertReferenceCountsConsistent()
+        self.assertFalse(CloudFile.objects.filter(pk=self.c_txt.pk).exists())
+
+    # 删除随目录一并移入回收站的对象，只从同时移入回收站的祖先目录中扣除
+    def test_delete_inside_trashed_directory(self):
+        self.b.trash()
+        before = self.rollups(self.a), self.rollups(self.owner)
+        CloudFile.objects.get(pk=self.c_txt.pk).delete()
+        CloudDirectory.objects.get(pk=self.c.pk).delete()
+        self.assertEqual((self.rollups(self.a), self.rollups(self.owner)), before)
+        self.assertEqual(self.rollups(self.b), (10, 1, 0))
+        CloudDirectory.objects.get(pk=self.b.pk).restore()
+        self.assertRollupsConsistent()
+
+    def test_restore_only_objects_trashed_together(self):
+        self.c_txt.trash()
+        self.b.trash()
+        self.b.restore()
+        self.assertRollupsConsistent()
+        self.assertIsNotNone(CloudFile.objects.get(pk=self.c_txt.pk).trashed_at)
+        self.assertIsNone(CloudFile.objects.get(pk=self.b_txt.pk).trashed_at)
+        self.assertTrue(CloudObjectName.objects.filter(directory=self.b).exists())
+
+    def test_restore_name_taken(self):
+        self.b.trash()
+        self.make_directory('b', self.a)
+        with self.assertRaises(ValidationError) as context:
+            self.b.restore()
+        self.assertEqual(context.exception.code, 'object-name-duplicated')
+        self.assertIsNotNone(CloudDirectory.objects.get(pk=self.b.pk).trashed_at)
+        self.assertRollupsConsistent()
+
+    def test_restore_parent_trashed(self):
+        self.c_txt.trash()
+        self.c.trash()
+        with self.assertRaises(ValidationError) as context:
+            self.c_txt.restore()
+        self.assertEqual(context.exception.code, 'parent-trashed')
+
+    def test_purge(self):
+        self.d_txt.trash()
+        self.b.trash()
+        # 未超过保留期的对象不会被清除
+        call_command('cloud_purge_trash', days=1, stdout=StringIO())
+        self.assertTrue(CloudDirectory.objects.filter(pk=self.b.pk).exists())
+
+        CloudDirectory.objects.filter(trashed_at__isnull=False).update(
+            trashed_at=timezone.now() - datetime.timedelta(days=2))
+        CloudFile.objects.filter(trashed_at__isnull=False).update(
+            trashed_at=timezone.now() - datetime.timedelta(days=2))
+        call_command('cloud_purge_trash', days=1, batch_size=1, stdout=StringIO())
+        self.assertEqual(set(CloudDirectory.objects.values_list('virtual_name', flat=True)),
+                         {'a', 'd'})
+        self.assertEqual(set(CloudFile.objects.values_list('virtual_name', flat=True)),
+                         {'a.txt'})
+        self.assertRollupsConsistent()
+        self.assertReferenceCountsConsistent()
+        self.assertEqual(CloudBlob.objects.count(), 1)
+
+
+class CloudRollupTest(CloudTreeTestCase):
+    def test_initial_rollups(self):
+        self.assertRollupsConsistent()
+        self.assertEqual(self.rollups(self.a), (1121, 5, 3))
+        self.assertEqual(self.rollups(self.c), (1100, 2, 0))
+
+    # 尚未上传的文件大小改变时，只更新差值
+    def test_file_size_changed(self):
+        self.pending.size = 2000
+        self.pending.save()
+        self.assertRollupsConsistent()
+        self.assertEqual(self.rollups(self.b), (2110, 3, 1))
+
+    def test_delete_file(self):
+        CloudFile.objects.get(pk=self.b_txt.pk).delete()
+        self.assertRollupsConsistent()
+        self.assertEqual(self.rollups(self.b), (1100, 2, 1))
+
+
+class CloudMoveTest(CloudTreeTestCase):
+    def test_move_directory(self):
+        c_txt_path = self.c_txt.path
+        self.b.parent = self.d
+        self.b.full_clean()
+        self.b.save()
+        self.assertPathsConsistent()
+        self.assertRollupsConsistent()
+        c_txt = CloudFile.objects.get(pk=self.c_txt.pk)
+        self.assertEqual(c_txt.virtual_path, 'tester/a/d/b/c/c.txt')
+        self.assertEqual(c_txt.depth, 4)
+        # 已上传文件的存储路径不随目录移动而改变，尚未上传的文件随之改变
+        self.assertEqual(c_txt.path, c_txt_path)
+        self.assertEqual(CloudFile.objects.get(pk=self.pending.pk).path,
+                         'cloud/user/tester/a/d/b/c/pending.txt')
+
+    def test_move_directory_to_root(self):
+        self.c.parent = None
+        self.c.save()
+        self.assertPathsConsistent()
+        self.assertRollupsConsistent()
+        self.assertEqual(CloudFile.objects.get(pk=self.c_txt.pk).tree_path, '%d/' % self.c.pk)
+
+    def test_rename_directory(self):
+        self.a.virtual_name = 'renamed'
+        self.a.full_clean()
+        self.a.save()
+        self.assertPathsConsistent()
+        self.assertEqual(CloudDirectory.objects.get(pk=self.c.pk).virtual_path,
+                         'tester/renamed/b/c/')
+
+    def test_move_into_own_subtree(self):
+        self.a.parent = self.c
+        with self.assertRaises(ValidationError):
+            self.a.full_clean()
+
+
+class CloudDepthTest(CloudTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        # 最深一级目录的深度为 CLOUD_TREE_MAX_DEPTH，其中不能再放置任何对象
+        self.deepest = None
+        for i in range(CLOUD_TREE_MAX_DEPTH + 1):
+            self.deepest = self.make_directory('level%d' % i, self.deepest)
+
+    def assertTooDeep(self, context):
+        self.assertEqual([e.code for e in context.exception.error_dict['__all__']],
+                         ['tree-too-deep'])
+
+    def test_max_depth(self):
+        self.assertEqual(self.deepest.depth, CLOUD_TREE_MAX_DEPTH)
+        self.assertLessEqual(len(self.deepest.subtree_path), 255)
+        with self.assertRaises(ValidationError) as context:
+            self.make_directory('too-deep', self.deepest)
+        self.assertTooDeep(context)
+        with self.assertRaises(ValidationError) as context:
+            self.make_file('too-deep.txt', self.deepest, 1)
+        self.assertTooDeep(context)
+
+    # 移动目录时，整棵子树都不能超过最大深度
+    def test_move_too_deep(self):
+        self.b.parent = self.deepest.parent.parent
+        with self.assertRaises(ValidationError) as context:
+            self.b.full_clean()
+        self.assertTooDeep(context)
+        self.d.parent = self.deepest.parent.parent
+        self.d.full_clean()
+
+    def test_copy_too_deep(self):
+        with self.assertRaises(ValidationError) as context:
+            self.b.copy_to(self.deepest.parent.parent)
+        self.assertEqual(context.exception.code, 'tree-too-deep')
+        self.d.copy_to(self.deepest.parent.parent)
+        self.assertPathsConsistent()
+
+
+class CloudCopyTest(CloudTreeTestCase):
+    def test_copy_directory(self):
+        self.d_txt.trash()
+        target = self.make_directory('target')
+        copy = self.a.copy_to(target)
+        self.assertRollupsConsistent()
+        self.assertReferenceCountsConsistent()
+        self.assertPathsConsistent()
+        # 回收站中的对象与尚未上传的文件不会被复制
+        self.assertEqual(self.rollups(copy), (111, 3, 3))
+        self.assertEqual(self.rollups(target), (111, 3, 4))
+        self.assertEqual(CloudBlob.objects.get(pk=self.c_txt.blob_id).reference_count, 2)
+        self.assertEqual(CloudObjectName.objects.filter(parent=copy).count(), 3)
+
+    def test_copy_directory_name_taken(self):
+        with self.assertRaises(ValidationError):
+            self.b.copy_to(self.a)
+        copy = self.b.copy_to(self.a, 'b2')
+        self.assertEqual(copy.virtual_path, 'tester/a/b2/')
+        self.assertRollupsConsistent()
+
+    def test_copy_directory_into_own_subtree(self):
+        with self.assertRaises(ValidationError):
+            self.a.copy_to(self.c)
+
+    def test_copy_file(self):
+        copy = self.c_txt.copy_to(None, 'copy.txt')
+        self.assertEqual(copy.path, self.c_txt.path)
+        self.assertRollupsConsistent()
+        self.assertReferenceCountsConsistent()
+        with self.assertRaises(ValidationError) as context:
+            self.pending.copy_to(None)
+        self.assertEqual(context.exception.code, 'file-not-uploaded')
+
+
+class CloudUserRequiredTest(TestCase):
+    def test_user_without_cloud_user(self):
+        User.objects.create_user(username='visitor', password='password')
+        self.client.login(username='visitor', password='password')
+        for name in ('api-list-root', 'api-trash-list', 'api-search-root'):
+            url = reverse('DiurenCloud:' + name)
+            response = self.client.get(url, {'q': 'name'})
+            self.assertEqual(response.status_code, 403, url)
+            self.assertEqual(response.json()['code'], 'cloud-user-required', url)
+
+
+class CloudStorageTestCase(TestCase):
+    '''
+    文件写入临时的 MEDIA_ROOT，测试结束后删除
+    已登录用户 uploader 拥有一个尚未上传的文件 data.bin
+    '''
+    data = b'0123456789' * 1000
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='uploader', password='password')
+        self.owner = CloudUser.objects.create(user=self.user)
+        self.client.login(username='uploader', password='password')
+        self.cloud_file = self.make_pending_file('data.bin', self.data)
+
+    def make_pending_file(self, name, data, owner=None) -> CloudFile:
+        cloud_file = CloudFile(owner=owner or self.owner, virtual_name=name,
+                               md5=hashlib.md5(data).hexdigest(), size=len(data))
+        cloud_file.full_clean()
+        cloud_file.save()
+        return cloud_file
+
+    def make_stored_file(self, name, parent, data) -> CloudFile:
+        cloud_file = self.make_pending_file(name, data)
+        cloud_file.parent = parent
+        cloud_file.attach(cloud_file.storage.save(cloud_file.path, ContentFile(data)))
+        cloud_file.save()
+        return cloud_file
+
+    def stored_files(self):
+        return [os.path.relpath(os.path.join(root, name), self.media_root)
+                for root, dirs, files in os.walk(self.media_root) for name in files]
+
+
+class CloudLocalUploadTest(CloudStorageTestCase):
+    def upload(self, client=None, name='data.bin', data=None, **extra):
+        url = reverse('DiurenCloud:api-upload', args=(self.cloud_file.pk,))
+        upload = SimpleUploadedFile(name, self.data if data is None else data)
+        return (client or self.client).post(url, {'file': upload}, **extra)
+
+    def test_upload(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 204)
+        cloud_file = CloudFile.objects.get(pk=self.cloud_file.pk)
+        self.assertTrue(cloud_file.uploaded)
+        self.assertEqual(cloud_file.blob.reference_count, 1)
+        with cloud_file.storage.open(cloud_file.path) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_md5_mismatch(self):
+        response = self.upload(data=self.data[::-1])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['code'], 'file-md5-validation-failed')
+        self.assertFalse(CloudFile.objects.get(pk=self.cloud_file.pk).uploaded)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_name_mismatch(self):
+        response = self.upload(name='other.bin')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['code'], 'file-name-validation-failed')
+        self.assertEqual(self.stored_files(), [])
+
+    def test_other_user(self):
+        User.objects.create_user(username='visitor', password='password')
+        CloudUser.objects.create(user=User.objects.get(username='visitor'))
+        client = Client()
+        client.login(username='visitor', password='password')
+        response = self.upload(client)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(CloudFile.objects.get(pk=self.cloud_file.pk).uploaded)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        client.login(username='uploader', password='password')
+        response = self.upload(client)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(CloudFile.objects.get(pk=self.cloud_file.pk).uploaded)
+        self.assertEqual(self.stored_files(), [])
+
+        token = 'a' * 64
+        client.cookies['csrftoken'] = token
+        response = self.upload(client, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 204)
+
+    # 客户端中途断开连接时不留下写入了一半的文件
+    def test_interrupted(self):
+        class BrokenStream(BytesIO):
+            def read(self, size=-1):
+                if self.tell() > len(body) // 2:
+                    raise UnreadablePostError('connection lost')
+                return super().read(1024)
+
+        body = encode_multipart(BOUNDARY, {'file': SimpleUploadedFile('data.bin', self.data)})
+        request = RequestFactory().post('/', data={})
+        request.META['CONTENT_TYPE'] = MULTIPART_CONTENT
+        request.META['CONTENT_LENGTH'] = str(len(body))
+        request._stream = LimitedStream(BrokenStream(body), len(body))
+        request.user = self.user
+        request._dont_enforce_csrf_checks = True
+        with self.assertRaises(UnreadablePostError):
+            CloudLocalFileUploadAPI.as_view()(request, pk=self.cloud_file.pk)
+        self.assertEqual(self.stored_files(), [])
+
+
+class CloudInstantUploadTest(CloudStorageTestCase):
+    def link_existing(self, owner, name):
+        cloud_file = self.make_pending_file(name, self.data, owner)
+        blob, created = CloudBlob.acquire(cloud_file.md5, cloud_file.size, 'cloud/blob/' + name)
+        cloud_file._link_blob(blob)
+        cloud_file.save()
+        return cloud_file
+
+    def request_upload(self):
+        url = reverse('DiurenCloud:api-upload-request', args=(self.cloud_file.pk,))
+        return self.client.get(url)
+
+    def test_instant_upload(self):
+        existing = self.link_existing(self.owner, 'existing.bin')
+        response = self.request_upload()
+        self.assertEqual(response.json()['code'], 'file-instant-uploaded')
+        cloud_file = CloudFile.objects.get(pk=self.cloud_file.pk)
+        self.assertTrue(cloud_file.uploaded)
+        self.assertEqual(cloud_file.blob_id, existing.blob_id)
+        self.assertEqual(cloud_file.blob.reference_count, 2)
+
+    # 只知道 md5 与大小的用户不能获得其他用户的文件
+    def test_other_users_blob(self):
+        other = CloudUser.objects.create(user=User.objects.create(username='other'))
+        existing = self.link_existing(other, 'secret.bin')
+        response = self.request_upload()
+        self.assertEqual(response.json()['code'], 'upload-link-generated')
+        self.assertFalse(CloudFile.objects.get(pk=self.cloud_file.pk).uploaded)
+        self.assertEqual(CloudBlob.objects.get(pk=existing.blob_id).reference_count, 1)
+
+
+class CloudOSSTestCase(CloudStorageTestCase):
+    '''
+    文件保存在模拟的 OSS Bucket 中
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.storage = AliyunMediaStorage()
+        self.storage.bucket = FakeBucket()
+        storage_patch = mock.patch('DiurenCloud.models.default_storage', self.storage)
+        storage_patch.start()
+        self.addCleanup(storage_patch.stop)
+        settings_override = override_settings(USE_OSS=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # 文件在创建时取得存储后端
+        self.cloud_file = CloudFile.objects.get(pk=self.cloud_file.pk)
+
+
+class CloudOSSCallbackTest(CloudOSSTestCase):
+    def callback(self, name, data=None):
+        data = self.data if data is None else data
+        params = {
+            'object': self.storage.get_object_key(name),
+            'size': len(data),
+            'md5': base64.b64encode(hashlib.md5(data).digest()).decode(),
+            'file': self.cloud_file.pk,
+        }
+        with mock.patch('DiurenCloud.views.verify_callback', return_value=True):
+            return self.client.post(reverse('DiurenCloud:api-oss-callback'), params)
+
+    def test_callback(self):
+        name = self.storage.save(self.cloud_file.path, ContentFile(self.data))
+        response = self.callback(name)
+        self.assertEqual(response.json()['code'], 'file-uploaded')
+        cloud_file = CloudFile.objects.get(pk=self.cloud_file.pk)
+        self.assertTrue(cloud_file.uploaded)
+        self.assertEqual(cloud_file.path, name)
+
+    # OSS 可能重复发送回调，重复的回调不会增加引用数
+    def test_repeated_callback(self):
+        name = self.storage.save(self.cloud_file.path, ContentFile(self.data))
+        for i in range(2):
+            response = self.callback(name)
+            self.assertEqual(response.status_code, 200)
+        cloud_file = CloudFile.objects.get(pk=self.cloud_file.pk)
+        self.assertEqual(cloud_file.blob.reference_count, 1)
+        cloud_file.trash()
+        CloudFile.objects.get(pk=cloud_file.pk).delete()
+        self.assertFalse(CloudBlob.objects.exists())
+
+    def test_md5_mismatch(self):
+        name = self.storage.save(self.cloud_file.path, ContentFile(self.data[::-1]))
+        response = self.callback(name, self.data[::-1])
+        self.assertEqual(response.json()['code'], 'file-md5-validation-failed')
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(CloudFile.objects.get(pk=self.cloud_file.pk).uploaded)
+
+
+class CloudStorageNameTest(CloudOSSTestCase):
+    def test_name_reserved(self):
+        path = self.cloud_file.path
+        name = self.storage.get_available_name(path)
+        self.assertEqual(name, path)
+        # 对象尚未写入时，名称也不会被再次分配
+        self.assertNotEqual(self.storage.get_available_name(path), name)
+        self.assertEqual(CloudStorageName.objects.count(), 2)
+
+    # 查询索引之后、预留之前名称被其它进程取得
+    def test_reserved_concurrently(self):
+        path = self.cloud_file.path
+        CloudStorageName.objects.create(path=path)
+        index = oss_storage.get_name_index(path)
+        stale_index = index._replace(taken_names=lambda names: set())
+        with mock.patch.dict(oss_storage._name_indexes, {USER_UPLOAD_PATH: stale_index}):
+            name = self.storage.get_available_name(path)
+        self.assertNotEqual(name, path)
+        self.assertTrue(CloudStorageName.objects.filter(path=name).exists())
+
+    def test_purge_expired(self):
+        self.storage.get_available_name(self.cloud_file.path)
+        self.assertEqual(CloudStorageName.purge_expired(), 0)
+        CloudStorageName.objects.update(reserved=timezone.now() - datetime.timedelta(days=2))
+        call_command('cloud_reconcile', stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(CloudStorageName.objects.exists())
+
+
+class CloudDownloadTest(CloudStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cloud_file.file = ContentFile(self.data)
+        self.cloud_file.save()
+        self.url = reverse('DiurenCloud:download', args=(self.cloud_file.pk,))
+
+    def download(self, **headers):
+        response = self.client.get(self.url, **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_download(self):
+        response, content = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        response, content = self.download(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.data[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/%d' % len(self.data))
+        response, content = self.download(HTTP_RANGE='bytes=-5')
+        self.assertEqual(content, self.data[-5:])
+
+    def test_unsatisfiable_range(self):
+        for header in ('bytes=%d-' % len(self.data), 'bytes=-0'):
+            response, content = self.download(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416, header)
+            self.assertEqual(response['Content-Range'], 'bytes */%d' % len(self.data))
+
+    # If-Range 与当前 ETag 不一致时发送完整内容
+    def test_if_range(self):
+        response, content = self.download(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.data)
+
+    def test_not_modified(self):
+        response, content = self.download()
+        response, content = self.download(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_other_user(self):
+        User.objects.create_user(username='visitor', password='password')
+        self.client.login(username='visitor', password='password')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class CloudUploadSessionTestMixin:
+    # 3 个分片，最后一个分片较小
+    part_size = 100 * 1024
+    data = os.urandom(250 * 1024)
+
+    def upload_parts(self, session, numbers=(3, 1, 2)):
+        for number in numbers:
+            start = (number - 1) * self.part_size
+            part = self.data[start:start + self.part_size]
+            session.upload_part(number, part, hashlib.md5(part).hexdigest())
+
+    def read(self, cloud_file):
+        with cloud_file.storage.open(cloud_file.path) as f:
+            return f.read()
+
+
+class CloudUploadSessionTest(CloudUploadSessionTestMixin, CloudStorageTestCase):
+    def test_commit(self):
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        self.upload_parts(session, (3, 1))
+        with self.assertRaises(ValidationError) as context:
+            session.commit()
+        self.assertEqual(context.exception.code, 'parts-missing')
+        self.upload_parts(session, (2, 2))
+        parts_path = session.parts_path
+        cloud_file = session.commit()
+        self.assertEqual(self.read(cloud_file), self.data)
+        self.assertEqual(cloud_file.blob.md5, cloud_file.md5)
+        # 分片与暂存目录均已删除
+        self.assertEqual(self.stored_files(), [cloud_file.path])
+        self.assertFalse(os.path.exists(cloud_file.storage.path(parts_path)))
+
+    def test_part_validation(self):
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        part = self.data[:self.part_size]
+        with self.assertRaises(ValidationError) as context:
+            session.upload_part(1, part, hashlib.md5(part[::-1]).hexdigest())
+        self.assertEqual(context.exception.code, 'part-md5-validation-failed')
+        with self.assertRaises(ValidationError) as context:
+            session.upload_part(3, part, hashlib.md5(part).hexdigest())
+        self.assertEqual(context.exception.code, 'part-size-validation-failed')
+
+    def test_md5_mismatch(self):
+        self.cloud_file.md5 = hashlib.md5(b'other').hexdigest()
+        self.cloud_file.save()
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        self.upload_parts(session)
+        with self.assertRaises(ValidationError) as context:
+            session.commit()
+        self.assertEqual(context.exception.code, 'file-md5-validation-failed')
+        self.assertFalse(CloudFile.objects.get(pk=self.cloud_file.pk).uploaded)
+        self.assertFalse(CloudBlob.objects.exists())
+
+    def test_abort(self):
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        self.upload_parts(session, (1, 2))
+        parts_path = session.parts_path
+        session.abort()
+        self.assertEqual(self.stored_files(), [])
+        self.assertFalse(os.path.exists(self.cloud_file.storage.path(parts_path)))
+
+
+class CloudOSSUploadSessionTest(CloudUploadSessionTestMixin, CloudOSSTestCase):
+    def test_commit(self):
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        self.upload_parts(session)
+        cloud_file = session.commit()
+        # 提交时不读取合并后的对象，文件暂不关联存储对象
+        self.assertEqual(self.storage.bucket.requests['get_object'], 0)
+        self.assertTrue(cloud_file.uploaded)
+        self.assertIsNone(cloud_file.blob)
+        self.assertEqual(self.read(cloud_file), self.data)
+        cloud_file.ensure_blob()
+        self.assertEqual(cloud_file.blob.path, cloud_file.path)
+        self.assertEqual(cloud_file.blob.md5, hashlib.md5(self.data).hexdigest())
+
+    # 声明的MD5与内容不符时，文件不会以声明的MD5与其它文件共用存储对象
+    def test_md5_mismatch(self):
+        claimed = hashlib.md5(b'other').hexdigest()
+        self.cloud_file.md5 = claimed
+        self.cloud_file.save()
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        self.upload_parts(session)
+        cloud_file = session.commit()
+        copy = cloud_file.copy_to(None, 'copy.bin')
+        self.assertEqual(copy.md5, hashlib.md5(self.data).hexdigest())
+        self.assertEqual(CloudFile.objects.get(pk=cloud_file.pk).md5, copy.md5)
+        self.assertFalse(CloudBlob.objects.filter(md5=claimed).exists())
+
+    def test_abort(self):
+        session = CloudUploadSession.start(self.cloud_file, self.part_size)
+        self.upload_parts(session, (1,))
+        session.abort()
+        self.assertFalse(CloudUploadSession.objects.exists())
+        with self.assertRaises(Exception):
+            self.storage.bucket.list_parts(self.storage.get_object_key(session.path),
+                                           session.upload_id)
+
+
+# 以 Cookie 认证的修改类接口需要 CSRF 令牌
+class CloudCSRFTest(CloudStorageTestCase):
+    token = 'a' * 64
+
+    def setUp(self):
+        super().setUp()
+        self.cloud_file.file = ContentFile(self.data)
+        self.cloud_file.save()
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.login(username='uploader', password='password')
+
+    def post(self, url_name, pk, with_token, **data):
+        headers = {}
+        if with_token:
+            self.client.cookies['csrftoken'] = self.token
+            headers['HTTP_X_CSRFTOKEN'] = self.token
+        return self.client.post(reverse('DiurenCloud:' + url_name, args=(pk,)), data, **headers)
+
+    def test_copy(self):
+        response = self.post('api-copy', self.cloud_file.pk, False, name='copy.bin')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(CloudFile.objects.count(), 1)
+        response = self.post('api-copy', self.cloud_file.pk, True, name='copy.bin')
+        self.assertEqual(response.status_code, 201)
+
+    def test_trash(self):
+        response = self.post('api-trash', self.cloud_file.pk, False)
+        self.assertEqual(response.status_code, 403)
+        self.assertIsNone(CloudFile.objects.get(pk=self.cloud_file.pk).trashed_at)
+        response = self.post('api-trash', self.cloud_file.pk, True)
+        self.assertEqual(response.status_code, 200)
+
+    def test_upload_session(self):
+        pending = self.make_pending_file('session.bin', self.data)
+        response = self.post('api-upload-session-create', pending.pk, False)
+        self.assertEqual(response.status_code, 403)
+        response = self.post('api-upload-session-create', pending.pk, True)
+        self.assertEqual(response.status_code, 201)
+        session = response.json()['session']
+
+        url = reverse('DiurenCloud:api-upload-session-part', args=(session, 1))
+        md5 = hashlib.md5(self.data).hexdigest()
+        response = self.client.put(url, self.data, content_type='application/octet-stream',
+                                   HTTP_CONTENT_MD5=md5)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.put(url, self.data, content_type='application/octet-stream',
+                                   HTTP_CONTENT_MD5=md5, HTTP_X_CSRFTOKEN=self.token)
+        self.assertEqual(response.status_code, 200)
+        response = self.post('api-upload-session-commit', session, True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(CloudFile.objects.get(pk=pending.pk).uploaded)
+
+
+class CloudDirectoryDownloadTest(CloudStorageTestCase):
+    def make_uploaded_file(self, name, parent, data):
+        cloud_file = CloudFile(owner=self.owner, parent=parent, virtual_name=name)
+        cloud_file.file = ContentFile(data)
+        cloud_file.full_clean()
+        cloud_file.save()
+        return cloud_file
+
+    def test_download_directory(self):
+        root = CloudDirectory(owner=self.owner, virtual_name='root')
+        root.save()
+        sub = CloudDirectory(owner=self.owner, parent=root, virtual_name='sub')
+        sub.save()
+        self.make_uploaded_file('a.txt', root, b'a')
+        self.make_uploaded_file('b.txt', sub, b'b' * 1000)
+        self.make_uploaded_file('trashed.txt', sub, b'trashed').trash()
+        CloudFile(owner=self.owner, parent=sub, virtual_name='pending.txt', md5='0' * 32,
+                  size=1).save()
+
+        response = self.client.get(reverse('DiurenCloud:api-directory-download', args=(root.pk,)))
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()),
+                         ['root/', 'root/a.txt', 'root/sub/', 'root/sub/b.txt'])
+        self.assertEqual(archive.read('root/sub/b.txt'), b'b' * 1000)
+
+    def test_other_user(self):
+        other = CloudUser.objects.create(user=User.objects.create(username='other'))
+        directory = CloudDirectory(owner=other, virtual_name='secret')
+        directory.save()
+        response = self.client.get(reverse('DiurenCloud:api-directory-download',
+                                           args=(directory.pk,)))
+        self.assertEqual(response.status_code, 404)
+
+
+class CloudBatchDeleteTest(CloudOSSTestCase):
+    '''
+    事务提交后的回调在 TestCase 中不会执行，此处改为立即执行
+    '''
+
+    def setUp(self):
+        super().setUp()
+        on_commit_patch = mock.patch('django.db.transaction.on_commit',
+                                     lambda func, using=None: func())
+        on_commit_patch.start()
+        self.addCleanup(on_commit_patch.stop)
+        self.root = CloudDirectory(owner=self.owner, virtual_name='root')
+        self.root.save()
+        self.sub = CloudDirectory(owner=self.owner, parent=self.root, virtual_name='sub')
+        self.sub.save()
+
+    def test_delete_directory(self):
+        a = self.make_stored_file('a.txt', self.root, b'a')
+        b = self.make_stored_file('b.txt', self.sub, b'b')
+        self.make_stored_file('b2.txt', self.sub, b'b')
+        # 目录外的文件引用的存储对象不被删除
+        kept = self.make_stored_file('c.txt', None, b'c')
+        self.make_stored_file('c2.txt', self.sub, b'c')
+        self.assertEqual(self.storage.bucket.object_count, 3)
+
+        self.storage.bucket.requests.clear()
+        self.root.delete()
+        self.assertEqual(self.storage.bucket.requests['batch_delete_objects'], 1)
+        self.assertEqual(self.storage.bucket.requests['delete_object'], 0)
+        self.assertFalse(self.storage.exists(a.path))
+        self.assertFalse(self.storage.exists(b.path))
+        self.assertTrue(self.storage.exists(kept.path))
+        self.assertEqual(list(CloudBlob.objects.values_list('pk', 'reference_count')),
+                         [(kept.blob_id, 1)])
+
+    def test_purge_trash(self):
+        files = [self.make_stored_file('%d.txt' % i, self.sub, b'%d' % i) for i in range(3)]
+        self.root.trash()
+        CloudFile.objects.update(trashed_at=timezone.now() - datetime.timedelta(days=60))
+        CloudDirectory.objects.update(trashed_at=timezone.now() - datetime.timedelta(days=60))
+        call_command('cloud_purge_trash', '--days', '30', stdout=StringIO())
+        self.assertEqual(self.storage.bucket.requests['batch_delete_objects'], 1)
+        self.assertEqual(self.storage.bucket.object_count, 0)
+        self.assertFalse(CloudBlob.objects.exists())
+        self.assertFalse(CloudDirectory.objects.exists())
+        self.assertFalse(CloudFile.objects.filter(pk__in=[f.pk for f in files]).exists())
+
+
+class CloudReconcileTestMixin:
+    def setUp(self):
+        super().setUp()
+        self.stored = self.make_stored_file('stored.bin', None, b'stored')
+        self.missing = self.make_stored_file('missing.bin', None, b'missing')
+        self.missing.storage.delete(self.missing.path)
+        self.orphan = self.missing.storage.save(USER_UPLOAD_PATH + 'orphan.bin',
+                                                ContentFile(b'orphan'))
+
+    def reconcile(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('cloud_reconcile', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_report(self):
+        stdout, stderr = self.reconcile('--grace', '0')
+        self.assertIn('共核对 2 个对象：孤立对象 1 个，缺失对象 1 个，大小不符 0 个', stdout)
+        self.assertIn('对象缺失：' + self.missing.path, stderr)
+        # 未指定修复选项时不做任何修改
+        self.assertTrue(self.stored.storage.exists(self.orphan))
+        self.assertTrue(CloudFile.objects.get(pk=self.missing.pk).uploaded)
+
+    # 最近修改的孤立对象可能正在上传，不被删除
+    def test_grace(self):
+        stdout, stderr = self.reconcile('--delete-orphans')
+        self.assertIn('孤立对象 0 个', stdout)
+        self.assertIn('跳过最近修改的对象 1 个', stdout)
+        self.assertTrue(self.stored.storage.exists(self.orphan))
+
+    def test_delete_orphans(self):
+        self.reconcile('--delete-orphans', '--grace', '0')
+        self.assertFalse(self.stored.storage.exists(self.orphan))
+        self.assertTrue(self.stored.storage.exists(self.stored.path))
+        stdout, stderr = self.reconcile('--grace', '0')
+        self.assertIn('孤立对象 0 个', stdout)
+
+    def test_fix_missing(self):
+        blob_id = self.missing.blob_id
+        self.reconcile('--fix-missing', '--grace', '0')
+        missing = CloudFile.objects.get(pk=self.missing.pk)
+        self.assertFalse(missing.uploaded)
+        self.assertIsNone(missing.blob_id)
+        self.assertFalse(CloudBlob.objects.filter(pk=blob_id).exists())
+        self.assertTrue(CloudFile.objects.get(pk=self.stored.pk).uploaded)
+        stdout, stderr = self.reconcile('--grace', '0')
+        self.assertIn('缺失对象 0 个', stdout)
+
+    def test_size_mismatch(self):
+        CloudBlob.objects.filter(pk=self.stored.blob_id).update(size=1)
+        stdout, stderr = self.reconcile('--grace', '0')
+        self.assertIn('大小不符 1 个', stdout)
+        self.assertIn('大小不符：' + self.stored.path, stderr)
+
+
+class CloudReconcileTest(CloudReconcileTestMixin, CloudStorageTestCase):
+    pass
+
+
+class CloudOSSReconcileTest(CloudReconcileTestMixin, CloudOSSTestCase):
+    def setUp(self):
+        super().setUp()
+        storage_patch = mock.patch(
+            'DiurenCloud.management.commands.cloud_reconcile.default_storage', self.storage)
+        storage_patch.start()
+        self.addCleanup(storage_patch.stop)
+
+
+class CloudSearchTest(CloudTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.owner.user)
+        self.reports = self.make_directory('reports', self.a)
+        self.make_file('report-2019.pdf', self.b, 2)
+        self.make_file('Report.PDF', self.d, 3)
+        self.notes = self.make_file('notes.txt', self.a, 4)
+        other = CloudUser.objects.create(user=User.objects.create(username='other'))
+        CloudFile(owner=other, virtual_name='report.pdf', md5='0' * 32, size=1).save()
+
+    def search(self, directory=None, **params):
+        if directory is None:
+            url = reverse('DiurenCloud:api-search-root')
+        else:
+            url = reverse('DiurenCloud:api-search', args=(directory.pk,))
+        return self.client.get(url, params)
+
+    def names(self, directory=None, **params) -> set:
+        response = self.search(directory, **params)
+        self.assertEqual(response.json()['code'], 'search-completed')
+        return {item['name'] for item in response.json()['items']}
+
+    def test_substring(self):
+        self.assertEqual(self.names(q='report'), {'reports', 'report-2019.pdf', 'Report.PDF'})
+        self.assertEqual(self.names(q='EPO'), {'reports', 'report-2019.pdf', 'Report.PDF'})
+        # 短于 trigram 长度的关键词
+        self.assertEqual(self.names(q='c'), {'c', 'c.txt'})
+
+    def test_prefix(self):
+        self.assertEqual(self.names(q='rep', mode='prefix'),
+                         {'reports', 'report-2019.pdf', 'Report.PDF'})
+        self.assertEqual(self.names(q='port', mode='prefix'), set())
+
+    def test_filters(self):
+        self.assertEqual(self.names(ext='pdf'), {'report-2019.pdf', 'Report.PDF'})
+        self.assertEqual(self.names(q='report', type='directory'), {'reports'})
+        self.assertEqual(self.names(self.b, q='report'), {'report-2019.pdf'})
+
+    def test_trashed(self):
+        self.d.trash()
+        self.assertEqual(self.names(q='report'), {'reports', 'report-2019.pdf'})
+
+    # 重命名后索引随之更新
+    def test_rename(self):
+        self.notes.virtual_name = 'report-notes.txt'
+        self.notes.save()
+        self.assertIn('report-notes.txt', self.names(q='report'))
+        self.assertEqual(self.names(q='notes'), {'report-notes.txt'})
+
+    def test_invalid(self):
+        for params in ({}, {'q': ' '}, {'q': 'a', 'mode': 'regex'}, {'q': 'a', 'type': 'link'}):
+            response = self.search(**params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertEqual(response.json()['code'], 'search-invalid')
+
+    @skipUnless(connection.vendor == 'sqlite' and
+                connection.Database.sqlite_version_info >= SQLITE_TRIGRAM_MIN_VERSION,
+                'SQLite 版本不支持 trigram 分词器')
+    def test_index_used(self):
+        self.assertTrue(fts_available(connection))
+        self.assertIn('MATCH', str(search_objects(CloudFile, self.owner, 'report').query))
+
+
+class CloudSearchMigrationTest(TestCase):
+    migration = import_module('DiurenCloud.migrations.0012_auto_20261018_2241')
+
+    # 迁移中的语句是固定的，不随 DiurenCloud.search 的修改而改变
+    def test_frozen(self):
+        with open(self.migration.__file__, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        imported = {node.module for node in ast.walk(tree) if isinstance(node, ast.ImportFrom)}
+        imported.update(alias.name for node in ast.walk(tree) if isinstance(node, ast.Import)
+                        for alias in node.names)
+        self.assertEqual(imported, {'django.db'})
+        self.assertEqual(self.migration.SQLITE_TRIGRAM_MIN_VERSION, SQLITE_TRIGRAM_MIN_VERSION)
+
+    # 迁移后补建的索引与迁移建立的索引一致
+    def test_matches_search(self):
+        for model in (CloudDirectory, CloudFile):
+            table, search = model._meta.db_table, model._meta.db_table + '_search'
+            expected = [sql.format(table=table, search=search)
+                        for sql in self.migration.INSTALL_SQL['sqlite'][:-1]]
+            statements = [sql.format(table=table, search=search)
+                          for sql in sqlite_index_sql(table, search).values()]
+            self.assertEqual(statements, expected)
@@ -0,0 +1,97 @@
+import hashlib
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.utils.translation import gettext_lazy as _
+
+from DiurenCloud.apps import logger, FILE_BUFFER_MAX_SIZE, UPLOAD_MULTIPART_OVERHEAD_MAX_SIZE
+from DiurenUtility.utility import open_storage_writer
+
+
+class CloudFileUploadError(Exception):
+    def __init__(self, message, code):
+        self.message = message
+        self.code = code
+
+    def __str__(self):
+        return repr(self.code)
+
+
+class StoredUploadedFile(UploadedFile):
+    """
+    已经写入存储后端的上传文件，仅记录保存路径、大小与 MD5，不再持有文件内容。
+    """
+
+    def __init__(self, name, path, size, md5, content_type=None, charset=None,
+                 content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.path = path
+        self.md5 = md5
+
+
+'''
+云文件上传处理器
+在接收请求体的同时完成校验、MD5 计算并将数据直接写入存储后端，不经过临时文件。
+仅处理名为 file 的字段，其它文件字段会被忽略。
+'''
+
+
+class CloudFileUploadHandler(FileUploadHandler):
+    field_name = 'file'
+
+    def __init__(self, request, cloud_file):
+        super().__init__(request)
+        self.cloud_file = cloud_file
+        self.writer = None
+        self.hasher = None
+        self.received = 0
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # multipart 请求体中除文件内容外还包括分隔符和字段头，因此只检查是否在合理范围内
+        size = self.cloud_file.size
+        logger.debug('上传处理器：验证请求大小 {length} {size}'.format(length=content_length,
+                                                             size=size))
+        if not size <= content_length <= size + UPLOAD_MULTIPART_OVERHEAD_MAX_SIZE:
+            raise CloudFileUploadError(_('文件大小校验失败。'), 'file-size-validation-failed')
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        if field_name != self.field_name:
+            raise SkipFile()
+        c_name = self.cloud_file.virtual_name
+        logger.debug('上传处理器：验证文件名 {name1} {name2}'.format(name1=file_name, name2=c_name))
+        if file_name != c_name:
+            raise CloudFileUploadError(_('文件名称校验失败。'), 'file-name-validation-failed')
+        self.hasher = hashlib.md5()
+        self.received = 0
+        self.writer = open_storage_writer(self.cloud_file.storage, self.cloud_file.path,
+                                          FILE_BUFFER_MAX_SIZE)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.cloud_file.size:
+            self.abort()
+            raise CloudFileUploadError(_('文件大小校验失败。'), 'file-size-validation-failed')
+        self.hasher.update(raw_data)
+        try:
+            self.writer.write(raw_data)
+        except Exception:
+            self.abort()
+            raise
+
+    def file_complete(self, file_size):
+        path = self.writer.close()
+        self.writer = None
+        logger.debug('上传处理器：写入完成 {path}，大小 {size}'.format(path=path, size=file_size))
+        return StoredUploadedFile(self.file_name, path, file_size, self.hasher.hexdigest(),
+                                  self.content_type, self.charset, self.content_type_extra)
+
+    # 请求体解析结束时文件仍未写入完成（如请求体被截断），中止写入
+    def upload_complete(self):
+        self.abort()
+
+    def abort(self):
+        if self.writer is not None:
+            logger.debug('上传处理器：上传中止')
+            self.writer.abort()
+            self.writer = None
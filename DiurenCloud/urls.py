@@ -13,11 +13,45 @@ urlpatterns = [
     path('file/<int:pk>', views.CloudFileView.as_view(), name='file'),
     path('directory/<int:pk>', views.CloudDirectoryView.as_view(), name='directory'),
     path('path/<str:path>', views.CloudPathView.as_view(), name='path'),
+    # 文件下载（本地存储）
+    path('download/<int:pk>', views.CloudFileDownloadView.as_view(), name='download'),
+    # 目录列表接口
+    path('api/list/', views.CloudDirectoryListAPI.as_view(), name='api-list-root'),
+    path('api/list/<int:pk>', views.CloudDirectoryListAPI.as_view(), name='api-list'),
+    # 搜索接口
+    path('api/search/', views.CloudSearchAPI.as_view(), name='api-search-root'),
+    path('api/search/<int:pk>', views.CloudSearchAPI.as_view(), name='api-search'),
     # 上传下载授权接口
     path('api/require-upload/<int:pk>', views.CloudFileUploadRequestAPI.as_view(),
          name='api-upload-request'),
     path('api/require-download/<int:pk>', views.CloudFileDownloadRequestAPI.as_view(),
          name='api-download-request'),
+    # 目录打包下载接口
+    path('api/download-directory/<int:pk>', views.CloudDirectoryDownloadAPI.as_view(),
+         name='api-directory-download'),
+    # 复制接口
+    path('api/copy/<int:pk>', views.CloudFileCopyAPI.as_view(), name='api-copy'),
+    path('api/copy-directory/<int:pk>', views.CloudDirectoryCopyAPI.as_view(),
+         name='api-directory-copy'),
+    # 回收站接口
+    path('api/trash/', views.CloudTrashListAPI.as_view(), name='api-trash-list'),
+    path('api/trash/<int:pk>', views.CloudFileTrashAPI.as_view(), name='api-trash'),
+    path('api/trash-directory/<int:pk>', views.CloudDirectoryTrashAPI.as_view(),
+         name='api-directory-trash'),
+    path('api/restore/<int:pk>', views.CloudFileRestoreAPI.as_view(), name='api-restore'),
+    path('api/restore-directory/<int:pk>', views.CloudDirectoryRestoreAPI.as_view(),
+         name='api-directory-restore'),
+    # OSS直传回调接口
+    path('api/oss-callback', views.CloudOSSUploadCallbackAPI.as_view(), name='api-oss-callback'),
     # 本地上传接口
     path('api/local-upload/<int:pk>', views.CloudLocalFileUploadAPI.as_view(), name='api-upload'),
+    # 断点续传接口
+    path('api/upload-session/create/<int:pk>', views.CloudUploadSessionCreateAPI.as_view(),
+         name='api-upload-session-create'),
+    path('api/upload-session/<int:pk>', views.CloudUploadSessionAPI.as_view(),
+         name='api-upload-session'),
+    path('api/upload-session/<int:pk>/part/<int:number>',
+         views.CloudUploadSessionPartAPI.as_view(), name='api-upload-session-part'),
+    path('api/upload-session/<int:pk>/commit', views.CloudUploadSessionCommitAPI.as_view(),
+         name='api-upload-session-commit'),
 ]
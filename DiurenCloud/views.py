@@ -1,12 +1,20 @@
-import hashlib
+import base64
+import json
+import mimetypes
+from urllib.parse import quote
 
 from django.conf import settings
-from django.core.exceptions import ValidationError
-from django.core.files import File
-from django.http import JsonResponse, HttpRequest
+from django.core.exceptions import ValidationError, PermissionDenied
+from django.db import transaction
+from django.db.models import Q, QuerySet, F
+from django.http import JsonResponse, HttpRequest, StreamingHttpResponse, HttpResponse, Http404
+from django.middleware.csrf import CsrfViewMiddleware
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
 
 from django.utils.translation import gettext, gettext_lazy as _
 # Create your views here.
@@ -15,8 +23,13 @@ from django.views.decorators.csrf import csrf_exempt
 
 from django.views.generic import TemplateView, DetailView
 
-from DiurenCloud.apps import logger
-from DiurenCloud.models import CloudFile
+from DiurenCloud.apps import logger, OSS_UPLOAD_TOKEN_EXPIRE, FILE_STREAM_CHUNK_SIZE
+from DiurenCloud.models import CloudUser, CloudFile, CloudUploadSession, CloudDirectory
+from DiurenCloud.search import search_objects, SEARCH_MODES
+from DiurenCloud.upload_handlers import CloudFileUploadHandler, CloudFileUploadError
+from DiurenUtility.aliyun_oss.utility import get_token, verify_callback
+from DiurenUtility.apps import CONTENT_DISPOSITION_INLINE_FILE_EXTS
+from DiurenUtility.utility import stream_zip, parse_range_header, iter_file_range
 from DiurenUtility.views import LoginRequiredAPIMixin
 
 
@@ -47,12 +60,225 @@ class CloudPathView(TemplateView):
 #         return self.model.objects.get(pk=pk)
 
 
+'''
+要求登录的用户已开通云盘（拥有 CloudUser），并保存到 self.cloud_user；未开通时返回 403
+'''
+
+
+class CloudUserRequiredAPIMixin(LoginRequiredAPIMixin):
+    def dispatch(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            try:
+                self.cloud_user = request.user.cloud_user
+            except CloudUser.DoesNotExist:
+                data = {
+                    'message': _('未开通云盘。'),
+                    'code': 'cloud-user-required',
+                }
+                return JsonResponse(data, status=403)
+        return super().dispatch(request, *args, **kwargs)
+
+
+'''
+目录列表接口
+注意：需通过 Cookie 提供 sessionid
+
+GET api/list/<目录pk>  列出目录下的子目录与文件；GET api/list/ 列出用户根目录
+可选参数：
+    limit：每页数量，默认 100，最大 1000
+    cursor：上一页返回的 next_cursor，用于获取下一页
+    urls：为 1 时同时返回已上传文件的下载url
+先按名称列出所有子目录，再按名称列出所有文件。分页基于（名称，pk）游标，每页的查询次数固定，与目录大小无关。
+'''
+
+
+class CloudDirectoryListAPI(CloudUserRequiredAPIMixin, View):
+    model = CloudDirectory
+    default_limit = 100
+    max_limit = 1000
+    listed_data = {
+        'message': _('成功获取目录列表。'),
+        'code': 'directory-listed',
+    }
+
+    directory_fields = ('id', 'virtual_name', 'virtual_path', 'last_modified',
+                        'total_size', 'file_count', 'directory_count')
+    file_fields = ('id', 'virtual_name', 'virtual_path', 'last_modified',
+                   'path', 'size', 'md5', 'uploaded')
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        if pk is None:
+            return None
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at=None)
+
+    @staticmethod
+    def encode_cursor(kind: str, obj) -> str:
+        cursor = json.dumps([kind, obj.virtual_name, obj.pk])
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        kind, name, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if kind not in ('directory', 'file'):
+            raise ValueError(kind)
+        return kind, str(name), int(pk)
+
+    @staticmethod
+    def page(queryset: QuerySet, after, limit: int) -> list:
+        queryset = queryset.order_by('virtual_name', 'pk')
+        if after:
+            name, pk = after
+            queryset = queryset.filter(Q(virtual_name__gt=name) | Q(virtual_name=name, pk__gt=pk))
+        return list(queryset[:limit])
+
+    @staticmethod
+    def directory_data(directory: CloudDirectory):
+        return {
+            'type': 'directory',
+            'id': directory.pk,
+            'name': directory.virtual_name,
+            'path': directory.virtual_path,
+            'last_modified': directory.last_modified,
+            'total_size': directory.total_size,
+            'file_count': directory.file_count,
+            'directory_count': directory.directory_count,
+        }
+
+    @staticmethod
+    def file_data(cloud_file: CloudFile):
+        return {
+            'type': 'file',
+            'id': cloud_file.pk,
+            'name': cloud_file.virtual_name,
+            'path': cloud_file.virtual_path,
+            'last_modified': cloud_file.last_modified,
+            'size': cloud_file.size,
+            'md5': cloud_file.md5,
+            'uploaded': cloud_file.uploaded,
+        }
+
+    def get_directories(self, owner, directory) -> QuerySet:
+        return CloudDirectory.objects.filter(owner=owner, parent=directory, trashed_at=None)
+
+    def get_files(self, owner, directory) -> QuerySet:
+        return CloudFile.objects.filter(owner=owner, parent=directory, trashed_at=None)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            data = {
+                'message': _('目录不存在。'),
+                'code': 'directory-does-not-exist',
+            }
+            return JsonResponse(data, status=404)
+        try:
+            limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+            cursor = request.GET.get('cursor')
+            kind, name, pk = self.decode_cursor(cursor) if cursor else ('directory', None, None)
+            if limit <= 0:
+                raise ValueError(limit)
+        except (ValueError, TypeError):
+            data = {
+                'message': _('分页参数无效。'),
+                'code': 'pagination-invalid',
+            }
+            return JsonResponse(data, status=400)
+        after = (name, pk) if pk is not None else None
+        with_urls = request.GET.get('urls') == '1'
+
+        owner = self.cloud_user
+        directory = self.object  # type:CloudDirectory
+        directories, files = [], []
+        # 多取一条用于判断是否还有下一页
+        if kind == 'directory':
+            directories = self.page(
+                self.get_directories(owner, directory).only(*self.directory_fields),
+                after, limit + 1)
+            after = None
+        if len(directories) <= limit:
+            files = self.page(self.get_files(owner, directory).only(*self.file_fields),
+                              after, limit + 1 - len(directories))
+
+        items = [('directory', d) for d in directories] + [('file', f) for f in files]
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = self.encode_cursor(*items[-1])
+
+        page_files = [f for k, f in items if k == 'file']
+        urls = CloudFile.get_urls(page_files) if with_urls else {}
+        results = []
+        for k, obj in items:
+            if k == 'directory':
+                results.append(self.directory_data(obj))
+            else:
+                item = self.file_data(obj)
+                if with_urls:
+                    item['url'] = urls.get(obj.pk)
+                results.append(item)
+
+        data = dict(self.listed_data,
+                    directory=self.directory_data(directory) if directory else None,
+                    items=results, next_cursor=next_cursor)
+        return JsonResponse(data, status=200)
+
+
+'''
+搜索接口
+注意：需通过 Cookie 提供 sessionid
+
+GET api/search/?q=<关键词>  按名称搜索用户的所有文件与目录；GET api/search/<目录pk>?q=<关键词> 只搜索该目录的子树
+可选参数：
+    mode：substring（默认，名称包含关键词）或 prefix（名称以关键词开头）
+    ext：只搜索指定扩展名的文件，如 pdf
+    type：file 或 directory，只搜索一种对象
+    limit、cursor、urls：同目录列表接口
+q 与 ext 至少提供一个，均不区分大小写。结果先按名称列出目录，再按名称列出文件，回收站中的对象不会被搜索到。
+'''
+
+
+class CloudSearchAPI(CloudDirectoryListAPI):
+    listed_data = {
+        'message': _('搜索完成。'),
+        'code': 'search-completed',
+    }
+    types = ('file', 'directory')
+
+    def get_directories(self, owner, directory) -> QuerySet:
+        if self.ext or self.type == 'file':
+            return CloudDirectory.objects.none()
+        return search_objects(CloudDirectory, owner, self.query, self.mode, within=directory)
+
+    def get_files(self, owner, directory) -> QuerySet:
+        if self.type == 'directory':
+            return CloudFile.objects.none()
+        return search_objects(CloudFile, owner, self.query, self.mode, self.ext,
+                              within=directory)
+
+    def get(self, request, *args, **kwargs):
+        self.query = request.GET.get('q', '').strip()
+        self.mode = request.GET.get('mode', SEARCH_MODES[0])
+        self.ext = request.GET.get('ext', '').strip().lstrip('.')
+        self.type = request.GET.get('type')
+        if not (self.query or self.ext) or self.mode not in SEARCH_MODES or \
+                self.type not in (None,) + self.types:
+            data = {
+                'message': _('搜索参数无效。'),
+                'code': 'search-invalid',
+            }
+            return JsonResponse(data, status=400)
+        return super().get(request, *args, **kwargs)
+
+
 class CloudFileDownloadRequestAPI(LoginRequiredAPIMixin, View):
     model = CloudFile
 
     def get_object(self):
         pk = self.kwargs.get('pk')
-        return self.model.objects.get(pk=pk)
+        return self.model.objects.get(pk=pk, owner__user=self.request.user, trashed_at=None)
 
     def get(self, request, *args, **kwargs):
         try:
@@ -79,12 +305,372 @@ class CloudFileDownloadRequestAPI(LoginRequiredAPIMixin, View):
             return JsonResponse(data, status=404)
 
 
+'''
+下载文件（本地存储）
+仅文件所有者可以下载。以 md5 作为 ETag，支持条件请求（If-None-Match、If-Modified-Since）与单段 Range 请求。
+若设置了 CLOUD_DOWNLOAD_ACCEL，则只返回 X-Accel-Redirect / X-Sendfile 头，由前端服务器发送文件内容。
+'''
+
+
+class CloudFileDownloadView(View):
+    model = CloudFile
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.get(pk=pk, owner__user=self.request.user, uploaded=True,
+                                      trashed_at=None)
+
+    @staticmethod
+    def content_headers(cloud_file: CloudFile) -> dict:
+        content_type, encoding = mimetypes.guess_type(cloud_file.virtual_name)
+        if cloud_file.virtual_name.split('.')[-1].lower() in CONTENT_DISPOSITION_INLINE_FILE_EXTS:
+            disposition = 'inline'
+        else:
+            disposition = "attachment; filename*=UTF-8''{name}".format(
+                name=quote(cloud_file.virtual_name))
+        return {
+            'Content-Type': content_type or 'application/octet-stream',
+            'Content-Disposition': disposition,
+            'ETag': quote_etag(cloud_file.md5),
+            'Last-Modified': http_date(cloud_file.last_modified.timestamp()),
+        }
+
+    @staticmethod
+    def accel_response(cloud_file: CloudFile) -> HttpResponse:
+        response = HttpResponse()
+        if settings.CLOUD_DOWNLOAD_ACCEL == 'X-Sendfile':
+            response['X-Sendfile'] = cloud_file.storage.path(cloud_file.path)
+        else:
+            response['X-Accel-Redirect'] = settings.CLOUD_DOWNLOAD_ACCEL_LOCATION + quote(
+                cloud_file.path)
+        return response
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            raise PermissionDenied
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            raise Http404(_('文件不存在。'))
+        cloud_file = self.object  # type:CloudFile
+        headers = self.content_headers(cloud_file)
+
+        response = get_conditional_response(
+            request, etag=headers['ETag'],
+            last_modified=int(cloud_file.last_modified.timestamp()))
+        if response is None and settings.CLOUD_DOWNLOAD_ACCEL:
+            # 前端服务器自行处理 Range 请求
+            response = self.accel_response(cloud_file)
+        if response is None:
+            response = self.file_response(request, cloud_file)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    @staticmethod
+    def file_response(request, cloud_file: CloudFile):
+        size = cloud_file.size
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        # If-Range 与当前 ETag 不一致时忽略 Range，发送完整内容
+        if range_header and size and (not if_range or if_range == quote_etag(cloud_file.md5)):
+            try:
+                byte_range = parse_range_header(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */{size}'.format(size=size)
+                return response
+            if byte_range:
+                start, end = byte_range
+                status = 206
+        length = end - start + 1 if size else 0
+
+        logger.debug('下载文件：{file} {start}-{end}'.format(file=cloud_file, start=start, end=end))
+        response = StreamingHttpResponse(
+            iter_file_range(cloud_file.file, start, length, FILE_STREAM_CHUNK_SIZE), status=status)
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response['Content-Range'] = 'bytes {start}-{end}/{size}'.format(
+                start=start, end=end, size=size)
+        return response
+
+
+'''
+打包下载目录
+注意：需通过 Cookie 提供 sessionid
+
+GET api/download-directory/<目录pk>
+以 ZIP 格式（存储模式，ZIP64）流式返回整个目录，包括所有子目录及已上传的文件。
+文件内容从存储后端逐块读取并直接写入响应，每个请求的内存占用与目录大小无关。
+'''
+
+
+class CloudDirectoryDownloadAPI(LoginRequiredAPIMixin, View):
+    model = CloudDirectory
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at=None)
+
+    @staticmethod
+    def date_time(obj):
+        # ZIP 格式无法表示 1980 年以前的时间
+        return max(timezone.localtime(obj.last_modified).timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+    @staticmethod
+    def file_chunks(cloud_file: CloudFile):
+        file = cloud_file.file
+        try:
+            for chunk in file.chunks(FILE_STREAM_CHUNK_SIZE):
+                yield chunk
+        finally:
+            file.close()
+
+    def entries(self, directory: CloudDirectory):
+        prefix_length = len(directory.virtual_path)
+        root = directory.virtual_name + '/'
+        yield root, self.date_time(directory), None
+        directories = directory.descendant_directories.filter(trashed_at=None)
+        for sub_directory in directories.order_by('virtual_path').iterator():
+            yield (root + sub_directory.virtual_path[prefix_length:],
+                   self.date_time(sub_directory), None)
+        files = directory.descendant_files.filter(uploaded=True, trashed_at=None).order_by(
+            'virtual_path')
+        for cloud_file in files.iterator():
+            logger.debug('打包下载：写入文件 {file}'.format(file=cloud_file))
+            yield (root + cloud_file.virtual_path[prefix_length:],
+                   self.date_time(cloud_file), self.file_chunks(cloud_file))
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            data = {
+                'message': _('目录不存在。'),
+                'code': 'directory-does-not-exist',
+            }
+            return JsonResponse(data, status=404)
+        directory = self.object  # type:CloudDirectory
+        response = StreamingHttpResponse(stream_zip(self.entries(directory)),
+                                         content_type='application/zip')
+        response['Content-Disposition'] = "attachment; filename*=UTF-8''{name}".format(
+            name=quote(directory.virtual_name + '.zip'))
+        return response
+
+
+'''
+复制文件/目录
+POST api/copy/<文件pk>、api/copy-directory/<目录pk>  {"parent":<可选，目标目录pk，省略时复制到根目录>, "name":<可选，副本名称>}
+副本与原文件共用存储对象，无论文件大小，存储后端上都不会复制任何数据。
+注意：需在 X-CSRFToken 请求头中提供 CSRF 令牌
+'''
+
+
+class CloudFileCopyAPI(LoginRequiredAPIMixin, View):
+    model = CloudFile
+    does_not_exist_data = {
+        'message': _('文件不存在。'),
+        'code': 'file-does-not-exist',
+    }
+    copied_data = {
+        'message': _('成功复制文件。'),
+        'code': 'file-copied',
+    }
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at=None)
+
+    def get_parent(self):
+        pk = self.request.POST.get('parent')
+        if not pk:
+            return None
+        return CloudDirectory.objects.get(pk=pk, owner__user=self.request.user,
+                                          trashed_at=None)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            return JsonResponse(self.does_not_exist_data, status=404)
+        try:
+            parent = self.get_parent()
+        except (CloudDirectory.DoesNotExist, ValueError):
+            data = {
+                'message': _('目标目录不存在。'),
+                'code': 'parent-does-not-exist',
+            }
+            return JsonResponse(data, status=404)
+        try:
+            copy = self.object.copy_to(parent, request.POST.get('name') or None)
+        except ValidationError as e:
+            if hasattr(e, 'error_dict'):
+                data = {
+                    'message': _('模型验证时发生错误。'),
+                    'code': 'model-validation-error',
+                    'error': dict(e),
+                }
+                return JsonResponse(data, status=400)
+            return CloudUploadSessionMixin.error_response(e)
+        data = dict(self.copied_data, pk=copy.pk)
+        return JsonResponse(data, status=201)
+
+
+class CloudDirectoryCopyAPI(CloudFileCopyAPI):
+    model = CloudDirectory
+    does_not_exist_data = {
+        'message': _('目录不存在。'),
+        'code': 'directory-does-not-exist',
+    }
+    copied_data = {
+        'message': _('成功复制目录。'),
+        'code': 'directory-copied',
+    }
+
+
+'''
+回收站
+POST api/trash/<文件pk>、api/trash-directory/<目录pk>  移入回收站，目录的整棵子树对用户立即不可见
+POST api/restore/<文件pk>、api/restore-directory/<目录pk>  从回收站中恢复到原位置
+GET api/trash/?limit=<可选，数量>&offset=<可选，偏移>  按移入时间倒序列出回收站中的文件与目录，
+随目录一并移入回收站的子孙对象不单独列出
+回收站中的对象在保留期过后由 cloud_purge_trash 命令清除。
+注意：移入回收站与恢复需在 X-CSRFToken 请求头中提供 CSRF 令牌
+'''
+
+
+class CloudFileTrashAPI(LoginRequiredAPIMixin, View):
+    model = CloudFile
+    does_not_exist_data = {
+        'message': _('文件不存在。'),
+        'code': 'file-does-not-exist',
+    }
+    done_data = {
+        'message': _('成功将文件移入回收站。'),
+        'code': 'file-trashed',
+    }
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at=None)
+
+    def perform(self, obj):
+        obj.trash()
+
+    def post(self, request, *args, **kwargs):
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            return JsonResponse(self.does_not_exist_data, status=404)
+        try:
+            self.perform(self.object)
+        except ValidationError as e:
+            return CloudUploadSessionMixin.error_response(e)
+        return JsonResponse(self.done_data, status=200)
+
+
+class CloudDirectoryTrashAPI(CloudFileTrashAPI):
+    model = CloudDirectory
+    does_not_exist_data = {
+        'message': _('目录不存在。'),
+        'code': 'directory-does-not-exist',
+    }
+    done_data = {
+        'message': _('成功将目录移入回收站。'),
+        'code': 'directory-trashed',
+    }
+
+
+class CloudFileRestoreAPI(CloudFileTrashAPI):
+    done_data = {
+        'message': _('成功恢复文件。'),
+        'code': 'file-restored',
+    }
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at__isnull=False)
+
+    def perform(self, obj):
+        obj.restore()
+
+
+class CloudDirectoryRestoreAPI(CloudFileRestoreAPI):
+    model = CloudDirectory
+    does_not_exist_data = CloudDirectoryTrashAPI.does_not_exist_data
+    done_data = {
+        'message': _('成功恢复目录。'),
+        'code': 'directory-restored',
+    }
+
+
+class CloudTrashListAPI(CloudUserRequiredAPIMixin, View):
+    default_limit = 100
+    max_limit = 1000
+
+    # 回收站中的顶层对象：父目录不在回收站中，或早于父目录单独移入回收站
+    @staticmethod
+    def trashed(model, owner, count: int) -> list:
+        queryset = model.objects.filter(owner=owner, trashed_at__isnull=False).exclude(
+            parent__trashed_at=F('trashed_at'))
+        return list(queryset.order_by('-trashed_at', '-pk')[:count])
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+            offset = int(request.GET.get('offset', 0))
+            if limit <= 0 or offset < 0:
+                raise ValueError(limit, offset)
+        except ValueError:
+            data = {
+                'message': _('分页参数无效。'),
+                'code': 'pagination-invalid',
+            }
+            return JsonResponse(data, status=400)
+        owner = self.cloud_user
+        # 多取一条用于判断是否还有下一页
+        count = offset + limit + 1
+        items = [(d.trashed_at, CloudDirectoryListAPI.directory_data(d))
+                 for d in self.trashed(CloudDirectory, owner, count)]
+        items += [(f.trashed_at, CloudDirectoryListAPI.file_data(f))
+                  for f in self.trashed(CloudFile, owner, count)]
+        items.sort(key=lambda item: (item[0], item[1]['id']), reverse=True)
+        results = []
+        for trashed_at, item in items[offset:offset + limit]:
+            item['trashed_at'] = trashed_at
+            results.append(item)
+        data = {
+            'message': _('成功获取回收站列表。'),
+            'code': 'trash-listed',
+            'items': results,
+            'has_more': len(items) > offset + limit,
+        }
+        return JsonResponse(data, status=200)
+
+
+'''
+请求上传文件
+使用OSS时返回浏览器直传OSS（PostObject）所需的表单字段，签名仅允许以声明的大小上传到指定的key，
+上传完成后OSS会回调 api/oss-callback，由回调接口校验大小与MD5并标记文件为已上传；
+使用本地存储时返回本地上传接口的url。
+若用户已有相同内容的文件，则直接引用其存储对象（秒传），返回 file-instant-uploaded。
+'''
+
+
 class CloudFileUploadRequestAPI(LoginRequiredAPIMixin, View):
     model = CloudFile
 
     def get_object(self):
         pk = self.kwargs.get('pk')
-        return self.model.objects.get(pk=pk)
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at=None)
 
     def get(self, request, *args, **kwargs):
         try:
@@ -95,12 +681,34 @@ class CloudFileUploadRequestAPI(LoginRequiredAPIMixin, View):
                 'code': 'file-does-not-exist',
             }
             return JsonResponse(data, status=404)
+        cloud_file = self.object  # type:CloudFile
+        # 用户已有相同内容（md5 与大小均相同）的文件时直接引用其存储对象，无需上传
+        with transaction.atomic():
+            instant_uploaded = cloud_file.attach_existing_blob()
+            if instant_uploaded:
+                cloud_file.save()
+        if instant_uploaded:
+            data = {
+                'message': _('文件已存在，秒传成功。'),
+                'code': 'file-instant-uploaded',
+                'url': cloud_file.url,
+            }
+            return JsonResponse(data, status=200)
         data = {
             'message': _('成功生成上传url。'),
             'code': 'upload-link-generated',
         }
         if settings.USE_OSS:
-            pass  # todo 看看oss怎么给post链接签名
+            oss_storage = cloud_file.storage
+            key = oss_storage.get_object_key(oss_storage.get_available_name(cloud_file.path))
+            callback_url = request.build_absolute_uri(reverse('DiurenCloud:api-oss-callback'))
+            callback_body = 'object=${object}&size=${size}&md5=${contentMd5}&file=%d' % cloud_file.pk
+            data.update({
+                'url': None,
+                'token': get_token(key, expires=OSS_UPLOAD_TOKEN_EXPIRE, callback_url=callback_url,
+                                   size=cloud_file.size, exact=True,
+                                   callback_body=callback_body),
+            })
         else:
             data.update({
                 'url': reverse('DiurenCloud:api-upload', kwargs={'pk': self.object.pk})
@@ -112,28 +720,22 @@ class CloudFileUploadRequestAPI(LoginRequiredAPIMixin, View):
 注意：需通过 Cookie 提供 sessionid
 注意：需要设置 Content-type: multipart/form-data
 注意：接口会对上传的文件名、文件大小和MD5进行校验
+注意：文件内容在接收时即被写入存储后端，文件名与请求大小不符时会在读取请求体之前拒绝
+注意：需在 X-CSRFToken 请求头中提供 CSRF 令牌
 
 调用方法：
 {"file":<文件>}
 '''
 
 
+# CSRF 中间件会读取 request.POST，使请求体在设置上传处理器之前就被解析，因此豁免后在视图中自行校验
 @method_decorator(csrf_exempt, 'dispatch')
 class CloudLocalFileUploadAPI(LoginRequiredAPIMixin, View):
     model = CloudFile
 
     def get_object(self):
         pk = self.kwargs.get('pk')
-        return self.model.objects.get(pk=pk)
-
-    @staticmethod
-    def md5(file: File):
-        logger.debug('本地上传：MD5验证计算开始')
-        hasher = hashlib.md5()
-        hasher.update(file.read())
-        result = hasher.hexdigest()
-        logger.debug('本地上传：MD5计算结果 {md5}'.format(md5=result))
-        return result
+        return self.model.objects.get(pk=pk, owner__user=self.request.user, trashed_at=None)
 
     def post(self, request, *args, **kwargs):
         try:
@@ -148,46 +750,65 @@ class CloudLocalFileUploadAPI(LoginRequiredAPIMixin, View):
         cloud_file = self.object  # type:CloudFile
 
         req = self.request  # type:HttpRequest
-        file = req.FILES['file']
-
-        # todo 好大一坨...想办法改改
-        c_name = cloud_file.virtual_name
-        logger.debug('本地上传：验证文件名 {name1} {name2}'.format(name1=file.name, name2=c_name))
-        if file.name == c_name:
-            c_size = cloud_file.size
-            logger.debug('本地上传：验证大小 {size1} {size2}'.format(size1=file.size, size2=c_size))
-            if file.size == c_size:
-                file_md5 = self.md5(file)
-                c_md5 = cloud_file.md5
-                logger.debug('本地上传：验证MD5 {md51} {md52}'.format(md51=file_md5, md52=c_md5))
-                if file_md5 == c_md5:
-                    logger.debug('本地上传：验证通过√')
-                    if cloud_file.uploaded:
-                        msg = _('成功上传并替换当前文件。')
-                        del cloud_file.file
-                    else:
-                        msg = _('成功上传文件。'),
-                    cloud_file.file = file
-                    logger.debug('本地上传：保存完成，实际保存路径 {name}'.format(name=cloud_file.path))
-                else:
-                    data = {
-                        'message': _('文件md5校验失败。'),
-                        'code': 'file-md5-validation-failed',
-                    }
-                    return JsonResponse(data, status=400)
-            else:
-                data = {
-                    'message': _('文件大小校验失败。'),
-                    'code': 'file-size-validation-failed',
-                }
-                return JsonResponse(data, status=400)
-        else:
+        # 上传处理器在接收请求体的同时校验文件名与大小、计算MD5，并将数据直接写入存储后端
+        handler = CloudFileUploadHandler(req, cloud_file)
+        req.upload_handlers = [handler]
+        try:
+            rejected = CsrfViewMiddleware().process_view(req, None, (), {})
+            file = req.FILES.get('file')
+        except CloudFileUploadError as e:
+            handler.abort()
+            data = {
+                'message': e.message,
+                'code': e.code,
+            }
+            return JsonResponse(data, status=400)
+        except Exception:
+            # 客户端断开连接或请求体无法解析时 Django 不会通知上传处理器，需在此中止写入
+            handler.abort()
+            raise
+        if rejected is not None:
+            # CSRF 校验失败时请求体已被接收，删除刚刚写入的文件
+            if file is not None:
+                cloud_file.storage.delete(file.path)
+            return rejected
+        if file is None:
             data = {
-                'message': _('文件名称校验失败。'),
-                'code': 'file-name-validation-failed',
+                'message': _('未提供文件。'),
+                'code': 'file-missing',
             }
             return JsonResponse(data, status=400)
 
+        c_size = cloud_file.size
+        c_md5 = cloud_file.md5
+        logger.debug('本地上传：验证大小 {size1} {size2}'.format(size1=file.size, size2=c_size))
+        logger.debug('本地上传：验证MD5 {md51} {md52}'.format(md51=file.md5, md52=c_md5))
+        if file.size != c_size:
+            data = {
+                'message': _('文件大小校验失败。'),
+                'code': 'file-size-validation-failed',
+            }
+        elif file.md5 != c_md5:
+            data = {
+                'message': _('文件md5校验失败。'),
+                'code': 'file-md5-validation-failed',
+            }
+        else:
+            data = None
+        if data:
+            # 校验失败，删除刚刚写入的文件
+            cloud_file.storage.delete(file.path)
+            return JsonResponse(data, status=400)
+
+        logger.debug('本地上传：验证通过√')
+        if cloud_file.uploaded:
+            msg = _('成功上传并替换当前文件。')
+            del cloud_file.file
+        else:
+            msg = _('成功上传文件。')
+        cloud_file.attach(file.path)
+        logger.debug('本地上传：保存完成，实际保存路径 {name}'.format(name=cloud_file.path))
+
         data = {
             'message': msg,
             'code': 'file-uploaded',
@@ -206,3 +827,246 @@ class CloudLocalFileUploadAPI(LoginRequiredAPIMixin, View):
             cloud_file.save()
 
             return JsonResponse(data, status=204)
+
+
+'''
+断点续传接口
+注意：需通过 Cookie 提供 sessionid
+注意：除查询会话外，需在 X-CSRFToken 请求头中提供 CSRF 令牌
+
+1. POST api/upload-session/create/<文件pk>  {"part_size":<可选，分片大小>}
+   创建上传会话，返回会话信息
+2. PUT api/upload-session/<会话pk>/part/<分片编号，从1开始>
+   请求体为分片的原始数据，需设置请求头 Content-MD5: <分片MD5的十六进制字符串>
+   分片可以任意顺序上传，重复上传会覆盖之前的分片
+3. GET api/upload-session/<会话pk>
+   查询会话信息，missing_parts 为尚未上传的分片编号
+4. POST api/upload-session/<会话pk>/commit
+   所有分片上传完成后提交会话，合并为完整文件
+DELETE api/upload-session/<会话pk> 可取消会话
+'''
+
+
+class CloudUploadSessionMixin:
+    model = CloudUploadSession
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.select_related('file').get(pk=pk,
+                                                             file__owner__user=self.request.user,
+                                                             file__trashed_at=None)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            data = {
+                'message': _('上传会话不存在。'),
+                'code': 'upload-session-does-not-exist',
+            }
+            return JsonResponse(data, status=404)
+        return super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def session_data(session: CloudUploadSession):
+        return {
+            'session': session.pk,
+            'file': session.file_id,
+            'part_size': session.part_size,
+            'part_count': session.part_count,
+            'missing_parts': session.missing_parts,
+        }
+
+    @staticmethod
+    def error_response(e: ValidationError):
+        data = {
+            'message': e.message % e.params if e.params else e.message,
+            'code': e.code,
+        }
+        return JsonResponse(data, status=400)
+
+
+class CloudUploadSessionCreateAPI(LoginRequiredAPIMixin, View):
+    model = CloudFile
+
+    def get_object(self):
+        pk = self.kwargs.get('pk')
+        return self.model.objects.get(pk=pk, owner__user=self.request.user,
+                                      trashed_at=None)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            self.object = self.get_object()
+        except self.model.DoesNotExist:
+            data = {
+                'message': _('文件不存在。'),
+                'code': 'file-does-not-exist',
+            }
+            return JsonResponse(data, status=404)
+        part_size = request.POST.get('part_size')
+        try:
+            session = CloudUploadSession.start(self.object,
+                                               int(part_size) if part_size else None)
+        except ValueError:
+            data = {
+                'message': _('分片大小无效。'),
+                'code': 'part-size-invalid',
+            }
+            return JsonResponse(data, status=400)
+        except ValidationError as e:
+            return CloudUploadSessionMixin.error_response(e)
+        data = {
+            'message': _('成功创建上传会话。'),
+            'code': 'upload-session-created',
+        }
+        data.update(CloudUploadSessionMixin.session_data(session))
+        return JsonResponse(data, status=201)
+
+
+class CloudUploadSessionAPI(LoginRequiredAPIMixin, CloudUploadSessionMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        data = {
+            'message': _('成功获取上传会话。'),
+            'code': 'upload-session-info',
+        }
+        data.update(self.session_data(self.object))
+        return JsonResponse(data, status=200)
+
+    def delete(self, request, *args, **kwargs):
+        self.object.abort()
+        data = {
+            'message': _('成功取消上传会话。'),
+            'code': 'upload-session-aborted',
+        }
+        return JsonResponse(data, status=200)
+
+
+class CloudUploadSessionPartAPI(LoginRequiredAPIMixin, CloudUploadSessionMixin, View):
+
+    def put(self, request, *args, **kwargs):
+        session = self.object  # type:CloudUploadSession
+        number = self.kwargs.get('number')
+        md5 = request.META.get('HTTP_CONTENT_MD5', '').lower()
+        # 请求体大小不超过分片大小，直接读入内存
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > session.part_size:
+            data = {
+                'message': _('分片大小校验失败。'),
+                'code': 'part-size-validation-failed',
+            }
+            return JsonResponse(data, status=400)
+        try:
+            session.upload_part(number, request.read(content_length), md5)
+        except ValidationError as e:
+            return self.error_response(e)
+        data = {
+            'message': _('成功上传分片。'),
+            'code': 'part-uploaded',
+        }
+        data.update(self.session_data(session))
+        return JsonResponse(data, status=200)
+
+
+class CloudUploadSessionCommitAPI(LoginRequiredAPIMixin, CloudUploadSessionMixin, View):
+
+    def post(self, request, *args, **kwargs):
+        try:
+            cloud_file = self.object.commit()
+        except ValidationError as e:
+            return self.error_response(e)
+        data = {
+            'message': _('成功上传文件。'),
+            'code': 'file-uploaded',
+            'url': cloud_file.url,
+        }
+        return JsonResponse(data, status=200)
+
+
+'''
+OSS上传回调
+浏览器直传OSS完成后，由OSS调用此接口；接口验证回调签名，校验文件大小与MD5后将文件标记为已上传。
+校验失败时删除已上传的对象，OSS会将此接口的响应返回给浏览器。
+'''
+
+
+@method_decorator(csrf_exempt, 'dispatch')
+class CloudOSSUploadCallbackAPI(View):
+    model = CloudFile
+
+    def post(self, request, *args, **kwargs):
+        meta = request.META
+        if not verify_callback(request.path, meta.get('QUERY_STRING', ''), request.body,
+                               meta.get('HTTP_AUTHORIZATION', ''),
+                               meta.get('HTTP_X_OSS_PUB_KEY_URL', '')):
+            logger.warning('OSS回调：签名验证失败')
+            data = {
+                'message': _('回调签名验证失败。'),
+                'code': 'callback-signature-invalid',
+            }
+            return JsonResponse(data, status=403)
+
+        params = request.POST
+        try:
+            cloud_file = self.model.objects.select_related('owner__user').get(pk=params['file'])
+        except (KeyError, ValueError, self.model.DoesNotExist):
+            data = {
+                'message': _('文件不存在。'),
+                'code': 'file-does-not-exist',
+            }
+            return JsonResponse(data, status=404)
+
+        oss_storage = cloud_file.storage
+        name = oss_storage.get_object_name(params.get('object', ''))
+        try:
+            size = int(params.get('size'))
+            md5 = base64.b64decode(params.get('md5', '')).hex()
+        except (TypeError, ValueError):
+            size, md5 = None, None
+        logger.debug('OSS回调：{name} 大小 {size} MD5 {md5}'.format(name=name, size=size, md5=md5))
+
+        if not name.startswith(cloud_file.owner.object_path):
+            data = {
+                'message': _('文件路径校验失败。'),
+                'code': 'file-path-validation-failed',
+            }
+        elif size != cloud_file.size:
+            data = {
+                'message': _('文件大小校验失败。'),
+                'code': 'file-size-validation-failed',
+            }
+        elif md5 != cloud_file.md5:
+            data = {
+                'message': _('文件md5校验失败。'),
+                'code': 'file-md5-validation-failed',
+            }
+        else:
+            data = None
+        if data:
+            oss_storage.delete(name)
+            return JsonResponse(data, status=400)
+
+        # 锁定文件，同一上传的重复回调依次处理
+        with transaction.atomic():
+            cloud_file = self.model.objects.select_for_update().get(pk=cloud_file.pk)
+            if cloud_file.uploaded and cloud_file.blob_id and cloud_file.blob.path == name:
+                # OSS 可能重复回调，文件已关联该对象时不再增加引用数
+                logger.debug('OSS回调：重复回调 {name}'.format(name=name))
+                msg = _('成功上传文件。')
+            else:
+                if cloud_file.uploaded and cloud_file.path != name:
+                    msg = _('成功上传并替换当前文件。')
+                    del cloud_file.file
+                else:
+                    msg = _('成功上传文件。')
+                cloud_file.attach(name)
+                cloud_file.save()
+        data = {
+            'message': msg,
+            'code': 'file-uploaded',
+            'file': cloud_file.pk,
+        }
+        return JsonResponse(data, status=200)
@@ -0,0 +1,105 @@
+# 进程内共享的 OSS 客户端
+# 媒体文件存储、静态文件存储与上传签名等工具函数共用同一组 Auth、连接池与 Bucket，
+# 在第一次使用时才根据 settings.ALIYUN_OSS_STORAGE 创建，以减少启动开销并在请求之间复用 TCP/TLS 连接。
+
+import threading
+
+import oss2
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from oss2.api import _normalize_endpoint
+
+from DiurenUtility.aliyun_oss.metadata import ObjectMetadataCache
+from DiurenUtility.apps import logger, OSS_CONNECTION_POOL_SIZE, OSS_CONNECT_TIMEOUT, \
+    OSS_REQUEST_RETRIES, OSS_METADATA_CACHE_SIZE, OSS_METADATA_CACHE_EXPIRE, \
+    OSS_METADATA_CACHE_ALIAS
+
+_NO_DEFAULT = object()
+
+_lock = threading.RLock()
+_clients = {}
+
+
+def get_config(name, default=_NO_DEFAULT):
+    try:
+        return settings.ALIYUN_OSS_STORAGE[name]
+    except (AttributeError, KeyError):
+        if default is not _NO_DEFAULT:
+            return default
+        raise ImproperlyConfigured("Can't find config for '%s' in setting.py" % name)
+
+
+def _get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def get_auth() -> oss2.Auth:
+    return _get_client('auth', lambda: oss2.Auth(get_config('ACCESS_KEY_ID'),
+                                                 get_config('ACCESS_KEY_SECRET')))
+
+
+def get_end_point() -> str:
+    return _normalize_endpoint(get_config('END_POINT').strip())
+
+
+'''
+共享的 HTTP 连接池
+连接池大小应不小于同时访问 OSS 的线程数（包括并发分片上传的线程），requests 会保持连接以供复用。
+'''
+
+
+def get_session() -> oss2.Session:
+    def create():
+        # 请求失败时的重试次数与连接池大小均为 oss2 的全局设置
+        # （oss2 2.7.0 的 Session 不接受参数，创建时读取 oss2.defaults.connection_pool_size）
+        oss2.defaults.request_retries = get_config('REQUEST_RETRIES', OSS_REQUEST_RETRIES)
+        pool_size = get_config('CONNECTION_POOL_SIZE', OSS_CONNECTION_POOL_SIZE)
+        oss2.defaults.connection_pool_size = pool_size
+        logger.debug('OSS客户端：创建连接池，大小 {size}'.format(size=pool_size))
+        return oss2.Session()
+
+    return _get_client('session', create)
+
+
+def get_service() -> oss2.Service:
+    return _get_client('service', lambda: oss2.Service(
+        get_auth(), get_end_point(), session=get_session(),
+        connect_timeout=get_config('CONNECT_TIMEOUT', OSS_CONNECT_TIMEOUT)))
+
+
+def get_bucket() -> oss2.Bucket:
+    def create():
+        bucket_name = get_config('BUCKET_NAME')
+        cname = get_config('ALIYUN_OSS_CNAME', None)
+        logger.debug('OSS客户端：创建 Bucket {name}'.format(name=bucket_name))
+        return oss2.Bucket(get_auth(), cname or get_end_point(), bucket_name,
+                           is_cname=bool(cname), session=get_session(),
+                           connect_timeout=get_config('CONNECT_TIMEOUT', OSS_CONNECT_TIMEOUT))
+
+    return _get_client('bucket', create)
+
+
+def get_metadata_cache() -> ObjectMetadataCache:
+    return _get_client('metadata_cache', lambda: ObjectMetadataCache(
+        get_config('METADATA_CACHE_SIZE', OSS_METADATA_CACHE_SIZE),
+        get_config('METADATA_CACHE_EXPIRE', OSS_METADATA_CACHE_EXPIRE),
+        get_config('METADATA_CACHE_ALIAS', OSS_METADATA_CACHE_ALIAS)))
+
+
+def reset_clients():
+    with _lock:
+        _clients.clear()
+
+
+@receiver(setting_changed)
+def _reset_clients_on_setting_changed(setting, **kwargs):
+    if setting == 'ALIYUN_OSS_STORAGE':
+        reset_clients()
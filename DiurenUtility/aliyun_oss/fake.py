@@ -0,0 +1,352 @@
+# 进程内模拟的 OSS Bucket，实现了存储后端所用到的 oss2.Bucket 接口，
+# 用于在没有阿里云账号的情况下测试、评估存储后端的性能。
+#
+# 用法：
+#     storage = AliyunMediaStorage()
+#     storage.bucket = FakeBucket(latency=0.02)
+#
+# 可以通过 latency（每个请求的延迟，秒）、bandwidth（传输速度，字节/秒）模拟网络环境，
+# 通过 failure_rate 或 fail_next() 注入请求失败。
+# 保存的数据位于匿名内存映射中，不经过 Python 的内存分配器，不计入 tracemalloc 统计的内存，
+# 因而评估存储后端的内存占用时无需扣除模拟 Bucket 中保存的数据。
+
+import base64
+import hashlib
+import mmap
+import random
+import threading
+import time
+from collections import Counter
+
+import six
+from oss2 import Auth, Bucket
+from oss2.exceptions import ServerError, NoSuchKey, NoSuchUpload, InvalidDigest, InvalidArgument
+from oss2.models import SimplifiedObjectInfo, PartInfo
+
+FAKE_END_POINT = 'https://oss-cn-hongkong.aliyuncs.com'
+FAKE_BUCKET_NAME = 'fake-bucket'
+
+# OSS 要求除最后一个分片外，分片大小不小于 100KB
+MULTIPART_MIN_PART_SIZE = 100 * 1024
+
+
+def _error(error_class, status, code, message):
+    return error_class(status, {}, b'', {'Code': code, 'Message': message})
+
+
+def _to_bytes(data) -> bytes:
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    return bytes(data)
+
+
+def _etag(data) -> str:
+    return hashlib.md5(data).hexdigest().upper()
+
+
+class FakeResult:
+    def __init__(self, status=200, **kwargs):
+        self.status = status
+        self.headers = {}
+        self.request_id = ''
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class FakeData:
+    """
+    依次写入 chunks 的只读数据，保存在匿名内存映射中。
+    """
+
+    def __init__(self, chunks, size: int):
+        self.size = size
+        # 无法创建长度为 0 的内存映射
+        self._buffer = mmap.mmap(-1, max(size, 1))
+        for chunk in chunks:
+            self._buffer.write(chunk)
+
+    def __len__(self):
+        return self.size
+
+    def view(self, start: int = 0, end: int = None) -> memoryview:
+        return memoryview(self._buffer)[start:self.size if end is None else end]
+
+    def tobytes(self) -> bytes:
+        return self.view().tobytes()
+
+
+class FakeObjectStream(FakeResult):
+    """
+    get_object 的返回值，与 oss2.models.GetObjectResult 一样可通过 read() 读取内容。
+    """
+
+    def __init__(self, data: memoryview, **kwargs):
+        super().__init__(**kwargs)
+        self._data = data
+        self._offset = 0
+        self.content_length = len(data)
+
+    def read(self, amt=None):
+        end = len(self._data)
+        if amt is not None and amt >= 0:
+            end = min(self._offset + amt, end)
+        chunk = self._data[self._offset:end].tobytes()
+        self._offset = end
+        return chunk
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b'')
+
+
+class FakeObject:
+    def __init__(self, data: FakeData, headers=None):
+        self.data = data
+        self.etag = _etag(data.view())
+        self.last_modified = int(time.time())
+        self.acl = 'default'
+        self.headers = dict(headers or {})
+
+
+class FakeBucket:
+    def __init__(self, bucket_name=FAKE_BUCKET_NAME, end_point=FAKE_END_POINT, latency: float = 0,
+                 bandwidth: float = None, failure_rate: float = 0, seed=None):
+        self.bucket_name = bucket_name
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        # 各类请求的次数
+        self.requests = Counter()
+        # 累计上传的字节数
+        self.bytes_written = 0
+
+        self._objects = {}
+        self._uploads = {}
+        self._failures = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # 签名与生成url均为本地计算，交由真实的 Bucket 完成
+        self._signer = Bucket(Auth('fake-access-key-id', 'fake-access-key-secret'), end_point,
+                              bucket_name)
+
+    # 令接下来的 count 个 operation 请求失败
+    def fail_next(self, operation: str, count: int = 1):
+        with self._lock:
+            self._failures[operation] += count
+
+    def _request(self, operation: str, size: int = 0):
+        with self._lock:
+            self.requests[operation] += 1
+            fail = self._failures[operation] > 0
+            if fail:
+                self._failures[operation] -= 1
+            elif self.failure_rate:
+                fail = self._random.random() < self.failure_rate
+        delay = self.latency
+        if self.bandwidth and size:
+            delay += size / self.bandwidth
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise _error(ServerError, 503, 'ServiceUnavailable', 'Injected failure: ' + operation)
+
+    def _get(self, key) -> FakeObject:
+        try:
+            return self._objects[key]
+        except KeyError:
+            raise _error(NoSuchKey, 404, 'NoSuchKey', 'The specified key does not exist.')
+
+    def _put(self, key, data, headers=None) -> FakeObject:
+        if not isinstance(data, FakeData):
+            data = FakeData([data], len(data))
+        obj = FakeObject(data, headers)
+        with self._lock:
+            self._objects[key] = obj
+            self.bytes_written += len(data)
+        return obj
+
+    @staticmethod
+    def _check_md5(data: bytes, headers):
+        md5 = (headers or {}).get('Content-MD5')
+        if md5 and base64.b64decode(md5) != hashlib.md5(data).digest():
+            raise _error(InvalidDigest, 400, 'InvalidDigest', 'Content-MD5 mismatch.')
+
+    # 对象
+
+    def put_object(self, key, data, headers=None, progress_callback=None):
+        data = _to_bytes(data)
+        self._request('put_object', len(data))
+        self._check_md5(data, headers)
+        obj = self._put(key, data, headers)
+        return FakeResult(etag=obj.etag)
+
+    def get_object(self, key, byte_range=None, headers=None, progress_callback=None,
+                   process=None, params=None):
+        obj = self._get(key)
+        size = len(obj.data)
+        start, end, status = 0, size, 200
+        if byte_range:
+            first, last = byte_range
+            # 与 OSS 一致：范围无效时忽略 Range，返回整个对象
+            if first is None:
+                if last is not None and last > 0:
+                    start, status = max(size - last, 0), 206
+            elif first < size and (last is None or first <= last < size):
+                start, end, status = first, size if last is None else last + 1, 206
+        data = obj.data.view(start, end)
+        self._request('get_object', len(data))
+        return FakeObjectStream(data, status=status, etag=obj.etag,
+                                last_modified=obj.last_modified)
+
+    def head_object(self, key, headers=None, params=None):
+        self._request('head_object')
+        obj = self._get(key)
+        return FakeResult(content_length=len(obj.data), etag=obj.etag,
+                          last_modified=obj.last_modified,
+                          content_type=obj.headers.get('Content-Type'))
+
+    def object_exists(self, key, headers=None):
+        self._request('object_exists')
+        return key in self._objects
+
+    def delete_object(self, key, params=None, headers=None):
+        self._request('delete_object')
+        with self._lock:
+            self._objects.pop(key, None)
+        return FakeResult(status=204)
+
+    def batch_delete_objects(self, key_list, headers=None):
+        if not key_list:
+            raise _error(InvalidArgument, 400, 'InvalidArgument', 'key_list should not be empty')
+        self._request('batch_delete_objects')
+        with self._lock:
+            for key in key_list:
+                self._objects.pop(key, None)
+        return FakeResult(deleted_keys=list(key_list))
+
+    def copy_object(self, source_bucket_name, source_key, target_key, headers=None, params=None):
+        self._request('copy_object')
+        obj = self._get(source_key)
+        obj = self._put(target_key, obj.data, obj.headers)
+        return FakeResult(etag=obj.etag)
+
+    def get_object_acl(self, key, params=None, headers=None):
+        self._request('get_object_acl')
+        return FakeResult(acl=self._get(key).acl)
+
+    def put_object_acl(self, key, permission, params=None, headers=None):
+        self._request('put_object_acl')
+        self._get(key).acl = permission
+        return FakeResult()
+
+    def list_objects(self, prefix='', delimiter='', marker='', max_keys=100, headers=None):
+        self._request('list_objects')
+        with self._lock:
+            objects = sorted((key, obj) for key, obj in self._objects.items()
+                             if key.startswith(prefix))
+        # 按顺序合并为对象与公共前缀，跳过 marker 及其之前的条目
+        entries = []
+        for key, obj in objects:
+            if delimiter:
+                index = key.find(delimiter, len(prefix))
+                if index >= 0:
+                    key, obj = key[:index + len(delimiter)], None
+            if key > marker and not (entries and entries[-1][0] == key):
+                entries.append((key, obj))
+        is_truncated = len(entries) > max_keys
+        entries = entries[:max_keys]
+        object_list = [SimplifiedObjectInfo(key, obj.last_modified, obj.etag, 'Normal',
+                                            len(obj.data), 'Standard')
+                       for key, obj in entries if obj is not None]
+        prefix_list = [key for key, obj in entries if obj is None]
+        return FakeResult(object_list=object_list, prefix_list=prefix_list,
+                          is_truncated=is_truncated,
+                          next_marker=entries[-1][0] if is_truncated else '')
+
+    # 分片上传
+
+    def init_multipart_upload(self, key, headers=None, params=None):
+        self._request('init_multipart_upload')
+        upload_id = hashlib.md5('{key}{time}{rand}'.format(
+            key=key, time=time.time(), rand=self._random.random()).encode()).hexdigest().upper()
+        with self._lock:
+            self._uploads[upload_id] = (key, {})
+        return FakeResult(upload_id=upload_id)
+
+    def _get_upload(self, key, upload_id):
+        upload = self._uploads.get(upload_id)
+        if upload is None or upload[0] != key:
+            raise _error(NoSuchUpload, 404, 'NoSuchUpload', 'The specified upload does not exist.')
+        return upload[1]
+
+    def upload_part(self, key, upload_id, part_number, data, progress_callback=None, headers=None):
+        data = _to_bytes(data)
+        self._request('upload_part', len(data))
+        self._check_md5(data, headers)
+        parts = self._get_upload(key, upload_id)
+        etag = _etag(data)
+        with self._lock:
+            parts[part_number] = (etag, FakeData([data], len(data)))
+            self.bytes_written += len(data)
+        return FakeResult(etag=etag)
+
+    def complete_multipart_upload(self, key, upload_id, parts, headers=None):
+        self._request('complete_multipart_upload')
+        uploaded = self._get_upload(key, upload_id)
+        chunks = []
+        for index, part in enumerate(sorted(parts, key=lambda p: p.part_number)):
+            etag, data = uploaded.get(part.part_number, (None, None))
+            if etag is None or etag != part.etag.strip('"').upper():
+                raise _error(InvalidArgument, 400, 'InvalidPart', 'Part %d is invalid.' %
+                             part.part_number)
+            if index < len(parts) - 1 and len(data) < MULTIPART_MIN_PART_SIZE:
+                raise _error(InvalidArgument, 400, 'EntityTooSmall',
+                             'Part %d is too small.' % part.part_number)
+            chunks.append(data)
+        # 分片直接依次写入新的内存映射，不在内存中拼接
+        obj = FakeObject(FakeData([data.view() for data in chunks], sum(map(len, chunks))))
+        # 分片上传对象的 ETag 与普通上传不同
+        obj.etag = '%s-%d' % (_etag(b''.join(bytes.fromhex(c.etag.strip('"')) for c in parts)),
+                              len(parts))
+        with self._lock:
+            # 分片的数据在上传时已计入 bytes_written
+            self._objects[key] = obj
+            del self._uploads[upload_id]
+        return FakeResult(etag=obj.etag)
+
+    def abort_multipart_upload(self, key, upload_id, headers=None):
+        self._request('abort_multipart_upload')
+        self._get_upload(key, upload_id)
+        with self._lock:
+            del self._uploads[upload_id]
+        return FakeResult(status=204)
+
+    def list_parts(self, key, upload_id, marker='', max_parts=1000, headers=None):
+        self._request('list_parts')
+        parts = self._get_upload(key, upload_id)
+        return FakeResult(parts=[PartInfo(number, etag, size=len(data))
+                                 for number, (etag, data) in sorted(parts.items())],
+                          is_truncated=False, next_marker='')
+
+    # url
+
+    def sign_url(self, method, key, expires, headers=None, params=None, slash_safe=False,
+                 additional_headers=None):
+        return self._signer.sign_url(method, key, expires, headers=headers, params=params)
+
+    def _make_url(self, bucket_name, key):
+        return self._signer._make_url(bucket_name, key)
+
+    # 模拟环境中的状态
+
+    @property
+    def object_count(self) -> int:
+        return len(self._objects)
+
+    @property
+    def pending_upload_count(self) -> int:
+        return len(self._uploads)
+
+    def get_data(self, key) -> bytes:
+        return self._get(key).data.tobytes()
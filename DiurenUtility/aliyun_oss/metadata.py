@@ -0,0 +1,82 @@
+# OSS 对象元数据缓存
+# 缓存 HEAD 请求得到的对象大小、修改时间与 ETag，以减少 size、get_modified_time 等操作重复发送的 HEAD 请求。
+# 只缓存对象存在的结果：对象可能随时被其它进程写入，缓存“不存在”会使 exists 返回过期的结果，
+# 进而使 get_available_name 选中已被占用的名称并覆盖其它进程刚写入的对象。
+# 进程内使用 LRU 缓存；可选同时使用 Django 缓存，使多个进程共享缓存并在写入时一同失效。
+
+import collections
+import hashlib
+import threading
+import time
+
+from django.core.cache import caches
+from django.utils.encoding import force_bytes
+
+ObjectMetadata = collections.namedtuple('ObjectMetadata', ('size', 'last_modified', 'etag'))
+
+# 表示对象不存在的值，不会被缓存
+MISSING = 'missing'
+
+
+class ObjectMetadataCache:
+    def __init__(self, max_size: int, expire: int, cache_alias: str = None,
+                 key_prefix: str = 'oss-meta:'):
+        self.max_size = max_size
+        self.expire = expire
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, bucket_name, key):
+        digest = hashlib.md5(force_bytes(bucket_name + '/' + key)).hexdigest()
+        return self.key_prefix + digest
+
+    @property
+    def _shared_cache(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    '''
+    获取缓存的对象元数据，未缓存时返回 None
+    '''
+    def get(self, bucket_name, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((bucket_name, key))
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end((bucket_name, key))
+                    return value
+                del self._entries[(bucket_name, key)]
+        if self._shared_cache is not None:
+            value = self._shared_cache.get(self._cache_key(bucket_name, key))
+            if value is not None:
+                value = ObjectMetadata(*value)
+                self._set_local(bucket_name, key, value)
+                return value
+        return None
+
+    def set(self, bucket_name, key, value: ObjectMetadata):
+        self._set_local(bucket_name, key, value)
+        if self._shared_cache is not None:
+            self._shared_cache.set(self._cache_key(bucket_name, key), tuple(value), self.expire)
+
+    def _set_local(self, bucket_name, key, value):
+        with self._lock:
+            self._entries[(bucket_name, key)] = (time.monotonic() + self.expire, value)
+            self._entries.move_to_end((bucket_name, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bucket_name, keys):
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._entries.pop((bucket_name, key), None)
+        if self._shared_cache is not None:
+            self._shared_cache.delete_many([self._cache_key(bucket_name, key) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -6,26 +6,38 @@
 # Configure OSS keys in settings.py
 # Bucket ACL should be set to PRIVATE
 
+import base64
+import collections
+import concurrent.futures
 import datetime
+import hashlib
 import os
+import time
 
 import six
 import posixpath
 
 from urllib.parse import urljoin
 
+from django.core.cache import cache
 from django.core.files import File
 from django.utils.encoding import force_text, force_bytes
-from oss2 import Auth, Service, Bucket, ObjectIterator, OBJECT_ACL_PUBLIC_READ
-from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
+from oss2 import Auth, Service, Bucket, ObjectIterator, OBJECT_ACL_PUBLIC_READ, determine_part_size
+from django.core.exceptions import SuspiciousOperation
 from django.core.files.storage import Storage
 from django.conf import settings
-from oss2.api import _normalize_endpoint
+from oss2.exceptions import NotFound
 from oss2.models import PartInfo
 
 import logging
 
-from DiurenUtility.apps import logger, CONTENT_DISPOSITION_INLINE_FILE_EXTS, OSS_SIGNED_URL_EXPIRE
+from DiurenUtility.aliyun_oss.client import get_config, get_bucket, get_auth, get_service, \
+    get_metadata_cache
+from DiurenUtility.aliyun_oss.metadata import ObjectMetadata, MISSING
+from DiurenUtility.apps import logger, CONTENT_DISPOSITION_INLINE_FILE_EXTS, OSS_SIGNED_URL_EXPIRE, \
+    OSS_SIGNED_URL_CACHE_EXPIRE, OSS_SIGNED_URL_CACHE_PREFIX, OSS_MULTIPART_THRESHOLD, \
+    OSS_MULTIPART_PART_SIZE, OSS_MULTIPART_THREADS, OSS_MULTIPART_MAX_IN_FLIGHT, OSS_READ_AHEAD_SIZE, \
+    OSS_BATCH_DELETE_SIZE, OSS_LIST_PAGE_SIZE
 from DiurenUtility.utility import gen_random_char_string
 
 
@@ -50,6 +62,18 @@ def _make_content_headers(name):
     return params
 
 
+# iter_dir 返回的条目；name 为相对于所列目录的名称，path 为存储名称（目录以 / 结尾）
+StorageEntry = collections.namedtuple('StorageEntry',
+                                      ('name', 'path', 'is_dir', 'size', 'last_modified'))
+
+
+# 分片上传所得对象的 ETag：各分片 MD5 的二进制摘要依次拼接后取 MD5，再附上分片数
+def multipart_etag(part_md5s) -> str:
+    part_md5s = list(part_md5s)
+    digest = hashlib.md5(b''.join(bytes.fromhex(md5) for md5 in part_md5s)).hexdigest()
+    return '{digest}-{count}'.format(digest=digest.upper(), count=len(part_md5s))
+
+
 class AliyunBaseStorage(Storage):
     """
     Aliyun OSS2 Storage
@@ -59,30 +83,40 @@ class AliyunBaseStorage(Storage):
     base_url = ''
 
     def __init__(self):
-        self.access_key_id = self._get_config('ACCESS_KEY_ID')
-        self.access_key_secret = self._get_config('ACCESS_KEY_SECRET')
-        self.end_point = _normalize_endpoint(self._get_config('END_POINT').strip())
-        self.bucket_name = self._get_config('BUCKET_NAME')
-        self.cname = self._get_config('ALIYUN_OSS_CNAME')
+        # 客户端由 client 模块在第一次访问 OSS 时创建，并由所有存储后端共享
+        self._bucket = None
 
-        self.auth = Auth(self.access_key_id, self.access_key_secret)
-        self.service = Service(self.auth, self.end_point)
+        self.multipart_threshold = self._get_config('MULTIPART_THRESHOLD', OSS_MULTIPART_THRESHOLD)
+        self.multipart_part_size = self._get_config('MULTIPART_PART_SIZE', OSS_MULTIPART_PART_SIZE)
+        self.multipart_threads = self._get_config('MULTIPART_THREADS', OSS_MULTIPART_THREADS)
+        self.multipart_max_in_flight = max(
+            self._get_config('MULTIPART_MAX_IN_FLIGHT', OSS_MULTIPART_MAX_IN_FLIGHT),
+            self.multipart_threads)
 
-        self.bucket = self._get_bucket(self.auth)
-        self.bucket = self._get_bucket(self.auth)
+    @property
+    def bucket(self) -> Bucket:
+        if self._bucket is None:
+            return get_bucket()
+        return self._bucket
 
-    def _get_bucket(self, auth):
-        if self.cname:
-            return Bucket(auth, self.cname, self.bucket_name, is_cname=True)
-        else:
-            return Bucket(auth, self.end_point, self.bucket_name)
+    # 可替换为其它 Bucket 对象，例如 fake.FakeBucket
+    @bucket.setter
+    def bucket(self, bucket):
+        self._bucket = bucket
 
-    @staticmethod
-    def _get_config(name):
-        try:
-            return settings.ALIYUN_OSS_STORAGE[name]
-        except KeyError:
-            raise ImproperlyConfigured("Can't find config for '%s' in setting.py" % name)
+    @property
+    def bucket_name(self) -> str:
+        return self.bucket.bucket_name
+
+    @property
+    def auth(self) -> Auth:
+        return get_auth()
+
+    @property
+    def service(self) -> Service:
+        return get_service()
+
+    _get_config = staticmethod(get_config)
 
     @staticmethod
     def _clean_name(name):
@@ -123,6 +157,17 @@ class AliyunBaseStorage(Storage):
         name = self._normalize_name(self._clean_name(name))
         return name
 
+    # 存储名称（相对于 location）与 OSS 对象 key 之间的转换
+
+    def get_object_key(self, name):
+        return self._get_target_name(name)
+
+    def get_object_name(self, key):
+        base_path = force_text(self.location).strip('/')
+        if base_path and key.startswith(base_path + '/'):
+            return key[len(base_path) + 1:]
+        return key
+
     def _open(self, name, mode='rb'):
         name = self._get_target_name(name)
         logger.debug('OSS存储后端：打开文件 {name}，模式 {mode}'.format(name=name, mode=mode))
@@ -138,35 +183,93 @@ class AliyunBaseStorage(Storage):
 
         content.open()
 
-        # 默认分片大小 1MB
-        DEFAULT_CHUNK_SIZE = 1 * 1024 * 1024
-
         logger.debug('OSS存储后端：读取完成，文件大小 %d' % content.size)
-        if not content.multiple_chunks(chunk_size=DEFAULT_CHUNK_SIZE):
+        if content.size <= self.multipart_threshold:
             logger.debug('OSS存储后端：不分片，开始上传')
             # 不分片
-            content_str = content.file.read()
+            content_str = content.read()
             self.bucket.put_object(target_name, content_str)
         else:
-            logger.debug('OSS存储后端：分片，开始上传')
             # 改用分片上传方式
-            upload_id = self.bucket.init_multipart_upload(target_name).upload_id
-            parts = []
-            part_id = 1
-
-            for chunk in content.chunks(chunk_size=DEFAULT_CHUNK_SIZE):
-                # TODO Create an API endpoint for getting uploading process
-                result = self.bucket.upload_part(target_name, upload_id, part_id, chunk)
-                parts.append(
-                    PartInfo(part_id, result.etag))
-                part_id += 1
-                logger.debug('OSS存储后端：上传分片 #%d' % part_id)
-            result = self.bucket.complete_multipart_upload(target_name, upload_id, parts)
+            self._save_multipart(target_name, content)
 
         logger.debug('OSS存储后端：上传完毕，关闭文件')
         content.close()
+        self._objects_changed([name])
         return self._clean_name(name)
 
+    '''
+    并发分片上传
+    按文件大小确定分片大小（保证分片数不超过 OSS 上限），由主线程顺序读取分片并提交到线程池上传，
+    同时在内存中的分片数不超过 multipart_max_in_flight。任一分片上传失败时取消分片上传，避免残留分片。
+    '''
+    def _save_multipart(self, target_name, content: File):
+        part_size = determine_part_size(content.size, self.multipart_part_size)
+        logger.debug('OSS存储后端：分片，开始上传，分片大小 %d' % part_size)
+        upload_id = self.bucket.init_multipart_upload(target_name).upload_id
+
+        def upload_part(part_id, data):
+            result = self.bucket.upload_part(target_name, upload_id, part_id, data)
+            logger.debug('OSS存储后端：上传分片 #%d' % part_id)
+            return PartInfo(part_id, result.etag, size=len(data))
+
+        parts = []
+        in_flight = set()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.multipart_threads) as executor:
+                try:
+                    for part_id, chunk in enumerate(content.chunks(chunk_size=part_size), 1):
+                        if len(in_flight) >= self.multipart_max_in_flight:
+                            done, in_flight = concurrent.futures.wait(
+                                in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                            parts.extend(future.result() for future in done)
+                        in_flight.add(executor.submit(upload_part, part_id, chunk))
+                    parts.extend(future.result() for future in in_flight)
+                except BaseException:
+                    for future in in_flight:
+                        future.cancel()
+                    raise
+            parts.sort(key=lambda part: part.part_number)
+            self.bucket.complete_multipart_upload(target_name, upload_id, parts)
+        except BaseException:
+            logger.warning('OSS存储后端：分片上传失败，取消上传 %s' % target_name)
+            self.bucket.abort_multipart_upload(target_name, upload_id)
+            raise
+
+    def open_writer(self, name, part_size: int):
+        return AliyunFileWriter(self, name, part_size)
+
+    # 分片上传接口，供需要跨请求持久化上传进度的调用方（如断点续传）使用
+
+    def init_multipart_upload(self, name) -> str:
+        name = self._get_target_name(name)
+        logger.debug('OSS存储后端：初始化分片上传 %s' % name)
+        return self.bucket.init_multipart_upload(name).upload_id
+
+    def upload_part(self, name, upload_id: str, part_number: int, data, md5: str = None) -> str:
+        name = self._get_target_name(name)
+        headers = None
+        if md5:
+            # OSS 会校验 Content-MD5（Base64 编码的二进制摘要）
+            headers = {'Content-MD5': base64.b64encode(bytes.fromhex(md5)).decode()}
+        result = self.bucket.upload_part(name, upload_id, part_number, data, headers=headers)
+        logger.debug('OSS存储后端：上传分片 %s #%d' % (name, part_number))
+        return result.etag
+
+    # 返回合并所得对象的 ETag（大写，不带引号）
+    def complete_multipart_upload(self, name, upload_id: str, parts) -> str:
+        target_name = self._get_target_name(name)
+        parts = [PartInfo(part_number, etag) for part_number, etag in parts]
+        result = self.bucket.complete_multipart_upload(target_name, upload_id, parts)
+        self._objects_changed([name])
+        logger.debug('OSS存储后端：完成分片上传 %s' % target_name)
+        return result.etag.strip('"').upper()
+
+    def abort_multipart_upload(self, name, upload_id: str):
+        name = self._get_target_name(name)
+        self.bucket.abort_multipart_upload(name, upload_id)
+        logger.debug('OSS存储后端：取消分片上传 %s' % name)
+
     def get_file_header(self, name):
         name = self._get_target_name(name)
         return self.bucket.head_object(name)
@@ -179,17 +282,36 @@ class AliyunBaseStorage(Storage):
         name = self._get_target_name(name)
         return self.bucket.put_object_acl(name, acl)
 
+    # 通过元数据缓存获取对象信息，未命中或 use_cache 为 False 时发送 HEAD 请求；对象不存在时返回 MISSING
+    # 缓存中只保存对象存在的结果
+    def _head(self, target_name, use_cache=True):
+        metadata_cache = get_metadata_cache()
+        metadata = metadata_cache.get(self.bucket_name, target_name) if use_cache else None
+        if metadata is None:
+            try:
+                header = self.bucket.head_object(target_name)
+            except NotFound:
+                metadata_cache.invalidate(self.bucket_name, [target_name])
+                return MISSING
+            metadata = ObjectMetadata(header.content_length, header.last_modified, header.etag)
+            metadata_cache.set(self.bucket_name, target_name, metadata)
+        return metadata
+
+    def get_metadata(self, name):
+        metadata = self._head(self._get_target_name(name))
+        if metadata == MISSING:
+            raise FileNotFoundError(name)
+        return metadata
+
+    # 不使用缓存：其它进程可能刚写入或删除了该对象，get_available_name 等依赖最新的结果
     def exists(self, name):
-        name = self._get_target_name(name)
-        return self.bucket.object_exists(name)
+        return self._head(self._get_target_name(name), use_cache=False) != MISSING
 
     def size(self, name):
-        file_info = self.get_file_header(name)
-        return file_info.content_length
+        return self.get_metadata(name).size
 
     def get_modified_time(self, name):
-        file_info = self.get_file_header(name)
-        return self._datetime_from_timestamp(file_info.last_modified)
+        return self._datetime_from_timestamp(self.get_metadata(name).last_modified)
 
     def _datetime_from_timestamp(self, ts):
         """
@@ -203,73 +325,207 @@ class AliyunBaseStorage(Storage):
             return datetime.datetime.fromtimestamp(ts)
 
     def listdir(self, name):
-        name = self._get_target_name(name)
-        logger.debug('OSS存储后端：列目录 {path}'.format(path=name))
-        if name and name.endswith('/'):
-            name = name[:-1]
-
-        files = []
-        dirs = set()
+        dirs, files = [], []
+        for entry in self.iter_dir(name):
+            (dirs if entry.is_dir else files).append(entry.name)
+        return dirs, files
 
-        for obj in ObjectIterator(self.bucket, prefix=name, delimiter='/'):
+    '''
+    逐个返回目录下的条目，每次只向 OSS 请求一页，不在内存中累积全部结果
+    :param name: 目录名称
+    :param start_after: 可选，从该存储名称之后开始列举；中断后传入最后一个条目的 path 即可继续
+    :param page_size: 可选，每个请求返回的条目数
+    :param recursive: 可选，为 True 时返回所有子目录中的文件，而不是子目录本身
+    '''
+    def iter_dir(self, name, start_after: str = '', page_size: int = OSS_LIST_PAGE_SIZE,
+                 recursive: bool = False):
+        prefix = self._get_target_name(name)
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        marker = self._get_target_name(start_after) if start_after else ''
+        if start_after.endswith('/') and not marker.endswith('/'):
+            marker += '/'
+        logger.debug('OSS存储后端：列目录 {path}，起始 {marker}'.format(path=prefix, marker=marker))
+
+        for obj in ObjectIterator(self.bucket, prefix=prefix, delimiter='' if recursive else '/',
+                                  marker=marker, max_keys=page_size):
+            if not obj.is_prefix() and obj.key.endswith('/'):
+                # 目录本身（递归列举时还有子目录）的占位对象
+                continue
+            path = self.get_object_name(obj.key)
             if obj.is_prefix():
-                dirs.add(obj.key)
+                yield StorageEntry(obj.key[len(prefix):].rstrip('/'), path, True, None, None)
             else:
-                files.append(obj.key)
-
-        return list(dirs), files
+                yield StorageEntry(obj.key[len(prefix):], path, False, obj.size,
+                                   self._datetime_from_timestamp(obj.last_modified))
 
     '''
     根据文件key生成对应的访问url
     :param name: 要生成链接的文件key
     :param virtual_name: 可选，指定下载文件名称，仅在签名且文件扩展名不属于直接显示类别（如图片）时生效
     :param sign: 可选，是否需要对url进行签名。对于访问ACL为私有的文件，必须签名访问
+    签名url会被缓存，在临近过期前重复使用；文件被覆盖或删除时缓存失效
     '''
     def url(self, name, virtual_name: str = None, sign: bool = True):
-        name = self._get_target_name(name)
-        logger.debug('OSS存储后端：生成url {path}，签名：{sign}'.format(path=name, sign=sign))
-        params = dict()
-        if not virtual_name:
-            virtual_name = name
-        params.update(_make_content_headers(virtual_name))
-        if sign:
-            return self.bucket.sign_url('GET', name, OSS_SIGNED_URL_EXPIRE,
-                                        params=params)  # default access link expire time: 5min
-        else:
-            return self.bucket._make_url(self.bucket_name, name)
+        return self.urls([(name, virtual_name)], sign=sign)[0]
+
+    # 批量生成访问url，items 为 (文件key, 下载文件名称) 列表，返回顺序与 items 一致
+    def urls(self, items, sign: bool = True) -> list:
+        targets = []
+        for name, virtual_name in items:
+            name = self._get_target_name(name)
+            params = _make_content_headers(virtual_name or name)
+            targets.append((name, params))
+        if not sign:
+            return [self.bucket._make_url(self.bucket_name, name) for name, params in targets]
+
+        # 缓存键包含文件的版本号，覆盖或删除文件时更新版本号，即可使该文件的所有url缓存失效
+        versions = self._get_url_versions([name for name, params in targets])
+        keys = [self._url_cache_key(name, params, versions[name]) for name, params in targets]
+        cached = cache.get_many(keys)
+        result, missing = [], {}
+        for key, (name, params) in zip(keys, targets):
+            url = cached.get(key)
+            if url is None:
+                logger.debug('OSS存储后端：生成url {path}'.format(path=name))
+                # default access link expire time: 5min
+                url = self.bucket.sign_url('GET', name, OSS_SIGNED_URL_EXPIRE, params=params)
+                missing[key] = url
+            result.append(url)
+        if missing:
+            cache.set_many(missing, OSS_SIGNED_URL_CACHE_EXPIRE)
+        return result
+
+    def _url_version_key(self, target_name):
+        digest = hashlib.md5(force_bytes(self.bucket_name + '/' + target_name)).hexdigest()
+        return OSS_SIGNED_URL_CACHE_PREFIX + 'version:' + digest
+
+    def _url_cache_key(self, target_name, params, version):
+        raw = '\n'.join((self.bucket_name, target_name, params['response-content-disposition']))
+        digest = hashlib.md5(force_bytes(raw)).hexdigest()
+        return '{prefix}{digest}:{version}'.format(prefix=OSS_SIGNED_URL_CACHE_PREFIX, digest=digest,
+                                                   version=version)
+
+    def _get_url_versions(self, target_names) -> dict:
+        keys = {self._url_version_key(name): name for name in target_names}
+        versions = cache.get_many(keys)
+        return {name: versions.get(key, 0) for key, name in keys.items()}
+
+    # 对象被写入、覆盖或删除后，使其url缓存与元数据缓存失效
+    def _objects_changed(self, names):
+        names = list(names)
+        self.invalidate_urls(names)
+        get_metadata_cache().invalidate(self.bucket_name,
+                                        [self._get_target_name(name) for name in names])
+
+    def invalidate_url(self, name):
+        self.invalidate_urls([name])
+
+    def invalidate_urls(self, names):
+        target_names = [self._get_target_name(name) for name in names]
+        # 以时间戳作为版本号，不会与此前任何版本重复；保存时间长于url缓存，保证旧url缓存先过期
+        version = int(time.time() * 1e6)
+        cache.set_many({self._url_version_key(name): version for name in target_names},
+                       OSS_SIGNED_URL_CACHE_EXPIRE * 2)
+        logger.debug('OSS存储后端：url缓存失效 {paths}'.format(paths=target_names))
 
     def read(self, name):
         pass
 
     def delete(self, name):
-        name = self._get_target_name(name)
-        result = self.bucket.delete_object(name)
+        target_name = self._get_target_name(name)
+        result = self.bucket.delete_object(target_name)
         if result.status >= 400:
             raise AliyunOperationError(result.resp)
+        self._objects_changed([name])
+
+    '''
+    批量删除文件
+    每个请求最多删除 OSS_BATCH_DELETE_SIZE 个对象，超过时分为多个请求并发执行
+    '''
+    def delete_many(self, names):
+        names = list(dict.fromkeys(names))
+        if not names:
+            return
+        target_names = [self._get_target_name(name) for name in names]
+        batches = [target_names[i:i + OSS_BATCH_DELETE_SIZE]
+                   for i in range(0, len(target_names), OSS_BATCH_DELETE_SIZE)]
+
+        def delete_batch(keys):
+            self.bucket.batch_delete_objects(keys)
+            logger.debug('OSS存储后端：批量删除 %d 个文件' % len(keys))
+
+        if len(batches) == 1:
+            delete_batch(batches[0])
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.multipart_threads) as executor:
+                # 任一请求失败时抛出异常
+                list(executor.map(delete_batch, batches))
+        self._objects_changed(names)
 
     def copy(self, source, target):
-        source = self._get_target_name(source)
-        target = self._get_target_name(target)
+        source_key = self._get_target_name(source)
+        target_key = self._get_target_name(target)
 
-        result = self.bucket.copy_object(self.bucket.bucket_name, source, target)
+        result = self.bucket.copy_object(self.bucket.bucket_name, source_key, target_key)
         if result.status >= 400:
             raise AliyunOperationError(result.resp)
+        self._objects_changed([target])
+
+
+# 名称索引：由应用登记其在某一路径前缀下已占用的存储名称（例如数据库中记录的文件路径），
+# 为该前缀下的文件分配名称时只需查询索引，无需逐个向 OSS 发送 HEAD 请求
+# taken_names 接受名称列表，返回其中已被占用的名称集合；
+# reserve_name 原子地预留一个名称（例如插入一条带唯一约束的记录），名称已被占用时返回 False，
+# 使并发分配的进程不会得到同一个名称
+_name_indexes = {}
+
+NameIndex = collections.namedtuple('NameIndex', ('taken_names', 'reserve_name'))
+
+
+def register_name_index(prefix: str, taken_names, reserve_name):
+    _name_indexes[prefix] = NameIndex(taken_names, reserve_name)
+
+
+def get_name_index(name: str):
+    for prefix, index in _name_indexes.items():
+        if name.startswith(prefix):
+            return index
+    return None
 
 
 class AliyunMediaStorage(AliyunBaseStorage):
     base_url = settings.MEDIA_URL
     location = settings.MEDIA_ROOT
 
-    def _save(self, name, content: File):
-        name = self.get_available_name(name)
-        return super()._save(name, content)
+    # 名称冲突时，每次查询名称索引所生成的候选名称数
+    available_name_candidates = 5
 
     def get_available_name(self, name, max_length=None):
-        while self.exists(name):
-            name, ext = os.path.splitext(name)
-            name += '_' + gen_random_char_string(5) + ext
-            logger.info('OSS存储后端：文件名重复，生成文件名 {name}'.format(name=name))
-        return name
+        index = get_name_index(self._clean_name(name))
+        if index is None:
+            # 没有登记名称索引的路径，通过 OSS 检查
+            while self.exists(name):
+                name = self._alternative_name(name)
+                logger.info('OSS存储后端：文件名重复，生成文件名 {name}'.format(name=name))
+            return name
+
+        candidates = [name]
+        while True:
+            taken = index.taken_names(candidates)
+            for candidate in candidates:
+                # 查询索引与预留之间名称可能已被其它进程取得，预留失败时尝试下一个候选名称
+                if candidate not in taken and index.reserve_name(candidate):
+                    if candidate != name:
+                        logger.info('OSS存储后端：文件名重复，生成文件名 {name}'.format(name=candidate))
+                    return candidate
+            candidates = [self._alternative_name(name)
+                          for _i in range(self.available_name_candidates)]
+
+    @staticmethod
+    def _alternative_name(name):
+        name, ext = os.path.splitext(name)
+        return name + '_' + gen_random_char_string(5) + ext
 
 
 class AliyunStaticStorage(AliyunBaseStorage):
@@ -284,6 +540,12 @@ class AliyunStaticStorage(AliyunBaseStorage):
 
 
 class AliyunFile(File):
+    """
+    OSS 对象的文件接口。读取时按需发起 Range 请求，并预读至多 OSS_READ_AHEAD_SIZE 字节，
+    支持 read(n)、seek、tell、chunks() 与逐行迭代，内存占用与对象大小无关。
+    写入模式下内容先写入内存，关闭时保存。
+    """
+
     def __init__(self, name, storage, mode):
         self._storage = storage
         # self._name = name[len(self._storage.location):]
@@ -291,19 +553,70 @@ class AliyunFile(File):
         self._mode = mode
         self.file = six.BytesIO()
         self._is_dirty = False
-        self._is_read = False
+        self._size = None
+        self._pos = 0
+        # 预读缓冲区及其在对象中的起始位置
+        self._buffer = b''
+        self._buffer_start = 0
         super(AliyunFile, self).__init__(self.file, self._name)
 
-    def read(self, num_bytes=None):
-        if not self._is_read:
-            content = self._storage.bucket.get_object(self._name)
-            self.file = six.BytesIO(content.read())
-            self._is_read = True
-
-        if num_bytes is None:
-            data = self.file.read()
+    @property
+    def size(self):
+        if 'w' in self._mode:
+            return len(self.file.getvalue())
+        if self._size is None:
+            metadata = self._storage._head(self._name)
+            if metadata == MISSING:
+                raise FileNotFoundError(self._name)
+            self._size = metadata.size
+        return self._size
+
+    def tell(self):
+        if 'w' in self._mode:
+            return self.file.tell()
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if 'w' in self._mode:
+            return self.file.seek(offset, whence)
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def _get_range(self, start, end):
+        logger.debug('OSS存储后端：读取 {name} {start}-{end}'.format(name=self._name, start=start,
+                                                                end=end))
+        return self._storage.bucket.get_object(self._name, byte_range=(start, end)).read()
+
+    def _read_range(self, num_bytes):
+        # 超出对象末尾的 Range 请求会使 OSS 返回整个对象，因此先按对象大小截断
+        end = self.size if num_bytes is None else min(self._pos + num_bytes, self.size)
+        if self._pos >= end:
+            return b''
+        buffer_end = self._buffer_start + len(self._buffer)
+        if self._buffer_start <= self._pos and end <= buffer_end:
+            data = self._buffer[self._pos - self._buffer_start:end - self._buffer_start]
+        elif end - self._pos >= OSS_READ_AHEAD_SIZE:
+            # 大块读取不经过缓冲区
+            data = self._get_range(self._pos, end - 1)
         else:
+            fetch_end = min(self._pos + OSS_READ_AHEAD_SIZE, self.size)
+            self._buffer = self._get_range(self._pos, fetch_end - 1)
+            self._buffer_start = self._pos
+            data = self._buffer[:end - self._pos]
+        self._pos += len(data)
+        return data
+
+    def read(self, num_bytes=None):
+        if 'w' in self._mode:
             data = self.file.read(num_bytes)
+        else:
+            data = self._read_range(None if num_bytes is None or num_bytes < 0 else num_bytes)
 
         if 'b' in self._mode:
             return data
@@ -316,10 +629,60 @@ class AliyunFile(File):
 
         self.file.write(force_bytes(content))
         self._is_dirty = True
-        self._is_read = True
 
     def close(self):
         if self._is_dirty:
             self.file.seek(0)
             self._storage._save(self._name, self.file)
         self.file.close()
+        self._buffer = b''
+
+
+class AliyunFileWriter:
+    """
+    逐块写入 OSS 对象：数据先在内存中累积至 part_size，再作为一个分片上传，
+    内存占用不超过一个分片的大小。若总大小不足一个分片，则在 close 时以普通方式上传。
+    """
+
+    def __init__(self, storage, name, part_size: int):
+        self._storage = storage
+        self.name = storage.get_available_name(name)
+        self._target_name = storage._get_target_name(self.name)
+        self._part_size = part_size
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def _upload_part(self, data):
+        bucket = self._storage.bucket
+        if self._upload_id is None:
+            self._upload_id = bucket.init_multipart_upload(self._target_name).upload_id
+        part_id = len(self._parts) + 1
+        result = bucket.upload_part(self._target_name, self._upload_id, part_id, data)
+        self._parts.append(PartInfo(part_id, result.etag))
+        logger.debug('OSS存储后端：上传分片 #%d' % part_id)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+
+    def close(self):
+        bucket = self._storage.bucket
+        if self._upload_id is None:
+            bucket.put_object(self._target_name, bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            bucket.complete_multipart_upload(self._target_name, self._upload_id, self._parts)
+        self._buffer = bytearray()
+        self._storage._objects_changed([self.name])
+        logger.debug('OSS存储后端：写入完毕 %s' % self._target_name)
+        return self._storage._clean_name(self.name)
+
+    def abort(self):
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self._storage.bucket.abort_multipart_upload(self._target_name, self._upload_id)
+            self._upload_id = None
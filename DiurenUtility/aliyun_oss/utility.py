@@ -4,21 +4,19 @@ import hmac
 import json
 import time
 from hashlib import sha1 as sha
+from urllib.parse import unquote
+from urllib.request import urlopen
 
-import oss2
-# from django.conf import settings
-
-from durian_cms import settings
-
-auth = oss2.Auth(settings.ALIYUN_OSS_STORAGE['ACCESS_KEY_ID'],
-                 settings.ALIYUN_OSS_STORAGE['ACCESS_KEY_SECRET'])
-bucket = oss2.Bucket(auth, settings.ALIYUN_OSS_STORAGE['END_POINT'],
-                     settings.ALIYUN_OSS_STORAGE['BUCKET_NAME'])
+from Crypto.Hash import MD5
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
 
+from DiurenUtility.aliyun_oss.client import get_bucket, get_config
+from DiurenUtility.apps import logger
 
 def get_signed_url(object_path: str, method: str = 'GET', expires: int = 5 * 60, headers=None,
                    params=None):
-    return bucket.sign_url(method.upper(), object_path, expires, headers, params)
+    return get_bucket().sign_url(method.upper(), object_path, expires, headers, params)
 
 
 # Author: Aliyun
@@ -32,39 +30,108 @@ def _get_iso_8601(expire):
     return gmt
 
 
-def get_token(object_path: str, expires: int = 5 * 60, callback_url: str = None):
+'''
+生成浏览器直传OSS（PostObject）所需的签名信息
+:param object_path: 允许上传的对象key；exact 为 False 时为允许上传的key前缀
+:param size: 可选，限定上传文件的大小（字节）
+:param callback_url: 可选，上传完成后OSS回调的地址
+:param callback_body: 可选，回调请求体，可使用OSS系统变量如 ${object} ${size} ${contentMd5}
+'''
+
+
+def get_token(object_path: str, expires: int = 5 * 60, callback_url: str = None,
+              size: int = None, exact: bool = False, callback_body: str = None):
     now = int(time.time())
     expire_syncpoint = now + expires
     expire = _get_iso_8601(expire_syncpoint)
 
     policy_dict = {'expiration': expire}
     condition_array = []
-    array_item = ['starts-with', '$key', object_path]
+    if exact:
+        array_item = ['eq', '$key', object_path]
+    else:
+        array_item = ['starts-with', '$key', object_path]
     condition_array.append(array_item)
+    if size is not None:
+        condition_array.append(['content-length-range', size, size])
     policy_dict['conditions'] = condition_array
     policy = json.dumps(policy_dict).strip()
     policy_encode = base64.b64encode(policy.encode())
-    h = hmac.new(settings.ALIYUN_OSS_STORAGE['ACCESS_KEY_SECRET'].encode(), policy_encode, sha)
+    h = hmac.new(get_config('ACCESS_KEY_SECRET').encode(), policy_encode, sha)
     sign_result = base64.encodebytes(h.digest()).strip()
 
-    token_dict = {'accessid': settings.ALIYUN_OSS_STORAGE['ACCESS_KEY_ID'],
-                  'host': settings.ALIYUN_OSS_STORAGE['END_POINT'],
+    bucket = get_bucket()
+    token_dict = {'accessid': get_config('ACCESS_KEY_ID'),
+                  'host': bucket._make_url(bucket.bucket_name, ''),
                   'policy': policy_encode.decode(),
                   'signature': sign_result.decode(),
                   'expire': expire_syncpoint,
                   'dir': object_path}
+    if exact:
+        token_dict['key'] = object_path
 
     if callback_url:
+        if callback_body is None:
+            callback_body = 'filename=${object}&size=${size}'
         callback_dict = {'callbackUrl': callback_url,
-                         'callbackBody': 'filename=${object}&size=${size}',
+                         'callbackBody': callback_body,
                          'callbackBodyType': 'application/x-www-form-urlencoded'}
         callback_param = json.dumps(callback_dict).strip()
         base64_callback_body = base64.b64encode(callback_param.encode())
         token_dict['callback'] = base64_callback_body.decode()
 
-    result = json.dumps(token_dict)
-    return result
+    return token_dict
+
+
+# OSS回调签名所用公钥只能从以下地址获取
+OSS_CALLBACK_PUBLIC_KEY_URL_PREFIXES = ('http://gosspublic.alicdn.com/',
+                                        'https://gosspublic.alicdn.com/')
+
+_callback_public_keys = {}
+
+
+def _get_callback_public_key(url: str):
+    if url not in _callback_public_keys:
+        with urlopen(url, timeout=5) as response:
+            _callback_public_keys[url] = RSA.importKey(response.read())
+    return _callback_public_keys[url]
+
+
+# Author: Aliyun
+# https://help.aliyun.com/document_detail/31989.html
+
+'''
+验证OSS上传回调请求的签名
+:param path: 回调请求的路径
+:param query_string: 回调请求的查询字符串
+:param body: 回调请求体
+:param authorization: 请求头 Authorization
+:param pub_key_url: 请求头 x-oss-pub-key-url
+'''
+
+
+def verify_callback(path: str, query_string: str, body: bytes, authorization: str,
+                    pub_key_url: str) -> bool:
+    try:
+        pub_key_url = base64.b64decode(pub_key_url).decode()
+        signature = base64.b64decode(authorization)
+    except (ValueError, TypeError):
+        return False
+    if not pub_key_url.startswith(OSS_CALLBACK_PUBLIC_KEY_URL_PREFIXES):
+        logger.warning('OSS回调：非法的公钥地址 {url}'.format(url=pub_key_url))
+        return False
+    try:
+        public_key = _get_callback_public_key(pub_key_url)
+    except (OSError, ValueError):
+        logger.warning('OSS回调：获取公钥失败 {url}'.format(url=pub_key_url))
+        return False
+
+    sign_str = unquote(path)
+    if query_string:
+        sign_str += '?' + query_string
+    sign_bytes = sign_str.encode() + b'\n' + body
+    return PKCS1_v1_5.new(public_key).verify(MD5.new(sign_bytes), signature)
 
 
 if __name__ == '__main__':
-    print(bucket.object_exists('media/'))
+    print(get_bucket().object_exists('media/'))
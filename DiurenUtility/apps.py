@@ -5,6 +5,44 @@ import logging
 CONTENT_DISPOSITION_INLINE_FILE_EXTS = ('jpeg', 'jpg', 'png', 'bmp', 'gif', 'webp', 'svg', 'ico')
 
 OSS_SIGNED_URL_EXPIRE = 5 * 60
+# 签名url的缓存时间，在过期前预留一段时间，保证返回给用户的url仍有足够的有效期
+OSS_SIGNED_URL_CACHE_EXPIRE = OSS_SIGNED_URL_EXPIRE - 60
+OSS_SIGNED_URL_CACHE_PREFIX = 'oss-url:'
+
+# OSS 客户端设置，可通过 ALIYUN_OSS_STORAGE 中的同名键覆盖
+# 连接池大小，应不小于同时访问 OSS 的线程数
+OSS_CONNECTION_POOL_SIZE = 20
+# 建立连接的超时时间（秒）
+OSS_CONNECT_TIMEOUT = 10
+# 请求失败时的重试次数
+OSS_REQUEST_RETRIES = 3
+
+# 对象元数据缓存设置，可通过 ALIYUN_OSS_STORAGE 中的同名键覆盖
+# 进程内缓存的对象数上限
+OSS_METADATA_CACHE_SIZE = 4096
+# 缓存时间（秒）
+OSS_METADATA_CACHE_EXPIRE = 60
+# 同时使用的 Django 缓存（CACHES 中的别名），为 None 时仅使用进程内缓存
+OSS_METADATA_CACHE_ALIAS = None
+
+# 分片上传设置，可通过 ALIYUN_OSS_STORAGE 中的同名键覆盖
+# 文件大小超过 MULTIPART_THRESHOLD 时改用分片上传
+OSS_MULTIPART_THRESHOLD = 1 * 1024 * 1024
+# 期望的分片大小，分片数超过 OSS 上限（10000）时自动增大
+OSS_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+# 并发上传分片的线程数
+OSS_MULTIPART_THREADS = 4
+# 同时在内存中等待或正在上传的分片数上限，内存占用约为 分片大小 * 该值
+OSS_MULTIPART_MAX_IN_FLIGHT = 8
+
+# 列目录时每个请求返回的条目数（OSS 上限为 1000）
+OSS_LIST_PAGE_SIZE = 1000
+
+# 批量删除时每个请求包含的对象数（OSS 上限为 1000）
+OSS_BATCH_DELETE_SIZE = 1000
+
+# 读取 OSS 对象时每次 Range 请求预读的字节数
+OSS_READ_AHEAD_SIZE = 1024 * 1024
 
 
 class DiurenutilityConfig(AppConfig):
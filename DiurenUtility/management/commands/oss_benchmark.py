@@ -0,0 +1,178 @@
+import random
+import time
+import tracemalloc
+import uuid
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+
+from DiurenUtility.aliyun_oss.fake import FakeBucket
+from DiurenUtility.aliyun_oss.storage import AliyunMediaStorage
+from DiurenUtility.utility import file_md5
+
+MB = 1024 * 1024
+
+BENCHMARK_PREFIX = 'benchmark/'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = '使用进程内模拟的 OSS Bucket 评估阿里云存储后端的性能，' \
+           '输出各项操作的吞吐量、延迟分位数与峰值内存。'
+
+    benchmarks = ('small-save', 'large-save', 'read-full', 'read-range', 'listdir', 'sign-url',
+                  'sign-url-cached')
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', nargs='*',
+                            help='要运行的测试项目，默认运行全部项目：' + '，'.join(self.benchmarks))
+        parser.add_argument('--latency', type=float, default=20,
+                            help='模拟的请求延迟（毫秒），默认 20')
+        parser.add_argument('--bandwidth', type=float, default=0,
+                            help='模拟的传输速度（MB/s），默认不限制')
+        parser.add_argument('--failure-rate', type=float, default=0,
+                            help='模拟的请求失败率（0-1），默认 0')
+        parser.add_argument('--count', type=int, default=200,
+                            help='小文件保存、随机读取、url签名的操作次数，默认 200')
+        parser.add_argument('--small-size', type=int, default=4,
+                            help='小文件大小（KB），默认 4')
+        parser.add_argument('--large-size', type=int, default=64,
+                            help='大文件大小（MB），默认 64')
+        parser.add_argument('--list-size', type=int, default=1000,
+                            help='列目录测试中目录下的对象数，默认 1000')
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+
+    def handle(self, *args, **options):
+        for name in options['benchmark']:
+            if name not in self.benchmarks:
+                raise CommandError('未知的测试项目：{name}'.format(name=name))
+        # 存储后端在第一次访问 OSS 时才创建客户端，替换为 FakeBucket 后无需 OSS 配置
+        self.storage = AliyunMediaStorage()
+        self.bucket = FakeBucket(latency=options['latency'] / 1000,
+                                 bandwidth=options['bandwidth'] * MB or None,
+                                 failure_rate=options['failure_rate'], seed=options['seed'])
+        self.storage.bucket = self.bucket
+        self.options = options
+        self.random = random.Random(options['seed'])
+        self.large_data = None
+
+        self.stdout.write('延迟 {latency}ms，带宽 {bandwidth}，失败率 {rate}'.format(
+            latency=options['latency'],
+            bandwidth='{0}MB/s'.format(options['bandwidth']) if options['bandwidth'] else '不限',
+            rate=options['failure_rate']))
+        self.stdout.write('{:<16}{:>8}{:>8}{:>12}{:>10}{:>10}{:>10}{:>12}{:>10}'.format(
+            '项目', '次数', '失败', '吞吐量MB/s', 'p50 ms', 'p95 ms', 'p99 ms', '峰值内存MB',
+            '请求数'))
+        for name in options['benchmark'] or self.benchmarks:
+            getattr(self, 'benchmark_' + name.replace('-', '_'))()
+
+    def measure(self, name, operations):
+        """
+        依次执行 operations 中的每个操作（返回处理的字节数），记录延迟与峰值内存。
+        模拟 Bucket 保存的数据不计入 tracemalloc 统计，峰值内存即存储后端自身的内存占用，
+        因此操作所需的数据应在调用前准备好。失败的操作计入失败数，并输出第一次失败的原因。
+        """
+        latencies, errors, total_bytes = [], 0, 0
+        first_error = None
+        requests = sum(self.bucket.requests.values())
+        tracemalloc.start()
+        started = time.perf_counter()
+        for operation in operations:
+            op_started = time.perf_counter()
+            try:
+                total_bytes += operation() or 0
+            except Exception as e:
+                errors += 1
+                if first_error is None:
+                    first_error = e
+            latencies.append(time.perf_counter() - op_started)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.stdout.write('{:<16}{:>8}{:>8}{:>12.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>12.2f}{:>10}'.format(
+            name, len(latencies), errors, total_bytes / MB / elapsed if elapsed else 0,
+            percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000, peak / MB,
+            sum(self.bucket.requests.values()) - requests))
+        if first_error is not None:
+            self.stderr.write('{name}：第一次失败 {error!r}'.format(name=name, error=first_error))
+
+    def get_large_object(self):
+        name = BENCHMARK_PREFIX + 'large.bin'
+        if self.large_data is None:
+            self.large_data = bytes(self.random.getrandbits(8) for _i in range(MB)) * \
+                              self.options['large_size']
+            self.bucket._put(self.storage.get_object_key(name), self.large_data)
+        return name
+
+    def benchmark_small_save(self):
+        data = bytes(self.random.getrandbits(8) for _i in range(self.options['small_size'] * 1024))
+
+        def save(i):
+            return lambda: len(data) if self.storage.save(
+                BENCHMARK_PREFIX + 'small/{0}.bin'.format(i), ContentFile(data)) else 0
+
+        self.measure('small-save', [save(i) for i in range(self.options['count'])])
+
+    def benchmark_large_save(self):
+        data = bytes(self.random.getrandbits(8) for _i in range(MB)) * self.options['large_size']
+        content = ContentFile(data)
+
+        def save():
+            self.storage.save(BENCHMARK_PREFIX + 'upload.bin', content)
+            return len(data)
+
+        self.measure('large-save', [save])
+
+    def benchmark_read_full(self):
+        name = self.get_large_object()
+
+        def read():
+            file = self.storage.open(name)
+            file_md5(file)
+            file.close()
+            return len(self.large_data)
+
+        self.measure('read-full', [read])
+
+    def benchmark_read_range(self):
+        name = self.get_large_object()
+        size = len(self.large_data)
+
+        def read(offset):
+            def operation():
+                file = self.storage.open(name)
+                file.seek(offset)
+                data = file.read(4)
+                file.close()
+                return len(data)
+
+            return operation
+
+        self.measure('read-range', [read(self.random.randrange(size))
+                                    for _i in range(self.options['count'])])
+
+    def benchmark_listdir(self):
+        directory = BENCHMARK_PREFIX + 'list/'
+        for i in range(self.options['list_size']):
+            self.bucket._put(self.storage.get_object_key(directory + '{0}.bin'.format(i)), b'')
+        self.measure('listdir', [lambda: self.storage.listdir(directory) and 0])
+
+    def benchmark_sign_url(self):
+        # 每次运行使用不同的文件名，使其url均未被缓存，无需清空缓存中的其它数据
+        directory = BENCHMARK_PREFIX + 'sign/{0}/'.format(uuid.uuid4().hex)
+        self.measure('sign-url', [lambda i=i: self.storage.url(
+            directory + 'file{0}.bin'.format(i)) and 0 for i in range(self.options['count'])])
+
+    def benchmark_sign_url_cached(self):
+        name = BENCHMARK_PREFIX + 'cached.bin'
+        self.storage.url(name)
+        self.measure('sign-url-cached', [lambda: self.storage.url(name) and 0
+                                         for _i in range(self.options['count'])])
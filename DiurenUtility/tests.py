@@ -1,14 +1,322 @@
-from io import BytesIO
+import shutil
+import tempfile
+import zipfile
+from io import BytesIO, StringIO
+from unittest import mock
 
 from PIL import Image
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
 from django.test import TestCase
 
 # Create your tests here.
 import os
 from django.core.mail import send_mail
 
+from DiurenUtility.aliyun_oss.client import get_metadata_cache
+from DiurenUtility.aliyun_oss.fake import FakeBucket
+from DiurenUtility.aliyun_oss.storage import AliyunMediaStorage
+from DiurenUtility.utility import delete_many, parse_range_header, stream_zip
+
 os.environ['DJANGO_SETTINGS_MODULE'] = 'DiurenCMS.settings'
 
+
+class OSSStorageTestCase(TestCase):
+    '''
+    使用模拟的 OSS Bucket；直接通过 bucket 读写对象，模拟其它进程的操作
+    '''
+
+    def setUp(self):
+        get_metadata_cache().clear()
+        self.addCleanup(get_metadata_cache().clear)
+        self.storage = AliyunMediaStorage()
+        self.bucket = FakeBucket()
+        self.storage.bucket = self.bucket
+
+    def put_elsewhere(self, name, data=b'data'):
+        self.bucket.put_object(self.storage.get_object_key(name), data)
+
+
+class OSSMetadataCacheTest(OSSStorageTestCase):
+    def test_size_cached(self):
+        self.storage.save('a.txt', ContentFile(b'abc'))
+        self.assertEqual(self.storage.size('a.txt'), 3)
+        heads = self.bucket.requests['head_object']
+        self.storage.size('a.txt')
+        self.storage.get_modified_time('a.txt')
+        self.assertEqual(self.bucket.requests['head_object'], heads)
+
+    # 对象不存在的结果不被缓存，其它进程写入的对象随即可见
+    def test_missing_not_cached(self):
+        self.assertFalse(self.storage.exists('a.txt'))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size('a.txt')
+        self.put_elsewhere('a.txt', b'abc')
+        self.assertTrue(self.storage.exists('a.txt'))
+        self.assertEqual(self.storage.size('a.txt'), 3)
+
+    def test_exists_not_cached(self):
+        self.storage.save('a.txt', ContentFile(b'abc'))
+        self.storage.size('a.txt')
+        self.bucket.delete_object(self.storage.get_object_key('a.txt'))
+        self.assertFalse(self.storage.exists('a.txt'))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size('a.txt')
+
+    def test_available_name(self):
+        self.assertEqual(self.storage.get_available_name('other/a.txt'), 'other/a.txt')
+        self.put_elsewhere('other/a.txt')
+        self.assertNotEqual(self.storage.get_available_name('other/a.txt'), 'other/a.txt')
+
+class OSSUrlCacheTest(OSSStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(self.bucket, 'sign_url', wraps=self.bucket.sign_url)
+        self.sign_url = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_url_cached(self):
+        url = self.storage.url('a.txt')
+        self.assertEqual(self.storage.url('a.txt'), url)
+        self.assertEqual(self.sign_url.call_count, 1)
+        # 下载文件名不同的url分别缓存
+        self.assertNotEqual(self.storage.url('a.txt', 'b.txt'), url)
+        self.assertEqual(self.sign_url.call_count, 2)
+
+    # 对象被覆盖或删除后，其url缓存失效
+    def test_url_invalidated(self):
+        self.storage.url('a.txt')
+        self.storage.save('a.txt', ContentFile(b'abc'))
+        self.storage.url('a.txt')
+        self.assertEqual(self.sign_url.call_count, 2)
+        self.storage.delete('a.txt')
+        self.storage.url('a.txt')
+        self.assertEqual(self.sign_url.call_count, 3)
+
+    def test_urls(self):
+        expected = [self.storage.url('a.txt'), self.storage.url('b.txt', 'c.txt')]
+        urls = self.storage.urls([('a.txt', None), ('b.txt', 'c.txt'), ('d.txt', None)])
+        self.assertEqual(urls[:2], expected)
+        self.assertEqual(self.sign_url.call_count, 3)
+        self.assertEqual(self.storage.url('a.txt', sign=False),
+                         self.storage.urls([('a.txt', None)], sign=False)[0])
+
+
+@mock.patch('DiurenUtility.aliyun_oss.storage.OSS_READ_AHEAD_SIZE', 100)
+class OSSRangedReadTest(OSSStorageTestCase):
+    data = b''.join(b'line %04d\n' % i for i in range(1000))
+
+    def setUp(self):
+        super().setUp()
+        self.storage.save('a.txt', ContentFile(self.data))
+        self.file = self.storage.open('a.txt')
+        self.addCleanup(self.file.close)
+
+    def gets(self):
+        return self.bucket.requests['get_object']
+
+    # 小块读取命中预读缓冲区，不再发起请求
+    def test_read_ahead(self):
+        self.assertEqual(self.file.read(10), self.data[:10])
+        self.assertEqual(self.gets(), 1)
+        self.assertEqual(self.file.read(50), self.data[10:60])
+        self.assertEqual(self.file.tell(), 60)
+        self.assertEqual(self.gets(), 1)
+        self.assertEqual(self.file.read(50), self.data[60:110])
+        self.assertEqual(self.gets(), 2)
+
+    def test_seek(self):
+        self.file.seek(5000)
+        self.assertEqual(self.file.read(10), self.data[5000:5010])
+        self.file.seek(-10, os.SEEK_END)
+        self.assertEqual(self.file.read(), self.data[-10:])
+        self.assertEqual(self.file.read(10), b'')
+        self.file.seek(20, os.SEEK_END)
+        self.assertEqual(self.file.read(), b'')
+        with self.assertRaises(ValueError):
+            self.file.seek(-1)
+
+    # 大块读取直接请求所需的范围，不经过缓冲区
+    def test_large_read(self):
+        self.file.seek(1000)
+        self.assertEqual(self.file.read(500), self.data[1000:1500])
+        self.assertEqual(self.gets(), 1)
+        self.assertEqual(self.file.read(), self.data[1500:])
+        self.assertEqual(self.gets(), 2)
+
+    def test_chunks(self):
+        chunks = list(self.file.chunks(chunk_size=3000))
+        self.assertEqual([len(chunk) for chunk in chunks], [3000, 3000, 3000, 1000])
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual(self.gets(), 4)
+
+    def test_iteration(self):
+        self.assertEqual(list(self.file), self.data.splitlines(keepends=True))
+
+
+class OSSDeleteManyTest(OSSStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.names = ['a/%d.txt' % i for i in range(5)]
+        for name in self.names:
+            self.storage.save(name, ContentFile(b'data'))
+
+    @mock.patch('DiurenUtility.aliyun_oss.storage.OSS_BATCH_DELETE_SIZE', 2)
+    def test_batches(self):
+        self.storage.size('a/0.txt')
+        delete_many(self.storage, self.names + ['a/0.txt'])
+        self.assertEqual(self.bucket.requests['batch_delete_objects'], 3)
+        self.assertEqual(self.bucket.requests['delete_object'], 0)
+        self.assertEqual(self.bucket.object_count, 0)
+        # 缓存的元数据随之失效
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size('a/0.txt')
+
+    def test_single_batch(self):
+        delete_many(self.storage, self.names[:3])
+        self.assertEqual(self.bucket.requests['batch_delete_objects'], 1)
+        self.assertEqual(self.storage.listdir('a')[1], ['3.txt', '4.txt'])
+
+    def test_empty(self):
+        delete_many(self.storage, [])
+        self.assertEqual(self.bucket.requests['batch_delete_objects'], 0)
+
+
+class OSSIterDirTest(OSSStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        # 目录本身的占位对象不作为条目返回
+        self.put_elsewhere('a/', b'')
+        for name in ('a/1.txt', 'a/2.txt', 'a/3.txt', 'a/sub/x.txt', 'a/sub2/y.txt', 'b/z.txt'):
+            self.put_elsewhere(name, name.encode())
+
+    def test_listdir(self):
+        self.assertEqual(self.storage.listdir('a'), (['sub', 'sub2'], ['1.txt', '2.txt', '3.txt']))
+        self.assertEqual(self.storage.listdir('a/sub/'), ([], ['x.txt']))
+
+    def test_entries(self):
+        entries = list(self.storage.iter_dir('a'))
+        self.assertEqual([(e.name, e.path, e.is_dir, e.size) for e in entries], [
+            ('1.txt', 'a/1.txt', False, 7),
+            ('2.txt', 'a/2.txt', False, 7),
+            ('3.txt', 'a/3.txt', False, 7),
+            ('sub', 'a/sub/', True, None),
+            ('sub2', 'a/sub2/', True, None),
+        ])
+        self.assertIsNotNone(entries[0].last_modified)
+
+    # 每次只请求一页，取得第一个条目时只发起一个请求
+    def test_pagination(self):
+        entries = self.storage.iter_dir('a', page_size=2)
+        self.assertEqual(next(entries).name, '1.txt')
+        self.assertEqual(self.bucket.requests['list_objects'], 1)
+        self.assertEqual(len(list(entries)), 4)
+        self.assertEqual(self.bucket.requests['list_objects'], 3)
+
+    def test_resume(self):
+        entries = list(self.storage.iter_dir('a', page_size=2))
+        self.assertEqual(list(self.storage.iter_dir('a', start_after=entries[1].path)),
+                         entries[2:])
+        self.assertEqual(list(self.storage.iter_dir('a', start_after=entries[3].path)),
+                         entries[4:])
+
+    def test_recursive(self):
+        self.assertEqual([e.path for e in self.storage.iter_dir('a', recursive=True)],
+                         ['a/1.txt', 'a/2.txt', 'a/3.txt', 'a/sub/x.txt', 'a/sub2/y.txt'])
+        self.assertEqual([e.name for e in self.storage.iter_dir('', recursive=True, page_size=3)],
+                         ['a/1.txt', 'a/2.txt', 'a/3.txt', 'a/sub/x.txt', 'a/sub2/y.txt',
+                          'b/z.txt'])
+
+
+class LocalDeleteManyTest(TestCase):
+    def test_fallback(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        storage = FileSystemStorage(location=location)
+        names = [storage.save('a/%d.txt' % i, ContentFile(b'data')) for i in range(3)]
+        delete_many(storage, (name for name in names[:2]))
+        self.assertEqual(storage.listdir('a')[1], ['2.txt'])
+
+
+class RangeHeaderTest(TestCase):
+    def test_range(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range_header('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=-200', 100), (0, 99))
+
+    # 无法解析或不支持的范围返回 None，发送完整内容
+    def test_ignored(self):
+        for header in ('items=0-9', 'bytes=0-9,20-29', 'bytes=9', 'bytes=a-b', 'bytes=--1'):
+            self.assertIsNone(parse_range_header(header, 100), header)
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=10-5', 'bytes=-0'):
+            with self.assertRaises(ValueError, msg=header):
+                parse_range_header(header, 100)
+
+
+class OSSBenchmarkTest(TestCase):
+    def run_benchmark(self, *args, **options):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('oss_benchmark', *args, latency=0, count=5, large_size=2, stdout=stdout,
+                     stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_benchmark(self):
+        stdout, stderr = self.run_benchmark('small-save', 'large-save', 'read-range')
+        self.assertIn('large-save', stdout)
+        self.assertEqual(stderr, '')
+
+    # 失败的操作计入失败数，并输出第一次失败的原因
+    def test_failure_reported(self):
+        stdout, stderr = self.run_benchmark('small-save', failure_rate=1)
+        self.assertIn('small-save：第一次失败', stderr)
+
+
+class StreamZipTest(TestCase):
+    date_time = (2019, 8, 1, 12, 0, 0)
+
+    def test_stream_zip(self):
+        entries = [
+            ('root/', self.date_time, None),
+            ('root/sub/', self.date_time, None),
+            ('root/sub/a.txt', self.date_time, iter([b'hello ', b'world'])),
+            ('root/empty.txt', self.date_time, iter([])),
+        ]
+        archive = zipfile.ZipFile(BytesIO(b''.join(stream_zip(entries))))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ['root/', 'root/sub/', 'root/sub/a.txt',
+                                              'root/empty.txt'])
+        self.assertTrue(archive.getinfo('root/sub/').is_dir())
+        self.assertEqual(archive.read('root/sub/a.txt'), b'hello world')
+        self.assertEqual(archive.read('root/empty.txt'), b'')
+        self.assertEqual(archive.getinfo('root/sub/a.txt').date_time, self.date_time)
+
+    # 文件内容边读取边输出，不等待整个文件读取完毕
+    def test_streaming(self):
+        consumed = []
+
+        def chunks():
+            for i in range(3):
+                consumed.append(i)
+                yield b'x' * 1024
+
+        output = stream_zip([('a.bin', self.date_time, chunks())])
+        pieces = []
+        for piece in output:
+            pieces.append(piece)
+            if len(consumed) == 1:
+                break
+        self.assertGreater(sum(map(len, pieces)), 1024)
+        self.assertEqual(consumed, [0])
+
+
 if __name__ == '__main__':
     # send_mail(
     #     '来自Django的测试邮件',
@@ -1,5 +1,8 @@
+import hashlib
+import os
 import random
 import string
+import zipfile
 from io import BytesIO
 
 from PIL import Image
@@ -92,6 +95,165 @@ def send_mail(context, from_email, to_email, subject_template_name=None,
     email_message.send()
 
 
+# 按块计算文件的 MD5，内存占用不超过一个块的大小
+def file_md5(file: File, chunk_size: int = None) -> str:
+    hasher = hashlib.md5()
+    for chunk in file.chunks(chunk_size):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class MD5HashingFile(File):
+    """
+    在文件内容被读取的同时计算其 MD5，例如将其作为 content 传给 Storage.save，
+    则保存完成后即可通过 md5 属性获得校验值，文件内容只需读取一次。
+    注意：仅在文件被从头至尾顺序读取一遍时结果有效，回到文件开头时会重新计算。
+    """
+
+    def __init__(self, file, name=None):
+        super().__init__(file, name)
+        self._hasher = hashlib.md5()
+
+    def read(self, *args, **kwargs):
+        data = self.file.read(*args, **kwargs)
+        self._hasher.update(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        result = self.file.seek(offset, whence)
+        if offset == 0 and whence == 0:
+            self._hasher = hashlib.md5()
+        return result
+
+    @property
+    def md5(self) -> str:
+        return self._hasher.hexdigest()
+
+
+class LocalFileWriter:
+    """
+    逐块写入本地文件系统存储（FileSystemStorage），接口与 AliyunFileWriter 一致。
+    """
+
+    def __init__(self, storage, name):
+        self._storage = storage
+        self.name = storage.get_available_name(name)
+        self._path = storage.path(self.name)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._file = open(self._path, 'xb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        return self.name.replace('\\', '/')
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._path)
+
+
+# 打开一个可逐块写入存储后端的对象，写入完成后调用 close() 获得实际保存的名称，失败时调用 abort()
+def open_storage_writer(storage, name, buffer_size: int):
+    if hasattr(storage, 'open_writer'):
+        return storage.open_writer(name, buffer_size)
+    return LocalFileWriter(storage, name)
+
+
+# 批量删除存储后端中的文件；存储后端不支持批量删除时（如 FileSystemStorage）逐个删除
+def delete_many(storage, names):
+    names = list(names)
+    if hasattr(storage, 'delete_many'):
+        return storage.delete_many(names)
+    for name in names:
+        storage.delete(name)
+
+
+# 解析 HTTP Range 请求头，返回闭区间 (start, end)；不支持多段范围，此时返回 None 以发送完整内容
+# 范围无法满足时抛出 ValueError
+def parse_range_header(header: str, size: int):
+    unit, _sep, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    start, sep, end = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # bytes=-n 表示最后 n 个字节；bytes=-0 的起始位置为 size，在下面作为无法满足的范围处理
+            length = int(end)
+            if length < 0:
+                return None
+            start, end = max(size - length, 0), size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+# 从文件的指定位置开始逐块读取 length 个字节，读取完毕后关闭文件
+def iter_file_range(file, start: int, length: int, chunk_size: int):
+    try:
+        if start:
+            file.seek(start)
+        while length > 0:
+            data = file.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+class _ZipStreamBuffer:
+    """
+    仅支持追加写入的缓冲区，ZipFile 检测到其不可 seek 后会以数据描述符的方式写入各文件，
+    已写入的数据通过 pop() 取出后即被释放。
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# 流式生成 ZIP 压缩包（存储模式，ZIP64），逐块返回压缩包内容，不在内存或磁盘中构建完整的压缩包
+# entries 为 (包内名称, 修改时间元组, 文件内容块的可迭代对象) 序列，内容为 None 时表示目录
+def stream_zip(entries):
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, date_time, chunks in entries:
+            if chunks is None:
+                info = zipfile.ZipInfo(name.rstrip('/') + '/', date_time)
+                info.external_attr = 0o40755 << 16 | 0x10
+                archive.writestr(info, b'')
+            else:
+                info = zipfile.ZipInfo(name, date_time)
+                info.external_attr = 0o644 << 16
+                with archive.open(info, 'w', force_zip64=True) as dest:
+                    for chunk in chunks:
+                        dest.write(chunk)
+                        yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
 class dotdict(dict):
     def __getattr__(self, item):
         item = self.__dict__.get(item, None)